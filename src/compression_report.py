@@ -0,0 +1,141 @@
+#! /usr/bin/python
+
+import io
+import logging
+from optparse import OptionParser
+import os
+import struct
+import sys
+
+import sie.classconfigs
+import sie.decoder
+import sie.decoder.c64
+import sie.encoder.v1
+import sie.encoder.v2
+import sie.encoder.v3
+from sie.encoder.common import COMPRESSION_MAX
+
+_encoders = {
+    1 : (sie.encoder.v1.EncoderV1, sie.classconfigs.ConfigV1),
+    2 : (sie.encoder.v2.EncoderV2, sie.classconfigs.ConfigV2),
+    3 : (sie.encoder.v3.EncoderV3, sie.classconfigs.ConfigV3)
+}
+
+def encodedSize(encoder, bmp, compression_method):
+    return encoder.writeImageData(io.BytesIO(), bmp.data.tolist(), bmp.width, bmp.height, compression_method)
+
+def readV1Map(lflf_path, name, size=None):
+    """ Decompresses one of a v1 room's maps. size: the size of the map, or None to read it from the file (for B5v1)."""
+    data = file(os.path.join(lflf_path, 'ROv1', name), 'rb').read()
+    if size is None:
+        # The 16bit length value seems to always be 8 too big (see c64.readMaskCharMap).
+        size = struct.unpack_from('<H', data)[0] - 8
+        data = data[2:]
+    # Runs are decoded whole, so there can be some extra values at the end.
+    return sie.decoder.c64.decodeC64GfxData(data, size)[:size]
+
+def report_room_v1(lflf_path):
+    """ Like report_room, for v1 rooms. Each map the encoder writes is compressed again,
+    since the background and objects share the character maps."""
+    encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
+    width, height = sie.decoder.v1.DecoderV1(sie.classconfigs.ConfigV1).readDimensions(lflf_path)
+    num_blocks = (width / 8) * (height / 8)
+    # (file name, size, whether it's a colour map)
+    maps = [('B1v1', 2048, False), ('B2v1', num_blocks, False), ('B3v1', num_blocks, True),
+            ('B4v1', num_blocks, False), ('B5v1', None, False)]
+    object_names = sorted(f for f in os.listdir(os.path.join(lflf_path, 'ROv1')) if f.startswith('OIv1_'))
+    for name in object_names:
+        obj_width, obj_height = sie.decoder.c64.readObjectDimensions(lflf_path, name[-4:])
+        maps.append((name, (obj_width / 8) * (obj_height / 8) * 3, False))
+    default_size = max_size = 0
+    for name, size, colours in maps:
+        data = readV1Map(lflf_path, name, size)
+        default_size += len(encoder.compressMap(data, None, colours))
+        max_size += len(encoder.compressMap(data, COMPRESSION_MAX, colours))
+    return 1 + len(object_names), default_size, max_size
+
+def report_room(lflf_path, version):
+    """ Re-encodes the background and object images of a room, with the default and max compression.
+    Returns the number of images, and the total size of their image data with each compression."""
+    if version == 1:
+        return report_room_v1(lflf_path)
+    encoder_class, config = _encoders[version]
+    encoder = encoder_class(config)
+    # The image path is only used to name the images.
+    images = sie.decoder.decodeImage(lflf_path, "image.png", version, 1, output_format=sie.decoder.MEMORY)
+    num_images = default_size = max_size = 0
+    for bmp, pal in images.itervalues():
+        if pal is None: # a mask
+            continue
+        num_images += 1
+        default_size += encodedSize(encoder, bmp, None)
+        max_size += encodedSize(encoder, bmp, COMPRESSION_MAX)
+    return num_images, default_size, max_size
+
+def report_game(game_path, version):
+    """ Prints the bytes saved by the max compression for each room, and for the whole game."""
+    config = _encoders[version][1]
+    lflf_names = [f for f in sorted(os.listdir(game_path))
+                  if os.path.isfile(os.path.join(game_path, f, *config.header_path))]
+    lines = []
+    total_default = total_max = 0
+    for lflf_name in lflf_names:
+        num_images, default_size, max_size = report_room(os.path.join(game_path, lflf_name), version)
+        total_default += default_size
+        total_max += max_size
+        lines.append("%-12s %3d images %8d bytes default %8d bytes max %6d saved" %
+                     (lflf_name, num_images, default_size, max_size, default_size - max_size))
+    # Print after decoding everything, so the report isn't mixed up with the decoders' warnings.
+    for line in lines:
+        print line
+    if total_default:
+        print "Total: %d rooms, %d bytes saved (%.1f%% of %d bytes)" % (len(lflf_names), total_default - total_max,
+                                                                       100.0 * (total_default - total_max) / total_default,
+                                                                       total_default)
+    else:
+        print "No v%d rooms found." % version
+
+def configure_logging():
+    # Warnings only, to leave out the encoders' reports of the bytes saved by each image.
+    logging.basicConfig(format="", level=logging.WARNING)
+
+
+def validate_args(args, options):
+    if len(args) < 1:
+        print "Insufficient arguments. I need the game path."
+        return False
+    if not os.path.isdir(args[0]):
+        print "Invalid game path."
+        return False
+    if options.version not in _encoders:
+        print "Only SCUMM v1, v2 and v3 have a max compression."
+        return False
+    return True
+
+
+def main(args):
+    oparser = OptionParser(usage="%prog [options] game_path\n\n"
+                           "Reports how many bytes --max-compression would save on the background and object images "
+                           "of every room in a game. game_path is a directory of unpacked LFLF directories.",
+                           version="1.0")
+    oparser.add_option("-v", "--sversion", action="store",
+                      dest="version", default=2, type="int",
+                      help="The version of SCUMM the game uses: 1, 2 or 3. Default is 2.")
+
+    options, args = oparser.parse_args(args)
+
+    if not validate_args(args, options):
+        oparser.print_help()
+        return 1
+
+    configure_logging()
+    try:
+        report_game(args[0], options.version)
+    except Exception, e:
+        logging.exception("Unhandled exception: \n")
+        return 2
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
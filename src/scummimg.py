@@ -46,20 +46,24 @@ THE SOFTWARE.
 ####
 ##################################################################
 import logging
+import os
 import sys
 import traceback
 from optparse import OptionParser
 
 from sie.decoder import *
 from sie.encoder import *
+from sie.encoder.common import COMPRESSION_MAX
+from sie.logcontext import configureLogging
+from sie.trace import enableTrace
 
-def configure_logging():
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.DEBUG,
-                        filename='scummimg.log',
-                        filemode='w')
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+def configure_logging(options, job):
+    log_path = None if options.no_log else options.log_file
+    configureLogging(getattr(logging, options.log_level), log_path, job)
 
 def main():
-    configure_logging()
     oparser = OptionParser(usage="%prog [options] lflf_path imagefile.png",
                       version="scumm image encoder v2 r2")
     
@@ -86,6 +90,44 @@ def main():
     oparser.add_option("-v", "--sversion", action="store",
                       dest="version", default=6, type="int",
                       help="The version of SCUMM to target: 1, 2, 3, 5 or 6. Default is 6.")
+    oparser.add_option("--max-compression", action="store_true",
+                      dest="max_compression", default=False,
+                      help="When encoding v1, v2 or v3 images, find the smallest encoding instead of matching the original encoder. "
+                      "Slower. Logs how many bytes were saved at the INFO level.")
+    oparser.add_option("-j", "--jobs", action="store",
+                      dest="jobs", default=1, type="int",
+                      help="When decoding v4/v5/v6 images, decode the strips in this many processes. 0 uses one per CPU.\n" +
+                            "Default: 1")
+    oparser.add_option("-o", "--output-format", action="store",
+                      dest="output_format", default="png", type="choice", choices=["png", "raw", "npy"],
+                      help="When decoding, the type of file to write: png, raw (a .bin file of palette indexes and a .pal file of R, G, B values) "
+                      "or npy (a NumPy array of palette indexes).\n" +
+                            "Default: png")
+    oparser.add_option("--png-level", action="store",
+                      dest="png_level", default=None, type="int",
+                      help="When decoding to PNG, the zlib compression level, from 0 (fastest) to 9 (smallest).\n" +
+                            "Default: PIL's default")
+    
+    oparser.add_option("--log-level", action="store",
+                      dest="log_level", default="WARNING", type="choice", choices=LOG_LEVELS,
+                      help="Only log messages at this level or above: " + ", ".join(LOG_LEVELS) + ". "
+                      "Use INFO to see the encoders' reports: the compression method and size of each v5/v6 strip, "
+                      "and the bytes saved by --max-compression.\n" +
+                            "Default: WARNING")
+    oparser.add_option("--log-file", action="store",
+                      dest="log_file", default="scummimg-{job}.log",
+                      help="Append log messages to this file. {job} is replaced by the name of the LFLF directory, "
+                      "and {pid} by the process ID, to give parallel runs their own files.\n" +
+                            "Default: scummimg-{job}.log")
+    oparser.add_option("--no-log", action="store_true",
+                      dest="no_log", default=False,
+                      help="Don't write a log file.")
+    oparser.add_option("--trace", action="store_true",
+                      dest="trace", default=False,
+                      help="Log a trace of every run read or written by the v2/v3 decoders and the v2 encoder. Slow.")
+    oparser.add_option("--trace-file", action="store",
+                      dest="trace_file", default=None,
+                      help="Write the trace to this file instead of the log, one JSON object per line. Implies --trace.")
     
     options, args = oparser.parse_args()
     
@@ -95,20 +137,30 @@ def main():
         or options.version > 6
         or options.quantize < 1
         or options.quantize > 256
-        or options.palette_num < 1):
+        or options.palette_num < 1
+        or options.jobs < 0
+        or (options.max_compression and options.version not in (1, 2, 3))
+        or (options.png_level is not None and (options.png_level < 0 or options.png_level > 9))):
         returnval = 1
         oparser.print_help()
         return returnval
 
     lflf_path = args[0]
     image_path = args[1]
+    configure_logging(options, os.path.basename(os.path.normpath(lflf_path)))
+    if options.trace or options.trace_file:
+        enableTrace(options.trace_file)
+
     try:
         if options.encode:
-            encodeImage(lflf_path, image_path, options.version, options.quantize, options.palette_num, options.freeze_palette)
+            compression_method = COMPRESSION_MAX if options.max_compression else None
+            encodeImage(lflf_path, image_path, options.version, options.quantize, options.palette_num, options.freeze_palette,
+                        compression_method)
             print "Done!"
             returnval = 0
         elif options.decode:
-            decodeImage(lflf_path, image_path, options.version, options.palette_num)
+            decodeImage(lflf_path, image_path, options.version, options.palette_num, jobs=options.jobs,
+                        output_format=options.output_format, png_compress_level=options.png_level)
             print "Done!"
             returnval = 0
         else:
@@ -5,6 +5,7 @@ import sie.decoder.v4
 import sie.decoder.v5
 import sie.decoder.v6
 import sie.classconfigs
+from sie.decoder.output import ImageOutput, OUTPUT_FORMATS, PNG, RAW, NPY, MEMORY
 from sie.sie_util import ScummImageEncoderException
 
 _version_map = [
@@ -17,9 +18,36 @@ _version_map = [
     (v6.DecoderV6, sie.classconfigs.ConfigV6)
 ]
 
-def decodeImage(lflf_path, image_path, version, palette_num):
+def _getDecoder(version, output=None):
     if version < 0 or version >= len(_version_map) or _version_map[version] is None:
         raise ScummImageEncoderException("Unsupported SCUMM version: %d" % version)
     decoder_class, config = _version_map[version]
-    decoder = decoder_class(config)
-    decoder.decodeImage(lflf_path, image_path, palette_num)
+    decoder = decoder_class(config, output)
+    return decoder
+
+def decodeImage(lflf_path, image_path, version, palette_num, jobs=None, output_format=PNG, png_compress_level=None):
+    """ output_format: one of OUTPUT_FORMATS. PNG, RAW (.bin and .pal files) and NPY files are written
+    next to image_path. MEMORY writes nothing, and returns a dictionary mapping each image path
+    (including masks and objects) to its bitmap and palette (None for black and white masks).
+    png_compress_level: zlib level for PNG files, from 0 (fastest) to 9 (smallest), or None for PIL's default."""
+    output = ImageOutput(output_format, png_compress_level)
+    decoder = _getDecoder(version, output)
+    decoder.decodeImage(lflf_path, image_path, palette_num, jobs=jobs)
+    if output_format == MEMORY:
+        return output.images
+
+def decodeBitmap(lflf_path, version, palette_num=1, jobs=None):
+    """ Decodes a room's background image without writing an image file.
+    Returns the bitmap (a sie.sie_util.Bitmap of palette indexes, with width and height attributes),
+    and the palette as a sequence of R, G, B values."""
+    decoder = _getDecoder(version)
+    return decoder.decodeBitmap(lflf_path, palette_num, jobs)
+
+def decodeViewport(lflf_path, version, x, view_width):
+    """ Decodes the part of a room's image from x to x + view_width, without decoding the rest of the room.
+    Only supported for v4 to v6. Returns the bitmap (view_width pixels wide, one palette index per pixel),
+    and its height."""
+    decoder = _getDecoder(version)
+    if not hasattr(decoder, 'readBitmapViewport'):
+        raise ScummImageEncoderException("Decoding a viewport is not supported for SCUMM version: %d" % version)
+    return decoder.readBitmapViewport(lflf_path, x, view_width)
@@ -2,10 +2,17 @@ import array
 import os
 import logging
 import struct
-from sie.sie_util import ScummImageEncoderException
+import numpy as np
+from sie.sie_util import initBitmapData, readSmapData, ScummImageEncoderException
 
 DEBUG_DUMP = False
 
+# Shifts to get the 2 bit colour indexes out of a character byte, leftmost pixel first.
+#  Each value is output twice - effectively means you've got a half-width image.
+BLOCK_COLOUR_SHIFTS = np.array([6, 6, 4, 4, 2, 2, 0, 0], np.uint8)
+# Shifts to get the mask bits out of a mask character byte, leftmost pixel first.
+MASK_BIT_SHIFTS = np.arange(8, dtype=np.uint8)
+
 def readCommonColours(lflf_path):
     coloursPath = os.path.join(lflf_path, 'ROv1', 'BCv1')
     if not os.path.isfile(coloursPath):
@@ -65,6 +72,35 @@ def readMaskCharMap(lflf_path):
     maskCharFile.close()
     return maskCharMap
 
+class RoomResources(object):
+    """ The resources shared by a room's background and all its objects: the common colours (BCv1),
+    the character map (B1v1), and the mask character map (B5v1).
+    Each one is read the first time it's needed, then kept, unless it's passed in."""
+    def __init__(self, lflf_path, colours=None, charMap=None, maskCharMap=None):
+        self.lflf_path = lflf_path
+        self._colours = colours
+        self._charMap = charMap
+        self._maskCharMap = maskCharMap
+
+    @property
+    def colours(self):
+        """ A new list each time, since unpacking overwrites the fourth colour."""
+        if self._colours is None:
+            self._colours = readCommonColours(self.lflf_path)
+        return list(self._colours)
+
+    @property
+    def charMap(self):
+        if self._charMap is None:
+            self._charMap = readCharMap(self.lflf_path)
+        return self._charMap
+
+    @property
+    def maskCharMap(self):
+        if self._maskCharMap is None:
+            self._maskCharMap = readMaskCharMap(self.lflf_path)
+        return self._maskCharMap
+
 def readObjectDimensions(lflf_path, objectNumAsStr):
     objCodeFile = file(os.path.join(lflf_path, 'ROv1', 'OCv1_%s' % objectNumAsStr), 'rb')
     objCodeFile.seek(9, os.SEEK_SET)
@@ -82,21 +118,14 @@ def readObjectMap(lflf_path, width, height, objectNumAsStr):
     return objectMap
 
 def unpackBlock(charMap, colours, img_data, col_start, y, charIdx, dstPitch):
-    # For each of the 8 rows
-    for i in xrange(8):
-        row_start = col_start + ((y * 8 + i) * dstPitch)
-        c = charMap[charIdx + i]
-        # For 8 columns
-        for j in xrange(0, 8, 2):
-            # Each value is output twice - effectively means
-            #  you've got a half-width image.
-            val = colours[(c >> (6 - j)) & 3]
-            img_data[row_start + j] = val
-            img_data[row_start + j + 1] = val
+    # Each of the 8 rows is one byte, holding 4 colour indexes of 2 bits each.
+    chars = np.array(charMap[charIdx:charIdx + 8], np.uint8)
+    colour_indexes = (chars[:, np.newaxis] >> BLOCK_COLOUR_SHIFTS) & 3
+    img_data.rows[y * 8:y * 8 + 8, col_start:col_start + 8] = np.take(colours, colour_indexes)
 
 def unpackV1Object(objectMap, charMap, colours, width, height):
     charIdx = None
-    img_data = array.array('B', [0] * (width * height))
+    img_data = initBitmapData(width, height)
     dstPitch = width
     num_strips = width / 8
     num_blocks = height / 8
@@ -116,18 +145,15 @@ def unpackV1Object(objectMap, charMap, colours, width, height):
     return img_data
 
 def unpackMaskBlock(charMap, img_data, col_start, y, charIdx, dstPitch):
-    # For each of the 8 rows
-    for i in xrange(8):
-        row_start = col_start + ((y * 8 + i) * dstPitch)
-        c = charMap[charIdx + i]
-        # For 8 columns
-        for j in xrange(8):
-            # Masks only store 1 or 0. 1 byte holds mask values for 8 columns.
-            img_data[row_start + j] = (c & (2 ** j)) >> j
+    # Masks only store 1 or 0. 1 byte holds mask values for 8 columns,
+    #  starting from the lowest bit.
+    chars = np.array(charMap[charIdx:charIdx + 8], np.uint8)
+    block = (chars[:, np.newaxis] >> MASK_BIT_SHIFTS) & 1
+    img_data.rows[y * 8:y * 8 + 8, col_start:col_start + 8] = block
 
 def unpackV1ObjectMaskData(objectMap, maskCharMap, width, height):
     maskIdx = None
-    img_data = array.array('B', [0] * (width * height))
+    img_data = initBitmapData(width, height)
     dstPitch = width
     num_strips = width / 8
     num_blocks = height / 8
@@ -144,13 +170,16 @@ def unpackV1ObjectMaskData(objectMap, maskCharMap, width, height):
             unpackMaskBlock(maskCharMap, img_data, col_start, hstrip_i, maskIdx, dstPitch)
     return img_data
 
-def decodeV1Object(lflf_path, width, height, objectNumAsStr):
+def decodeV1Object(lflf_path, width, height, objectNumAsStr, resources=None):
+    """ resources: the room's RoomResources. Pass the same one for each object, to only read them once."""
     global DEBUG_DUMP
+    if resources is None:
+        resources = RoomResources(lflf_path)
     # The colours file requires running v1col_extract. Other files are generated by scummrp.
-    colours = readCommonColours(lflf_path)
-    charMap = readCharMap(lflf_path)
+    colours = resources.colours
+    charMap = resources.charMap
     objectMap = readObjectMap(lflf_path, width, height, objectNumAsStr)
-    maskCharMap = readMaskCharMap(lflf_path)
+    maskCharMap = resources.maskCharMap
     #logging.debug("obj objectMap size: %d" % len(objectMap))
     # Dump un-RLEed files
     if DEBUG_DUMP:
@@ -168,7 +197,7 @@ def decodeV1Object(lflf_path, width, height, objectNumAsStr):
 
 def unpackV1Background(charMap, picMap, colourMap, colours, width, height):
     charIdx = None
-    img_data = array.array('B', [0] * (width * height))
+    img_data = initBitmapData(width, height)
     num_strips = width / 8
     num_blocks = height / 8
     dstPitch = width
@@ -187,7 +216,7 @@ def unpackV1Background(charMap, picMap, colourMap, colours, width, height):
 
 def unpackV1BackgroundMask(maskPicMap, maskCharMap, width, height):
     charIdx = None
-    img_data = array.array('B', [0] * (width * height))
+    img_data = initBitmapData(width, height)
     num_strips = width / 8
     num_blocks = height / 8
     dstPitch = width
@@ -202,7 +231,7 @@ def unpackV1BackgroundMask(maskPicMap, maskCharMap, width, height):
             unpackMaskBlock(maskCharMap, img_data, col_start, y, maskIdx, dstPitch)
     return img_data
 
-def decodeV1Bitmap(lflf_path, width, height):
+def decodeV1Bitmap(lflf_path, width, height, resources=None):
     """
     Room format (offsets):
     probably starts with the size of the chunk.
@@ -221,14 +250,18 @@ def decodeV1Bitmap(lflf_path, width, height):
     charMap has output size of 2048.
     picMap, colourMap, and maskMap have an output size of width * height (I think) -
     that's width in num_strips and height in num_blocks.
+
+    resources: the room's RoomResources, if they're shared with the objects.
     """
     global DEBUG_DUMP
+    if resources is None:
+        resources = RoomResources(lflf_path)
     # The colours file requires running v1col_extract. Other files are generated by scummrp.
-    colours = readCommonColours(lflf_path)
-    charMap = readCharMap(lflf_path)
+    colours = resources.colours
+    charMap = resources.charMap
     picMap = readPicMap(lflf_path, width, height)
     colourMap = readColourMap(lflf_path, width, height)
-    maskCharMap = readMaskCharMap(lflf_path)
+    maskCharMap = resources.maskCharMap
     maskPicMap = readMaskPicMap(lflf_path, width, height)
 
     # Dump un-RLEed files
@@ -250,40 +283,48 @@ def decodeV1Bitmap(lflf_path, width, height):
     
 
 def decodeC64Gfx(src, size):
-    """This is an RLE variant."""
-    colour = None # actually could be any value, not just colours.
-    run = None
+    """This is an RLE variant. src can be a file, which is read to the end,
+    or the compressed data (a string, bytearray or buffer)."""
+    return decodeC64GfxData(readSmapData(src), size)
+
+def decodeC64GfxData(src_data, size):
+    """ Decodes at least size bytes of RLE data, starting with its 4 common values.
+    Runs are added to the output whole, so the result can be longer than size."""
+    # Indexing and slicing an array gives ints and arrays, which the output can extend with directly.
+    src_data = array.array('B', str(src_data))
     # Read the most common values
-    common = struct.unpack('<4B', src.read(4))
+    common = src_data[0:4]
     #logging.debug("RLE-> common: 0x%X, 0x%X, 0x%X, 0x%X" % common)
     data = array.array('B')
+    pos = 4
     try:
+        if len(common) < 4:
+            raise IndexError("missing the common values")
         while len(data) < size:
-            run, = struct.unpack('<B', src.read(1))
+            run = src_data[pos]
+            pos += 1
             #logging.debug("RLE-> item: %d.  run: 0x%X" % (len(data), run))
             # 0x80 indicates use of one of the common values.
             # common value index is stored in 0x60.
             # max run value is 31. (value is output 32 times)
             if run & 0x80:
-                colour = common[(run >> 5) & 3]
-                run &= 0x1F
-                for _ in xrange(run + 1):
-                    data.append(colour)
+                data.extend(common[(run >> 5) & 3:((run >> 5) & 3) + 1] * ((run & 0x1F) + 1))
             # 0x40 indicates a run of one (uncommon) value.
             # The value to repeat is stored in the next byte.
             # max run value is 63. (value is output 64 times)
             elif run & 0x40:
-                run &= 0x3F
-                colour, = struct.unpack('<B', src.read(1))
-                for _ in xrange(run + 1):
-                    data.append(colour)
+                if pos >= len(src_data):
+                    raise IndexError("missing the value to repeat")
+                data.extend(src_data[pos:pos + 1] * ((run & 0x3F) + 1))
+                pos += 1
             # If bits in 0xC0 are not set, indicates a run of discrete (non-repeated) values.
             # max run value is 63. (64 values are read and output)
             else:
-                for _ in xrange(run + 1):
-                    colour, = struct.unpack('<B', src.read(1))
-                    data.append(colour)
-    except Exception, e:
+                if pos + run + 1 > len(src_data):
+                    raise IndexError("missing some of the values")
+                data.extend(src_data[pos:pos + run + 1])
+                pos += run + 1
+    except IndexError, e:
         logging.error("ERROR unpacking C64 RLE data. Decoded %d bytes, expected %d. Dump follows.\n%s" % (len(data), size, data))
-        raise e
+        raise ScummImageEncoderException("C64 RLE data ended before %d bytes were decoded (%s)." % (size, e))
     return data
@@ -1,16 +1,25 @@
-import os.path
 import struct
-from PIL import Image
-from vga import decodeVgaBitmap
+from output import ImageOutput
+from vga import decodeVgaBitmap, decodeVgaViewport
 from sie.common import ImageCodecBase, HeaderReaderWriterBinary, HeaderReaderWriterXml
 
 class ImageDecoderBase(ImageCodecBase):
-    def decodeImage(self, lflf_path, image_path, palette_num):
+    def __init__(self, config, output=None):
+        super(ImageDecoderBase, self).__init__(config)
+        # How decoded images are saved - see sie.decoder.output.
+        self.output = output if output is not None else ImageOutput()
+
+    def decodeImage(self, lflf_path, image_path, palette_num, jobs=None):
+        bmp_data, pal_data = self.decodeBitmap(lflf_path, palette_num, jobs)
+        self.saveImage(image_path, bmp_data.width, bmp_data.height, bmp_data, pal_data)
+
+    def decodeBitmap(self, lflf_path, palette_num, jobs=None):
+        """ Decodes the background image, without saving it.
+        Returns the bitmap (a Bitmap of palette indexes), and the palette (a sequence of R, G, B values)."""
         width, height = self.readDimensions(lflf_path)
         pal_data = self.readPalette(lflf_path, palette_num)
         bitmap_path = self.getExistingBitmapPath(lflf_path)
-        bmp_data = self.readBitmap(lflf_path, bitmap_path, width, height, pal_data)
-        self.saveImage(image_path, width, height, bmp_data, pal_data)
+        return self.readBitmap(lflf_path, bitmap_path, width, height, pal_data, jobs), pal_data
 
     def readDimensions(self, lflf_path):
         header_path = self.getExistingHeaderPath(lflf_path)
@@ -33,33 +42,30 @@ class ImageDecoderBase(ImageCodecBase):
             palf.close()
         return pal
 
-    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data):
+    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data, jobs=None):
         return None
 
     def saveImage(self, image_path, width, height, bmp_data, pal_data):
-        print "Saving output image file to %s..." % image_path
-        # Create our new image!
-        im = Image.new('P', (width, height) )
-        im.putpalette(pal_data)
-        im.putdata(bmp_data)
-        if os.path.splitext(image_path)[1].lower() != '.png':
-            image_path += '.png'
-        im.save(image_path, 'png') # always saves to PNG files.
+        self.output.saveImage(image_path, width, height, bmp_data, pal_data)
     
     def saveBWImage(self, image_path, width, height, bmp_data):
-        print "Saving output image file to %s..." % image_path
-        # Create our new image!
-        im = Image.new('1', (width, height) )
-        im.putdata(bmp_data)
-        if os.path.splitext(image_path)[1].lower() != '.png':
-            image_path += '.png'
-        im.save(image_path, 'png') # always saves to PNG files.
+        self.output.saveBWImage(image_path, width, height, bmp_data)
 
 class ImageDecoderVgaBase(ImageDecoderBase):
-    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data):
+    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data, jobs=None):
         # Load pixelmap data
         smap = file(bitmap_path, 'rb')
         try:
-            return decodeVgaBitmap(smap, width, height)
+            return decodeVgaBitmap(smap, width, height, jobs)
+        finally:
+            smap.close()
+
+    def readBitmapViewport(self, lflf_path, x, view_width):
+        """ Decodes only the strips needed to show the image from x to x + view_width.
+        Returns the bitmap (view_width pixels wide), and its height."""
+        width, height = self.readDimensions(lflf_path)
+        smap = file(self.getExistingBitmapPath(lflf_path), 'rb')
+        try:
+            return decodeVgaViewport(smap, width, height, x, view_width), height
         finally:
             smap.close()
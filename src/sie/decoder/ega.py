@@ -1,153 +1,146 @@
 import logging
 import os
 import struct
-from sie.sie_util import initBitmapData
+import numpy as np
+from sie.sie_util import initBitmapData, PackedBitmap, readSmapData, ScummImageEncoderException
+from sie.trace import isTraceEnabled, trace
 
 # For v2. RLE, column-based.
-def decodeV2Bitmap(smap, width, height):
-    run = 1
+def decodeV2Columns(data, pos, width, height, img, bleed_table, tracing):
+    """ Decodes the image data starting at data[pos] into img, filling a whole run at a time.
+    Pixels in bleeding runs keep the colour from the same row of the column to their left,
+    which is what's left in bleed_table.
+    Returns the position after the image data."""
+    remaining = 0 # pixels left in the current run, which can carry on into the next column
     colour = 0
-    data = 0
     bleed = False # keep a track of horizontal bleeding
-    bleed_table = [0] * 128 # (same value as the height of backgrounds...)
-    bleed_table_i = 0
-    img = initBitmapData(width, height)
     for x in xrange(width):
-        logging.debug("column: %d" % x)
-        logging.debug("smap tell: %d" % smap.tell())
-        logging.debug("Bleed table: %s" % bleed_table)
-        bleed_table_i = 0
-        for y in xrange(height):
-            run -= 1
-            if run == 0:
-                data, = struct.unpack('B', smap.read(1))
-                if data & 0x80:
-                    run = data & 0x7F
+        if tracing:
+            trace("column", column=x, offset=pos, bleed_table=bleed_table.tolist())
+        y = 0
+        while y < height:
+            if remaining == 0:
+                code = data[pos]
+                pos += 1
+                if code & 0x80:
+                    remaining = code & 0x7F
                     bleed = True
                 else:
-                    run = data >> 4
+                    remaining = code >> 4
                     bleed = False
-                if run == 0:
-                    run, = struct.unpack('B', smap.read(1))
-                colour = data & 0x0F
-                logging.debug("data1: %d. run: %d. bleed: %s. colour: %d" % (data, run, bleed, colour))
+                if remaining == 0:
+                    remaining = data[pos]
+                    pos += 1
+                colour = code & 0x0F
+                if tracing:
+                    trace("run", data=code, run=remaining, bleed=bleed, colour=colour)
+                if remaining == 0:
+                    # Never counts down to the next run.
+                    remaining = width * height
+            n = min(remaining, height - y)
             if not bleed:
-                bleed_table[bleed_table_i] = colour
-            img[y * width + x] = bleed_table[bleed_table_i]
-            bleed_table_i += 1
-        logging.debug("---")
+                bleed_table[y:y + n] = colour
+            y += n
+            remaining -= n
+        img.getColumn(x)[:] = bleed_table[:height]
+    return pos
+
+def decodeV2Bitmap(smap, width, height):
+    """ smap can be a file, or the image data (a string, buffer or bytearray)."""
+    data = readSmapData(smap)
+    bleed_table = np.zeros(height, np.uint8)
+    img = initBitmapData(width, height)
+    try:
+        decodeV2Columns(data, 0, width, height, img, bleed_table, isTraceEnabled())
+    except IndexError:
+        raise ScummImageEncoderException("Image data ended before the image was completed.")
     return img
     
 def decodeV2Mask(smap, width, height):
-    smap.seek(0, os.SEEK_END)
-    file_size = smap.tell()
-    smap.seek(0, os.SEEK_SET)
-    logging.debug("mask file total size in bytes: %d" % file_size)
-    
-    bleed = False
-    small_width = width >> 3
-    mask = initBitmapData(width, height)
-    x = y = 0
-    run = 1
-    try:
-        for x in xrange(small_width):
-            for y in xrange(height):
-                run -= 1
-                if run == 0:
-                    colour, = struct.unpack('B', smap.read(1))
-                    if colour & 0x80:
-                        run = colour & 0x7F
-                        bleed = True
-                    else:
-                        run = colour;
-                        bleed = False
-                    if run == 0:
-                        run, = struct.unpack('B', smap.read(1))
-                    if bleed:
-                        colour, = struct.unpack('B', smap.read(1))
-                if not bleed:
-                    colour, = struct.unpack('B', smap.read(1))
-                setMaskBitmapData(mask, y ,x, width, colour)   
-    except:
+    data = readSmapData(smap)
+    logging.debug("mask file total size in bytes: %d", len(data))
+    mask, complete = decodeMaskColumns(data, 0, width, height)
+    if not complete:
         #FIXME OI masks finished by 0x82 are 1 byte too short. Why?
         logging.debug("mask ended before expected")
     return mask
     
 def decodeV2ObjectBitmap(smap, width, height):
-    smap.seek(0, os.SEEK_END)
-    file_size = smap.tell()
     smap.seek(0, os.SEEK_SET)
-    logging.debug("object file total size in bytes: %d" % file_size)
+    data = bytearray(smap.read())
+    file_size = len(data)
+    logging.debug("object file total size in bytes: %d", file_size)
     
-    run = 1
-    colour = 0
-    bleed = False # keep a track of horizontal bleeding
-    bleed_table = [0] * height # (same value as the height of backgrounds...)
-    bleed_table_i = 0
+    bleed_table = np.zeros(height, np.uint8)
     img = initBitmapData(width, height)
-    for x in xrange(width):
-        logging.debug("column: %d" % x)
-        logging.debug("smap tell: %d" % smap.tell())
-        logging.debug("Bleed table: %s" % bleed_table)
-        bleed_table_i = 0
-        for y in xrange(height):
-            run -= 1
-            if run == 0:
-                colour, = struct.unpack('B', smap.read(1))
-                if colour & 0x80:
-                    run = colour & 0x7F
-                    bleed = True
-                else:
-                    run = colour >> 4
-                    bleed = False
-                if run == 0:
-                    run, = struct.unpack('B', smap.read(1))
-                colour = colour & 0x0F
-                logging.debug("data1: %d. run: %d. bleed: %s. colour: %d" % (colour, run, bleed, colour))
-            if not bleed:
-                bleed_table[bleed_table_i] = colour
-            img[y * width + x] = bleed_table[bleed_table_i]
-            bleed_table_i += 1
-        logging.debug("---")
+    try:
+        pos = decodeV2Columns(data, 0, width, height, img, bleed_table, isTraceEnabled())
+    except IndexError:
+        raise ScummImageEncoderException("Object image data ended before the image was completed.")
         
     #obtaining mask
-    remaining_size = file_size - smap.tell() 
-    logging.debug("object mask size in bytes: %d" % remaining_size)
-    bleed = False
-    small_width = width >> 3
-    mask = initBitmapData(width, height)
-    x = y = 0
-    run = 1
-    try:
-        for x in xrange(small_width):
-            for y in xrange(height):
-                run -= 1
-                if run == 0:
-                    colour, = struct.unpack('B', smap.read(1))
-                    if colour & 0x80:
-                        run = colour & 0x7F
-                        bleed = True
-                    else:
-                        run = colour;
-                        bleed = False
-                    if run == 0:
-                        run, = struct.unpack('B', smap.read(1))
-                    if bleed:
-                        colour, = struct.unpack('B', smap.read(1))
-                if not bleed:
-                    colour, = struct.unpack('B', smap.read(1))
-                setMaskBitmapData(mask, y ,x, width, colour)   
-    except:
+    logging.debug("object mask size in bytes: %d", file_size - pos)
+    mask, complete = decodeMaskColumns(data, pos, width, height)
+    if not complete:
         #FIXME OI masks finished by 0x82 are 1 byte too short. Why?
         print("WARNING: mask ended before expected")
         logging.warning("mask ended before expected")
     return img, mask
     
-def setMaskBitmapData(mask, y, x, width, colour):
-    for i in xrange(8):
-        bit = ((colour << i) & 0x80) >> 7
-        mask[y * width + x*8+i] = bit
-    
+def decodeMaskColumns(data, pos, width, height, check_chunk_end=False):
+    """ Reads the RLE mask data starting at data[pos]: a byte of 8 pixels for each row of each column of bytes,
+    down each column in turn. A run either repeats one byte, or gives a byte for each row.
+    The bytes are collected first, then packed into the mask's rows in one go.
+    check_chunk_end: for v3, where a run of 2 repeated bytes that ends a column (0x82)
+                     can be missing the byte to repeat. The 0x82 gets repeated instead.
+    Returns the mask (a PackedBitmap), and False if the data ended before the mask was complete."""
+    num_bytes = width / 8 * height
+    mask_bytes = []
+    end_chunk = False
+    end_chunk_count = 0
+    complete = True
+    try:
+        while len(mask_bytes) < num_bytes:
+            code = data[pos]
+            pos += 1
+            if code & 0x80:
+                run = code & 0x7F
+            else:
+                run = code
+            if run == 0:
+                run = data[pos]
+                pos += 1
+            if code & 0x80:
+                colour = code
+                if check_chunk_end:
+                    end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, run)
+                if check_chunk_end and end_chunk and code == 0x82:
+                    print("WARNING: mask is missing a byte at chunk end")
+                    logging.warning("mask is missing a byte at chunk end")
+                else:
+                    colour = data[pos]
+                    pos += 1
+                # A run of 0 never counts down to the next run.
+                mask_bytes.extend([colour] * (run or num_bytes))
+            else:
+                run = run or num_bytes
+                if check_chunk_end:
+                    for _ in xrange(min(run, num_bytes - len(mask_bytes))):
+                        end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, 1)
+                mask_bytes.extend(data[pos:pos + run])
+                pos += run
+                if pos > len(data):
+                    complete = False
+                    break
+    except IndexError:
+        complete = False
+    del mask_bytes[num_bytes:]
+    columns = np.zeros(num_bytes, np.uint8)
+    columns[:len(mask_bytes)] = mask_bytes
+    mask = PackedBitmap(width, height)
+    mask.rows[:] = columns.reshape(width / 8, height).T
+    return mask, complete
+
 def readObjectDimensions(config, header_object_path):
     objCodeFile = file(header_object_path, 'rb')
     objCodeFile.seek(config.header_object_index_map["width"], os.SEEK_SET)
@@ -157,229 +150,119 @@ def readObjectDimensions(config, header_object_path):
     objCodeFile.close()
     return width, height
     
-def decodeV3Bitmap(smap, width, height):
-    smap.seek(0, os.SEEK_END)
-    file_size = smap.tell()
-    smap.seek(0, os.SEEK_SET)
-    logging.debug("object file total size in bytes: %d" % file_size)
-    
-    mask_start = 0
-    image_start = 0
-    mask_start, = struct.unpack('H', smap.read(2))
-    image_start, = struct.unpack('H', smap.read(2))
-    
-    smap.seek(image_start, os.SEEK_SET)
-    
-    run = 1
-    inv_run = 1
+def decodeV3Columns(data, pos, width, height, img, bleed_table, tracing):
+    """ Like decodeV2Columns, with an extra type of run that alternates between two colours.
+    Returns the position after the image data, or None if the data ends before the image is complete."""
+    remaining = 0
     colour = 0
     bleed = False # keep a track of horizontal bleeding
-    bleed_table = [0] * height # (same value as the height of backgrounds...)
-    bleed_table_i = 0
     alternative = False # keep a track of the vertical color pair aternation
-    alternative_table = [0] * height # (same value as the height of backgrounds...)
-    alternative_table_i = 0
-    colour_alt= 0
-    img = initBitmapData(width, height)
+    colour_alt = 0
+    drawn = 0 # pixels of the current run drawn so far, to know which colour an alternating run is up to
+    data_size = len(data)
     for x in xrange(width):
-        logging.debug("column: %d" % x)
-        logging.debug("smap tell: %d" % smap.tell())
-        logging.debug("Bleed table: %s" % bleed_table)
-        bleed_table_i = 0
-        for y in xrange(height):
-            run -= 1
-            inv_run += 1
-            if run == 0:
-                if smap.tell() >= file_size:
+        if tracing:
+            trace("column", column=x, offset=pos, bleed_table=bleed_table.tolist())
+        y = 0
+        while y < height:
+            if remaining == 0:
+                if pos >= data_size:
                     print("WARNING: File ended before image is completed.")
                     logging.warning("File ended before image is completed.")
-                    return img;
-                colour, = struct.unpack('B', smap.read(1))
-                if colour & 0xC0 == 0xC0:
-                    run = colour & 0x3F
+                    img.getColumn(x)[:y] = bleed_table[:y]
+                    return None
+                code = data[pos]
+                pos += 1
+                if code & 0xC0 == 0xC0:
+                    remaining = code & 0x3F
                     bleed = False
                     alternative = True
-                    colour, = struct.unpack('B', smap.read(1))
-                    colour_alt = colour >> 4
-                elif colour & 0x80:
-                    run = colour & 0x3F
+                    code = data[pos]
+                    pos += 1
+                    colour_alt = code >> 4
+                elif code & 0x80:
+                    remaining = code & 0x3F
                     bleed = True
                     alternative = False
                 else:
-                    run = colour >> 4
+                    remaining = code >> 4
                     bleed = False
                     alternative = False
-                if run == 0:
-                    run, = struct.unpack('B', smap.read(1))
-                colour = colour & 0x0F
-                inv_run = 1
-                logging.debug("data1: %d. run: %d. bleed: %s. colour: %d" % (colour, run, bleed, colour))
+                if remaining == 0:
+                    remaining = data[pos]
+                    pos += 1
+                colour = code & 0x0F
+                drawn = 0
+                if tracing:
+                    trace("run", run=remaining, bleed=bleed, alternative=alternative, colour=colour, colour_alt=colour_alt)
+                if remaining == 0:
+                    # Never counts down to the next run.
+                    remaining = width * height
+            n = min(remaining, height - y)
             if not bleed:
                 if not alternative:
-                    bleed_table[bleed_table_i] = colour
+                    bleed_table[y:y + n] = colour
+                elif drawn % 2 == 0:
+                    # Starts with the second colour
+                    bleed_table[y:y + n:2] = colour_alt
+                    bleed_table[y + 1:y + n:2] = colour
                 else:
-                    bleed_table[bleed_table_i] = colour if inv_run % 2 == 0 else colour_alt
-            img[y * width + x] = bleed_table[bleed_table_i]
-            bleed_table_i += 1
-        logging.debug("---")
+                    bleed_table[y:y + n:2] = colour
+                    bleed_table[y + 1:y + n:2] = colour_alt
+            y += n
+            remaining -= n
+            drawn += n
+        img.getColumn(x)[:] = bleed_table[:height]
+    return pos
+
+def decodeV3Bitmap(smap, width, height):
+    """ smap can be a file, or the image data (a string, buffer or bytearray)."""
+    data = readSmapData(smap)
+    logging.debug("object file total size in bytes: %d", len(data))
+    
+    mask_start, image_start = struct.unpack_from('2H', data)
+    
+    bleed_table = np.zeros(height, np.uint8)
+    img = initBitmapData(width, height)
+    try:
+        decodeV3Columns(data, image_start, width, height, img, bleed_table, isTraceEnabled())
+    except IndexError:
+        raise ScummImageEncoderException("Image data ended before the image was completed.")
     return img
     
 def decodeV3Mask(smap, width, height):
-    smap.seek(0, os.SEEK_END)
-    file_size = smap.tell()
-    smap.seek(0, os.SEEK_SET)
-    logging.debug("mask file total size in bytes: %d" % file_size)
+    data = readSmapData(smap)
+    logging.debug("mask file total size in bytes: %d", len(data))
     
-    mask_start = 0
-    mask_start, = struct.unpack('H', smap.read(2))
+    mask_start, = struct.unpack_from('H', data)
     
-    smap.seek(mask_start, os.SEEK_SET)
-    
-    bleed = False
-    small_width = width >> 3
-    mask = initBitmapData(width, height)
-    x = y = 0
-    run = 1
-    end_chunk_count = 0
-    end_chunk = False
-    
-    try:
-        for x in xrange(small_width):
-            for y in xrange(height):
-                run -= 1
-                if run == 0:
-                    colour, = struct.unpack('B', smap.read(1))
-                    if colour & 0x80:
-                        run = colour & 0x7F
-                        bleed = True
-                    else:
-                        run = colour;
-                        bleed = False
-                    if run == 0:
-                        run, = struct.unpack('B', smap.read(1))
-                    if bleed:
-                        end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, run)
-                        if end_chunk and colour == 0x82:
-                            print("WARNING: mask is missing a byte at chunk end")
-                            logging.warning("mask is missing a byte at chunk end")
-                        else:
-                            colour, = struct.unpack('B', smap.read(1))
-                    
-                if not bleed:
-                    end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, 1)
-                    colour, = struct.unpack('B', smap.read(1))
-                setMaskBitmapData(mask, y ,x, width, colour)   
-    except:
+    mask, complete = decodeMaskColumns(data, mask_start, width, height, True)
+    if not complete:
         #FIXME OI masks finished by 0x82 are 1 byte too short. Why?
         print("WARNING: mask ended before expected")
         logging.warning("mask ended before expected")
     return mask
     
 def decodeV3ObjectBitmap(smap, width, height):
-    smap.seek(0, os.SEEK_END)
-    file_size = smap.tell()
     smap.seek(0, os.SEEK_SET)
-    logging.debug("object file total size in bytes: %d" % file_size)
-    
-    mask_start = 0
-    image_start = 0
-    mask_start, = struct.unpack('H', smap.read(2))
-    image_start, = struct.unpack('H', smap.read(2))
+    data = bytearray(smap.read())
+    logging.debug("object file total size in bytes: %d", len(data))
     
-    smap.seek(image_start, os.SEEK_SET)
+    mask_start, image_start = struct.unpack_from('2H', data)
     
-    run = 1
-    inv_run = 1
-    colour = 0
-    bleed = False # keep a track of horizontal bleeding
-    bleed_table = [0] * height # (same value as the height of backgrounds...)
-    bleed_table_i = 0
-    alternative = False # keep a track of the vertical color pair aternation
-    alternative_table = [0] * height # (same value as the height of backgrounds...)
-    alternative_table_i = 0
-    colour_alt= 0
+    bleed_table = np.zeros(height, np.uint8)
     img = initBitmapData(width, height)
-    for x in xrange(width):
-        logging.debug("column: %d" % x)
-        logging.debug("smap tell: %d" % smap.tell())
-        logging.debug("Bleed table: %s" % bleed_table)
-        bleed_table_i = 0
-        for y in xrange(height):
-            run -= 1
-            inv_run += 1
-            if run == 0:
-                colour, = struct.unpack('B', smap.read(1))
-                if colour & 0xC0 == 0xC0:
-                    run = colour & 0x3F
-                    bleed = False
-                    alternative = True
-                    colour, = struct.unpack('B', smap.read(1))
-                    colour_alt = colour >> 4
-                elif colour & 0x80:
-                    run = colour & 0x3F
-                    bleed = True
-                    alternative = False
-                else:
-                    run = colour >> 4
-                    bleed = False
-                    alternative = False
-                if run == 0:
-                    run, = struct.unpack('B', smap.read(1))
-                colour = colour & 0x0F
-                inv_run = 1
-                logging.debug("data1: %d. run: %d. bleed: %s. colour: %d" % (colour, run, bleed, colour))
-            if not bleed:
-                if not alternative:
-                    bleed_table[bleed_table_i] = colour
-                else:
-                    bleed_table[bleed_table_i] = colour if inv_run % 2 == 0 else colour_alt
-            img[y * width + x] = bleed_table[bleed_table_i]
-            bleed_table_i += 1
-        logging.debug("---")
+    try:
+        decodeV3Columns(data, image_start, width, height, img, bleed_table, isTraceEnabled())
+    except IndexError:
+        raise ScummImageEncoderException("Object image data ended before the image was completed.")
         
     #obtaining mask
-    #remaining_size = file_size - smap.tell() 
-    #logging.debug("object mask size in bytes: %d" % remaining_size)
     
-    smap.seek(mask_start, os.SEEK_SET)
-    mask_image_start, = struct.unpack('H', smap.read(2))
-    smap.seek(mask_start + mask_image_start, os.SEEK_SET)
+    mask_image_start, = struct.unpack_from('H', data, mask_start)
     
-    bleed = False
-    small_width = width >> 3
-    mask = initBitmapData(width, height)
-    x = y = 0
-    run = 1
-    end_chunk_count = 0
-    end_chunk = False
-    
-    try:
-        for x in xrange(small_width):
-            for y in xrange(height):
-                run -= 1
-                if run == 0:
-                    colour, = struct.unpack('B', smap.read(1))
-                    if colour & 0x80:
-                        run = colour & 0x7F
-                        bleed = True
-                    else:
-                        run = colour;
-                        bleed = False
-                    if run == 0:
-                        run, = struct.unpack('B', smap.read(1))
-                    if bleed:
-                        end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, run)
-                        if end_chunk and colour == 0x82:
-                            print("WARNING: mask is missing a byte at chunk end")
-                            logging.warning("mask is missing a byte at chunk end")
-                        else:
-                            colour, = struct.unpack('B', smap.read(1))
-                    
-                if not bleed:
-                    end_chunk, end_chunk_count = manageChunkCount(end_chunk, end_chunk_count, height, 1)
-                    colour, = struct.unpack('B', smap.read(1))
-                setMaskBitmapData(mask, y ,x, width, colour)   
-    except:
+    mask, complete = decodeMaskColumns(data, mask_start + mask_image_start, width, height, True)
+    if not complete:
         #FIXME OI masks finished by 0x82 are 1 byte too short. Why?
         print("WARNING: mask ended before expected")
         logging.warning("mask ended before expected")
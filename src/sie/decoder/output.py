@@ -0,0 +1,81 @@
+import os.path
+import numpy as np
+from PIL import Image
+from sie.sie_util import ScummImageEncoderException
+
+PNG = "png"
+RAW = "raw" # .bin file of palette indexes, plus a .pal file of R, G, B values
+NPY = "npy" # NumPy array of palette indexes, shaped (height, width)
+MEMORY = "memory" # keep the bitmaps in memory instead of writing files
+OUTPUT_FORMATS = [PNG, RAW, NPY, MEMORY]
+
+class ImageOutput(object):
+    """ Saves decoded images in one of the output formats.
+    png_compress_level: zlib level (0 - 9) for PNG files, or None for PIL's default."""
+    def __init__(self, output_format=PNG, png_compress_level=None):
+        if output_format not in OUTPUT_FORMATS:
+            raise ScummImageEncoderException("Unknown output format: %s" % output_format)
+        if png_compress_level is not None and not 0 <= png_compress_level <= 9:
+            raise ScummImageEncoderException("PNG compression level must be between 0 and 9: %s" % png_compress_level)
+        self.output_format = output_format
+        self.png_compress_level = png_compress_level
+        # For MEMORY, maps each image path to its bitmap and palette (None for masks).
+        self.images = {}
+
+    def getBasePath(self, image_path):
+        """ The image path, without a .png extension."""
+        base_path, ext = os.path.splitext(image_path)
+        if ext.lower() != '.png':
+            return image_path
+        return base_path
+
+    def saveImage(self, image_path, width, height, bmp_data, pal_data):
+        if self.output_format == MEMORY:
+            self.images[image_path] = (bmp_data, pal_data)
+            return
+        print "Saving output image file to %s..." % image_path
+        base_path = self.getBasePath(image_path)
+        if self.output_format == PNG:
+            # Create our new image!
+            im = Image.frombuffer('P', (width, height), bmp_data.data, 'raw', 'P', 0, 1)
+            im.putpalette(pal_data)
+            self.savePng(base_path, im)
+        elif self.output_format == RAW:
+            self.saveRaw(base_path, bmp_data)
+            palf = file(base_path + '.pal', 'wb')
+            try:
+                palf.write(np.array(pal_data, np.uint8).tostring())
+            finally:
+                palf.close()
+        elif self.output_format == NPY:
+            np.save(base_path + '.npy', bmp_data.rows)
+
+    def saveBWImage(self, image_path, width, height, bmp_data):
+        """ bmp_data is a PackedBitmap. PNG files are written straight from it;
+        the other formats get one byte per pixel, 0 for black and 1 for white."""
+        if self.output_format == MEMORY:
+            self.images[image_path] = (bmp_data.unpack(), None)
+            return
+        print "Saving output image file to %s..." % image_path
+        base_path = self.getBasePath(image_path)
+        if self.output_format == PNG:
+            # 8 pixels per byte, like PIL's 1 bit images.
+            im = Image.frombuffer('1', (width, height), bmp_data.data, 'raw', '1', 0, 1)
+            self.savePng(base_path, im)
+        elif self.output_format == RAW:
+            self.saveRaw(base_path, bmp_data.unpack())
+        elif self.output_format == NPY:
+            np.save(base_path + '.npy', bmp_data.unpack().rows)
+
+    def savePng(self, base_path, im):
+        if self.png_compress_level is None:
+            im.save(base_path + '.png', 'png')
+        else:
+            im.save(base_path + '.png', 'png', compress_level=self.png_compress_level, optimize=False)
+
+    def saveRaw(self, base_path, bmp_data):
+        binf = file(base_path + '.bin', 'wb')
+        try:
+            binf.write(bmp_data.tostring())
+        finally:
+            binf.close()
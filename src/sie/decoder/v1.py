@@ -13,20 +13,31 @@ tableV1Palette = [
 
 
 class DecoderV1(common.ImageDecoderBase):
-    def decodeImage(self, lflf_path, image_path, palette_num):
+    def decodeImage(self, lflf_path, image_path, palette_num, jobs=None):
         """ V1 background images share "character map" data with the objects, so decode all objects as well."""
         width, height = self.readDimensions(lflf_path)
         pal_data = self.readPalette(lflf_path, palette_num)
         bitmap_path = self.getExistingBitmapPath(lflf_path)
-        bmp_data, mask_data = self.readBitmap(lflf_path, bitmap_path, width, height, pal_data)
+        # Colours and character maps are read once for the background and all objects.
+        resources = c64.RoomResources(lflf_path)
+        bmp_data, mask_data = self.readBitmap(lflf_path, bitmap_path, width, height, pal_data, resources)
         self.saveImage(image_path, width, height, bmp_data, pal_data)
         # Save the mask as well
         ip, ipext = os.path.splitext(image_path)
         self.saveImage(ip + ".mask" + ipext, width, height, mask_data, pal_data)
         # Decode all object images
-        self.decodeObjectImages(lflf_path, bitmap_path, image_path, pal_data)
+        self.decodeObjectImages(lflf_path, bitmap_path, image_path, pal_data, resources)
+
+    def decodeBitmap(self, lflf_path, palette_num, jobs=None):
+        width, height = self.readDimensions(lflf_path)
+        pal_data = self.readPalette(lflf_path, palette_num)
+        bitmap_path = self.getExistingBitmapPath(lflf_path)
+        bmp_data, mask_data = self.readBitmap(lflf_path, bitmap_path, width, height, pal_data)
+        return bmp_data, pal_data
 
-    def decodeObjectImages(self, lflf_path, bitmap_path, image_path, pal_data):
+    def decodeObjectImages(self, lflf_path, bitmap_path, image_path, pal_data, resources=None):
+        if resources is None:
+            resources = c64.RoomResources(lflf_path)
         objNumStrs = [f[-4:] for f in os.listdir(bitmap_path) if f.startswith("OIv1_")]
         ip, ipext = os.path.splitext(image_path)
         for objNum in objNumStrs:
@@ -34,7 +45,7 @@ class DecoderV1(common.ImageDecoderBase):
             #try:
             width, height = c64.readObjectDimensions(lflf_path, objNum)
             logging.debug("object - width, height: %d, %d" % (width, height))
-            bmp_data, mask_data = c64.decodeV1Object(lflf_path, width, height, objNum)
+            bmp_data, mask_data = c64.decodeV1Object(lflf_path, width, height, objNum, resources)
             obj_image_path = "%s-OIv1_%s%s" % (ip, objNum, ipext)
             self.saveImage(obj_image_path, width, height, bmp_data, pal_data)
             obj_mask_path = "%s-OIv1_%s.mask%s" % (ip, objNum, ipext)
@@ -46,8 +57,8 @@ class DecoderV1(common.ImageDecoderBase):
     def readPalette(self, lflf_path, palette_num):
         return tableV1Palette
 
-    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data):
-        img_data = c64.decodeV1Bitmap(lflf_path, width, height)
+    def readBitmap(self, lflf_path, bitmap_path, width, height, pal_data, resources=None):
+        img_data = c64.decodeV1Bitmap(lflf_path, width, height, resources)
         return img_data
 
     def readDimensions(self, lflf_path):
@@ -12,6 +12,8 @@ tableEGAPalette = [
 
 class DecoderV2(common.ImageDecoderBase):
     def fixPalette(self):
+        if len(tableEGAPalette) >= 256 * 3:
+            return # already extended by an earlier decode
         initial_length = len(tableEGAPalette) / 3
         num_elements = 3 * (256 - initial_length)
         extraEGAPallete = [0x00] * num_elements
@@ -24,7 +26,7 @@ class DecoderV2(common.ImageDecoderBase):
             count += 1
         tableEGAPalette.extend(extraEGAPallete)
 
-    def decodeImage(self, lflf_path, image_path, palette_num):
+    def decodeImage(self, lflf_path, image_path, palette_num, jobs=None):
         """ V2 background images share "character map" data with the objects, so decode all objects as well."""
         width, height = self.readDimensions(lflf_path)
         self.fixPalette()
@@ -43,6 +45,13 @@ class DecoderV2(common.ImageDecoderBase):
         # Decode all object images
         self.decodeObjectImages(lflf_path, bitmap_path, image_path, pal_data)
 
+    def decodeBitmap(self, lflf_path, palette_num, jobs=None):
+        width, height = self.readDimensions(lflf_path)
+        self.fixPalette()
+        pal_data = self.readPalette(palette_num)
+        bitmap_path = self.getExistingBitmapPath(lflf_path)
+        return self.readBitmap(bitmap_path, width, height, pal_data), pal_data
+
     def decodeObjectImages(self, lflf_path, bitmap_path, image_path, pal_data):
         objNumStrs = [f[-4:] for f in os.listdir(os.path.join(lflf_path, self.config.object_path[0])) if f.startswith(self.config.object_path[1])]
         ip, ipext = os.path.splitext(image_path)
@@ -1,4 +1,7 @@
-from sie.sie_util import arrayToInt, getByte, byteToBits, getDWord, getDWordLE, initBitmapData, ScummImageEncoderException
+import multiprocessing
+import struct
+import numpy as np
+from sie.sie_util import initBitmapData, readSmapData, ScummImageEncoderException
 
 HORIZONTAL = 0
 VERTICAL = 1
@@ -20,376 +23,370 @@ DECPAL3 = 7
 
 
 
+# Opcode tables, indexed by the next bits of the stream. The first bit read is
+#  the lowest bit of the index. Each entry is (opcode, number of bits used).
+METHOD_ONE_OPCODE_BITS = 3
+METHOD_ONE_OPCODES = []
+for i in xrange(1 << METHOD_ONE_OPCODE_BITS):
+    if not i & 1:
+        METHOD_ONE_OPCODES.append((DRAWPIX, 1))
+    elif not i & 2:
+        METHOD_ONE_OPCODES.append((READPAL, 2))
+    elif not i & 4:
+        METHOD_ONE_OPCODES.append((SUBVAR, 3))
+    else:
+        METHOD_ONE_OPCODES.append((NEGVAR, 3))
+
+# Method two entries also hold the change to the palette index for READVAL codes.
+METHOD_TWO_OPCODE_BITS = 5
+METHOD_TWO_OPCODES = []
+for i in xrange(1 << METHOD_TWO_OPCODE_BITS):
+    if not i & 1:
+        METHOD_TWO_OPCODES.append((DRAWPIX, 1, 0))
+    elif not i & 2:
+        METHOD_TWO_OPCODES.append((READPAL, 2, 0))
+    elif i >> 2 == READ8BITS:
+        METHOD_TWO_OPCODES.append((READ8BITS, 5, 0))
+    else:
+        # Serge's doc seems to have decrement and increments
+        # mixed up - hence contradictary names (INCPAL4 subtracts 4, etc.)
+        METHOD_TWO_OPCODES.append((READVAL, 5, (i >> 2) - 4))
+del i
+
+BIT_MASKS = [(1 << n) - 1 for n in xrange(33)]
+
+# The compressed decoders read the strip through a bit accumulator: whole bytes are
+#  added above the bits already buffered, and since SCUMM reads each byte starting
+#  from the least significant bit, the next bit in the stream is always the lowest
+#  bit of the accumulator. Codes are then decoded by looking up their first few bits
+#  in the tables above, and palette indexes by masking off paramSub bits.
+
+def putStripPixels(img, stripNum, height, pixels, rendDir):
+    """ Copies a strip's pixels into the bitmap. pixels is a buffer holding them
+    in the order they are drawn."""
+    pixels = np.frombuffer(pixels, np.uint8)
+    if rendDir == HORIZONTAL:
+        img.getStrip(stripNum)[:] = pixels.reshape(height, 8)
+    else:
+        img.getStrip(stripNum)[:] = pixels.reshape(8, height).T
+
 # Works in custom-made image
-def doUncompressed(smap, img, width, height, limit, stripNum):
+def doUncompressed(data, pos, img, width, height, limit, stripNum):
     ##print "In uncompressed"
-    xCounter = 0
-    yCounter = 0
+    count = min(height * 8, max(limit - pos, 0))
+    numRows = count / 8
+    strip = img.getStrip(stripNum)
+    # Copy all the complete rows in one go
+    if numRows:
+        strip[:numRows] = np.frombuffer(data, np.uint8, numRows * 8, pos).reshape(numRows, 8)
+    # The strip may end part way through a row
+    if count % 8:
+        strip[numRows, :count % 8] = np.frombuffer(data, np.uint8, count % 8, pos + numRows * 8)
 
-    while smap.tell() < limit:
-        currPalIndex = arrayToInt(getByte(smap,0))
-        img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-        xCounter += 1
-        if xCounter >= 8:
-            xCounter = 0
-            yCounter += 1
-            # This bit makes sure we don't go past the image's boundaries
-            # (which can happen because a byte requires 8 bits but the
-            # image may not need all those bits)
-            if yCounter >= height:
-                break
-
-def doMethodOne(smap, img, width, height, limit, stripNum, paramSub, rendDir):
+def doMethodOne(data, pos, img, width, height, limit, stripNum, paramSub, rendDir):
     ##print "In method one"
-    xCounter = 0
-    yCounter = 0
-    bitAcc = 0 # Bit accumulator
-    contReadingPal = False
-    readCount = 0
+    numPixels = height * 8
+    pixels = bytearray(numPixels)
     iSubVar = 1
 
     # Get first (top-left) colour/palette index
-    currPalIndex = arrayToInt(getByte(smap, 0))
-    ##print "initial pal index is " + str(currPalIndex)
-    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-    # Move to next pixel
-    if rendDir == HORIZONTAL:
-        xCounter += 1
-    else:
-        ##print "In VERTICAL style"
-        yCounter += 1
-    ##print "put first pixel"
+    currPalIndex = data[pos]
+    pixels[0] = currPalIndex
+    pos += 1
 
+    opcodes = METHOD_ONE_OPCODES
+    palMask = BIT_MASKS[paramSub]
+    maxCodeLength = 2 + paramSub
+    bitAcc = 0 # Bit accumulator
+    numBits = 0
+    for i in xrange(1, numPixels):
+        while numBits < maxCodeLength and pos < limit:
+            bitAcc |= data[pos] << numBits
+            pos += 1
+            numBits += 8
+        opcode, length = opcodes[bitAcc & 0x7]
+        if opcode == READPAL:
+            length += paramSub
+            # Stop if the strip ends in the middle of a code
+            if length > numBits:
+                break
+            currPalIndex = (bitAcc >> 2) & palMask
+            iSubVar = 1
+        elif length > numBits:
+            break
+        elif opcode == SUBVAR:
+            currPalIndex -= iSubVar
+        elif opcode == NEGVAR:
+            iSubVar = -iSubVar
+            currPalIndex -= iSubVar
+        bitAcc >>= length
+        numBits -= length
+        pixels[i] = currPalIndex
+    putStripPixels(img, stripNum, height, pixels, rendDir)
 
-    while smap.tell() < limit and \
-    ((rendDir == HORIZONTAL and yCounter < height) or
-     (rendDir == VERTICAL and xCounter < 8)):
-        thisByte = byteToBits(getByte(smap, 0), LE=1)
+def doMethodTwo(data, pos, img, width, height, limit, stripNum, paramSub):
+    ##print "In method two"
+    numPixels = height * 8
+    pixels = bytearray(numPixels)
 
-        # For each bit
-        for b in thisByte:
-            # Reading a palette index
-            if contReadingPal:
-                bitAcc += (b << readCount) # compensates for reading it in reverse
-                readCount += 1
-                # Finished reading palette index number
-                if readCount == paramSub:
-                    currPalIndex = bitAcc
-                    ##print "Read new palette index, now " + str(currPalIndex)
-                    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                    iSubVar = 1 # set subvar
-                    # Move to next pixel
-                    if rendDir == HORIZONTAL:
-                        xCounter += 1
-                        if xCounter >= 8:
-                            xCounter = 0
-                            yCounter += 1
-                            if yCounter >= height:
-                                break
-                    else:
-                        yCounter += 1
-                        if yCounter >= height:
-                            yCounter = 0
-                            xCounter += 1
-                            if xCounter >= 8:
-                                break
-                    ##print "put pixel"
-                    contReadingPal = False
-                    readCount = 0
-                    bitAcc = 0
+    # Get first (top-left) colour/palette index
+    currPalIndex = data[pos]
+    pixels[0] = currPalIndex
+    pos += 1
 
-            elif b == 1:
-                bitAcc = bitAcc << 1
-                bitAcc += 1
-                if bitAcc == NEGVAR:
-                    iSubVar = ~iSubVar + 1 # convert -1 to 1 and vice versa
-                    currPalIndex -= iSubVar
-                    bitAcc = 0
-                    # Place pixel
-                    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                    # Move to next pixel
-                    if rendDir == HORIZONTAL:
-                        xCounter += 1
-                        if xCounter >= 8:
-                            xCounter = 0
-                            yCounter += 1
-                            if yCounter >= height:
-                                break
-                    else:
-                        yCounter += 1
-                        if yCounter >= height:
-                            yCounter = 0
-                            xCounter += 1
-                            if xCounter >= 8:
-                                break
+    opcodes = METHOD_TWO_OPCODES
+    palMask = BIT_MASKS[paramSub]
+    maxCodeLength = max(5 + 8, 2 + paramSub)
+    bitAcc = 0 # Bit accumulator
+    numBits = 0
+    i = 1
+    while i < numPixels:
+        while numBits < maxCodeLength and pos < limit:
+            bitAcc |= data[pos] << numBits
+            pos += 1
+            numBits += 8
+        opcode, length, delta = opcodes[bitAcc & 0x1F]
+        if opcode == READPAL:
+            length += paramSub
+            if length > numBits:
+                break
+            currPalIndex = (bitAcc >> 2) & palMask
+        elif opcode == READ8BITS:
+            length += 8
+            if length > numBits:
+                break
+            # Repeat the current colour for the next n pixels
+            numPix = min((bitAcc >> 5) & 0xFF, numPixels - i)
+            bitAcc >>= length
+            numBits -= length
+            if numPix:
+                pixels[i:i + numPix] = bytearray([currPalIndex]) * numPix
+            i += numPix
+            continue
+        # Stop if the strip ends in the middle of a code
+        elif length > numBits:
+            break
+        else:
+            currPalIndex += delta
+        bitAcc >>= length
+        numBits -= length
+        pixels[i] = currPalIndex
+        i += 1
+    putStripPixels(img, stripNum, height, pixels, HORIZONTAL)
 
-            # Place pixel / end (and execute) a command
-            elif b == 0:
-                bitAcc = bitAcc << 1 # Do this so we get proper value for checking READPAL
-                if bitAcc == READPAL:
-                    contReadingPal = True
-                    bitAcc = 0
-                    # Don't place the pixel until we get the new palette index
-                    continue
-                elif bitAcc == SUBVAR:
-                    currPalIndex -= iSubVar
-                    bitAcc = 0
-                # Place pixel
-                img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                # Move to next pixel
-                if rendDir == HORIZONTAL:
-                    xCounter += 1
-                    if xCounter >= 8:
-                        xCounter = 0
-                        yCounter += 1
-                        if yCounter >= height:
-                            break
-                else:
-                    yCounter += 1
-                    if yCounter >= height:
-                        yCounter = 0
-                        xCounter += 1
-                        if xCounter >= 8:
-                            break
-                ##print "put pixel"
+def getStripBounds(data, numStrips, data_size=None):
+    """ Returns the (start, limit) offsets of each strip in an SMAP buffer.
+    The last strip ends at the end of the block.
+    data_size: the size of the whole block, if data only holds its header and offset table."""
+    if data_size is None:
+        data_size = len(data)
+    blocksize = struct.unpack_from('>I', data, 4)[0]
+    stripOffsets = struct.unpack_from('<%dI' % numStrips, data, 8)
+    bounds = []
+    for stripnum, s in enumerate(stripOffsets):
+        if s >= data_size:
+            break # v4, loom CD, room 2
+        if stripnum+1 == len(stripOffsets): # is it the last strip?
+            limit = blocksize
+        else:
+            limit = stripOffsets[stripnum+1]
+        bounds.append((s, min(limit, data_size)))
+    return bounds
 
-def doMethodTwo(smap, img, width, height, limit, stripNum, paramSub):
-    ##print "In method two"
-    xCounter = 0
-    yCounter = 0
-    bitAcc = 0 # Bit accumulator
-    contReadingPal = False
-    contReadingNumPix = False
-    contReadingDecom = False
-    readCount = 0
+def stripSpan(bounds):
+    """ Returns the (start, limit) of the bytes holding some strips (see getStripBounds),
+    and their bounds relative to the start of those bytes."""
+    span_start = min(start for start, limit in bounds)
+    span_limit = max(limit for start, limit in bounds)
+    return span_start, span_limit, [(start - span_start, limit - span_start) for start, limit in bounds]
 
-    # Get first (top-left) colour/palette index
-    currPalIndex = arrayToInt(getByte(smap, 0))
-    ##print "initial pal index is " + str(currPalIndex)
-    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-    # Move to next pixel
-    xCounter += 1
+def readSmapStrips(smap, numStrips, firstStrip, count):
+    """ Reads only the parts of an SMAP block needed to decode some of its strips.
+    If smap is a file (holding just the SMAP block), this reads the offset table, then seeks
+    straight to the strips, so the same file can be used for each call.
+    Returns a buffer, and the bounds of the strips within that buffer (see getStripBounds)."""
+    if not hasattr(smap, 'seek'):
+        data = readSmapData(smap)
+        return data, getStripBounds(data, numStrips)[firstStrip:firstStrip + count]
+    smap.seek(0, 0)
+    header = bytearray(smap.read(8 + numStrips * 4))
+    smap.seek(0, 2)
+    data_size = smap.tell()
+    bounds = getStripBounds(header, numStrips, data_size)[firstStrip:firstStrip + count]
+    if not bounds:
+        return header, bounds
+    span_start, span_limit, span_bounds = stripSpan(bounds)
+    smap.seek(span_start, 0)
+    data = bytearray(smap.read(span_limit - span_start))
+    return data, span_bounds
 
+def decodeStrip(data, start, limit, img, width, height, stripnum):
+    """ Decodes the strip at data[start:limit] into column stripnum of img.
+    Returns True if the strip is transparent."""
+    compID = data[start]
+    # Default variables (based on uncompressed settings)
+    compMethod = 0 # 0 will also stand for uncompressed
+    paramSub = 0
+    trans = False
+    rendDir = HORIZONTAL
 
-    while smap.tell() < limit and yCounter < height:
-        thisByte = byteToBits(getByte(smap, 0), LE=1)
+    ##print compID
+    # Determine compression type
+    if compID == 0x01:
+        # Values are already initialised to uncompressed method settings
+        pass
+    # Method 1 variations
+    elif compID >= 0x0E and compID <= 0x12:
+        paramSub = compID - 0x0A
+        rendDir = VERTICAL
+        compMethod = 1
+    elif compID >= 0x18 and compID <= 0x1C:
+        paramSub = compID - 0x14
+        compMethod = 1
+    elif compID >= 0x22 and compID <= 0x26:
+        paramSub = compID - 0x1E
+        rendDir = VERTICAL
+        trans = True
+        compMethod = 1
+    elif compID >= 0x2C and compID <= 0x30:
+        paramSub = compID - 0x28
+        trans = True
+        compMethod = 1
+    # Method 2 variations
+    elif compID >= 0x40 and compID <= 0x44:
+        paramSub = compID - 0x3C
+        compMethod = 2
+    elif compID >= 0x54 and compID <= 0x58:
+        paramSub = compID - 0x50 # Serge's thing says 0x51
+        trans = True
+        compMethod = 2
+    elif compID >= 0x68 and compID <= 0x6C:
+        paramSub = compID - 0x64
+        trans = True
+        compMethod = 2
+    elif compID >= 0x7C and compID <= 0x80:
+        paramSub = compID - 0x78
+        compMethod = 2
+    else:
+        print "Unknown compression method for strip " + str(compID)
+        raise ScummImageEncoderException("Unknown compression method for strip: %d" % compID)
 
-        # For each bit
-        for b in thisByte:
-            # Reading a palette index
-            if contReadingPal:
-                bitAcc += (b << readCount)
-                readCount += 1
-                # Finished reading palette index number
-                if readCount == paramSub:
-                    currPalIndex = bitAcc
-                    ##print "Read new palette index, now " + str(currPalIndex)
-                    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                    # Move to next pixel
-                    xCounter += 1
-                    if xCounter >= 8:
-                        xCounter = 0
-                        yCounter += 1
-                        if yCounter >= height:
-                                break
-                    ##print "put pixel"
-                    contReadingPal = False
-                    readCount = 0
-                    bitAcc = 0
+    # Try/except is for debugging - will show however much image we've decoded
+    try:
+        if compMethod == 0:
+            #print "Processing uncompresed strip"
+            doUncompressed(data, start + 1, img, width, height, limit, stripnum)
+        elif compMethod == 1:
+            #print "Processing strip with method one"
+            doMethodOne(data, start + 1, img, width, height, limit, stripnum, paramSub, rendDir)
+        elif compMethod == 2:
+            #print "Processing strip with method two"
+            doMethodTwo(data, start + 1, img, width, height, limit, stripnum, paramSub)
+    except Exception, e:
+        print "ERROR: %s" % e
+        #print "An error occured - attempting to show incomplete image."
+        #im = Image.new('P', (width, height) )
+        #im.putpalette(pal)
+        #im.putdata(img)
+        #im.show()
+        #smap.close()
+        raise ScummImageEncoderException(e)
+    return trans
 
-            elif contReadingNumPix:
-                bitAcc += (b << readCount)
-                readCount += 1
-                if readCount == 8:
-                    for i in range(bitAcc):
-                        img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                        xCounter += 1
-                        if xCounter >= 8:
-                            xCounter = 0
-                            yCounter += 1
-                            if yCounter >= height:
-                                break
-                        ##print "put pixel"
-                    contReadingNumPix = False
-                    readCount = 0
-                    bitAcc = 0
+def decodeStripRange(data, bounds, height, numStrips=None):
+    """ Decodes a run of strips (see getStripBounds) into a bitmap just wide enough to hold them,
+    or numStrips wide if some of the strips are missing from the end of bounds.
+    Returns the bitmap, and whether any of the strips are transparent."""
+    if numStrips is None:
+        numStrips = len(bounds)
+    width = numStrips * 8
+    img = initBitmapData(width, height)
+    is_transparent = False
+    for stripnum, (start, limit) in enumerate(bounds):
+        is_transparent = decodeStrip(data, start, limit, img, width, height, stripnum) or is_transparent
+    return img, is_transparent
 
+def decodeStripRangeJob(args):
+    """ Process pool entry point for decodeStripRange. The strips' bytes are passed as a string."""
+    data, bounds, height = args
+    return decodeStripRange(bytearray(data), bounds, height)
 
-            elif contReadingDecom:
-                bitAcc += (b << readCount)
-                ##print bitAcc
-                readCount += 1 # how many bits it has read
-                if readCount == 3:
-                    # Serge's doc seems to have decrement and increments
-                    # mixed up - hence contradictary names
-                    if bitAcc == INCPAL4:
-                        currPalIndex -= 4
-                    elif bitAcc == INCPAL3:
-                        currPalIndex -= 3
-                    elif bitAcc == INCPAL2:
-                        currPalIndex -= 2
-                    elif bitAcc == INCPAL1:
-                        currPalIndex -= 1
-                    elif bitAcc == READ8BITS:
-                        contReadingNumPix = True
-                        bitAcc = 0
-                        readCount = 0
-                        contReadingDecom = False
-                        continue
-                    elif bitAcc == DECPAL1:
-                        currPalIndex += 1
-                    elif bitAcc == DECPAL2:
-                        currPalIndex += 2
-                    elif bitAcc == DECPAL3:
-                        currPalIndex += 3
-                    ##print "new currPalIndex is " + str(currPalIndex)
-                    # Place pixel
-                    img[(stripNum * 8 + xCounter) + (yCounter * width)] = currPalIndex
-                    # Move to next pixel
-                    xCounter += 1
-                    if xCounter >= 8:
-                        xCounter = 0
-                        yCounter += 1
-                        if yCounter >= height:
-                            break
-                    ##print "put pixel"
-                    bitAcc = 0
-                    readCount = 0
-                    contReadingDecom = False
+def decodeStripsParallel(data, bounds, img, width, height, jobs):
+    """ Splits the strips into one contiguous range per job, and decodes them in a process pool.
+    Each job is only sent the bytes of its own strips."""
+    range_size = (len(bounds) + jobs - 1) / jobs
+    firstStrips = range(0, len(bounds), range_size)
+    tasks = []
+    for stripNum in firstStrips:
+        span_start, span_limit, span_bounds = stripSpan(bounds[stripNum:stripNum + range_size])
+        tasks.append((str(data[span_start:span_limit]), span_bounds, height))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(decodeStripRangeJob, tasks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    is_transparent = False
+    for stripNum, (range_img, trans) in zip(firstStrips, results):
+        img.getStrips(stripNum, range_img.width / 8)[:] = range_img.rows
+        is_transparent = is_transparent or trans
+    return is_transparent
 
-            elif b == 1:
-                bitAcc = bitAcc << 1
-                bitAcc += 1
-                if bitAcc == READVAL:
-                    contReadingDecom = True
-                    bitAcc = 0
+def decodeVgaStrips(smap, width, height, firstStrip, numStrips):
+    """ Decodes numStrips strips, starting from strip firstStrip, of an image that is width pixels wide.
+    Only those strips are read and decoded. smap is as for decodeVgaBitmap, but isn't closed.
+    Returns a bitmap that is numStrips * 8 pixels wide."""
+    if firstStrip < 0 or numStrips < 1 or firstStrip + numStrips > width / 8:
+        raise ScummImageEncoderException("Strips %d to %d are outside the image, which has %d strips." %
+                                         (firstStrip, firstStrip + numStrips - 1, width / 8))
+    data, bounds = readSmapStrips(smap, width / 8, firstStrip, numStrips)
+    img, is_transparent = decodeStripRange(data, bounds, height, numStrips)
+    return img
 
-            # Place pixel / end (and execute) a command
-            elif b == 0:
-                bitAcc = bitAcc << 1 # Do this so we get proper value for checking READPAL
-                if bitAcc == READPAL:
-                    contReadingPal = True
-                    bitAcc = 0
-                    # Don't place the pixel until we get the new palette index
-                    continue
-                # Place pixel
-                x_index = (stripNum * 8 + xCounter)
-                y_index = (yCounter * width)
-                final_index = x_index + y_index
-                # This seems to occur in Sam 'n' Max room 2. The final image seems to be alright
-                #  if we ignore these pixels.
-                if final_index >= len(img):
-                    pass
-                    #print "x_index + y_index = %s, which is outside the image (max: %s)." % (final_index, len(img))
-                else:
-                    img[x_index + y_index] = currPalIndex
-                # Move to next pixel
-                xCounter += 1
-                if xCounter >= 8:
-                    xCounter = 0
-                    yCounter += 1
-                    if yCounter >= height:
-                        break
-                ##print "put pixel"
+def decodeVgaViewport(smap, width, height, x, view_width):
+    """ Decodes the part of an image from x to x + view_width, decoding only the strips that cover it.
+    Returns a bitmap that is view_width pixels wide."""
+    if x < 0 or view_width < 1 or x + view_width > width:
+        raise ScummImageEncoderException("Viewport from x=%d to x=%d is outside the image, which is %d pixels wide." %
+                                         (x, x + view_width, width))
+    firstStrip = x / 8
+    numStrips = (x + view_width + 7) / 8 - firstStrip
+    img = decodeVgaStrips(smap, width, height, firstStrip, numStrips)
+    strips_width = numStrips * 8
+    if strips_width == view_width:
+        return img
+    # Crop the partial strips at either side
+    return img.crop(x - firstStrip * 8, view_width)
 
-def decodeVgaBitmap(smap, width, height):
+def decodeVgaBitmap(smap, width, height, jobs=None):
+    """ smap: an open SMAP file, or the SMAP block's bytes (see readSmapData).
+    The block is read once, and each strip is decoded from its offsets in that buffer.
+    jobs: if more than 1, strips are decoded in a pool of this many processes
+          (0 uses one process per CPU). The result is the same as decoding them one by one."""
     img = initBitmapData(width, height)
-
-    # Do these things so we know the size of the last strip
-    limit = 0
-    header = getDWord(smap, 0) # not used
-    blocksize = arrayToInt(getDWord(smap, 0))
+    data = readSmapData(smap)
+    if hasattr(smap, 'close'):
+        smap.close()
 
     print "Retrieving strip offsets from SMAP..."
     # Get strip offsets
     numStrips = width/8
-    stripOffsets = []
-    [stripOffsets.append(arrayToInt(getDWordLE(smap, 0)))
-         for _ in xrange(numStrips)]
+    bounds = getStripBounds(data, numStrips)
 
     print "Reading strips from SMAP... "
-    is_transparent = False
-    # For reach strip
-    for stripnum, s in enumerate(stripOffsets):
-        smap.seek(s, 0)
-        try:
-            compID = arrayToInt(getByte(smap,0))
-        except Exception, eofe:
-            break # v4, loom CD, room 2
-        # Default variables (based on uncompressed settings)
-        compMethod = 0 # 0 will also stand for uncompressed
-        paramSub = 0
-        trans = False
-        rendDir = HORIZONTAL
-
-        ##print compID
-        # Determine compression type
-        if compID == 0x01:
-            # Values are already initialised to uncompressed method settings
-            pass
-        # Method 1 variations
-        elif compID >= 0x0E and compID <= 0x12:
-            paramSub = compID - 0x0A
-            rendDir = VERTICAL
-            compMethod = 1
-        elif compID >= 0x18 and compID <= 0x1C:
-            paramSub = compID - 0x14
-            compMethod = 1
-        elif compID >= 0x22 and compID <= 0x26:
-            paramSub = compID - 0x1E
-            rendDir = VERTICAL
-            trans = True
-            compMethod = 1
-        elif compID >= 0x2C and compID <= 0x30:
-            paramSub = compID - 0x28
-            trans = True
-            compMethod = 1
-        # Method 2 variations
-        elif compID >= 0x40 and compID <= 0x44:
-            paramSub = compID - 0x3C
-            compMethod = 2
-        elif compID >= 0x54 and compID <= 0x58:
-            paramSub = compID - 0x50 # Serge's thing says 0x51
-            trans = True
-            compMethod = 2
-        elif compID >= 0x68 and compID <= 0x6C:
-            paramSub = compID - 0x64
-            trans = True
-            compMethod = 2
-        elif compID >= 0x7C and compID <= 0x80:
-            paramSub = compID - 0x78
-            compMethod = 2
-        else:
-            print "Unknown compression method for strip " + str(compID)
-            raise ScummImageEncoderException("Unknown compression method for strip: %d" % compID)
-
-        if stripnum+1 == len(stripOffsets): # is it the last strip?
-            limit = blocksize
-        else:
-            limit = stripOffsets[stripnum+1]
-        # Try/except is for debugging - will show however much image we've decoded
-        try:
-            if compMethod == 0:
-                #print "Processing uncompresed strip"
-                doUncompressed(smap, img, width, height, limit, stripnum)
-            elif compMethod == 1:
-                #print "Processing strip with method one"
-                doMethodOne(smap, img, width, height, limit, stripnum, paramSub, rendDir)
-            elif compMethod == 2:
-                #print "Processing strip with method two"
-                doMethodTwo(smap, img, width, height, limit, stripnum, paramSub)
-            is_transparent = is_transparent or trans
-        except Exception, e:
-            print "ERROR: %s" % e
-            #print "An error occured - attempting to show incomplete image."
-            #im = Image.new('P', (width, height) )
-            #im.putpalette(pal)
-            #im.putdata(img)
-            #im.show()
-            #smap.close()
-            raise ScummImageEncoderException(e)
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(bounds) > 1:
+        is_transparent = decodeStripsParallel(data, bounds, img, width, height, min(jobs, len(bounds)))
+    else:
+        is_transparent = False
+        # For reach strip
+        for stripnum, (start, limit) in enumerate(bounds):
+            is_transparent = decodeStrip(data, start, limit, img, width, height, stripnum) or is_transparent
     if is_transparent:
         print "WARNING! The original image contains transparency!\n " + \
                 "If you try to re-encode the output file, you will lose all transparency!"
-    smap.close()
-    return img
\ No newline at end of file
+    return img
@@ -22,4 +22,4 @@ def encodeImage(lflf_path, image_path, version, quantization, palette_num, freez
         raise ScummImageEncoderException("Unsupported SCUMM version: %d" % version)
     encoder_class, config = _version_map[version]
     encoder = encoder_class(config)
-    encoder.encodeImage(lflf_path, image_path, quantization, palette_num, freeze_palette, compression_method=None)
+    encoder.encodeImage(lflf_path, image_path, quantization, palette_num, freeze_palette, compression_method=compression_method)
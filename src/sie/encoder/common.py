@@ -1,8 +1,33 @@
 import array
+import logging
+import numpy as np
 import os
 from PIL import Image
 from sie.common import ImageCodecBase, HeaderReaderWriterBinary, HeaderReaderWriterXml
-from sie.sie_util import ScummImageEncoderException, intToBytes
+from sie.sie_util import ScummImageEncoderException
+from vga import encodeVgaBitmap
+
+# compression_method for the v1, v2 and v3 encoders: find the smallest encoding of the image data,
+#  instead of taking the longest run at each position, like the original encoders.
+# Each encoder works backwards from the end, keeping the fewest bytes needed to encode the rest of the data
+#  from each position. Encoding everything from a later position never takes more bytes (each run can just be
+#  shortened), so for each type of run it's enough to try the longest run that fits in each size of code.
+COMPRESSION_MAX = "max"
+
+def packMaskBits(source_mask, width, height):
+    """ Packs a mask image into bytes of 8 pixels, with the leftmost pixel in the top bit.
+    White (255) pixels are set. Returns a list of columns of bytes, each height long."""
+    if source_mask.size != (width, height):
+        raise ScummImageEncoderException("Error: Mask must be the same size as the image.")
+    if source_mask.mode == '1':
+        # NumPy gives booleans for 1 bit images.
+        source_mask = source_mask.convert('L')
+    mask = np.asarray(source_mask).reshape(height, width)
+    return np.packbits(mask >= 255, axis=1).T.tolist()
+
+def logBytesSaved(size, default_size):
+    logging.info("Image data: %d bytes, %d bytes smaller than the default compression (%d bytes)" %
+                 (size, default_size - size, default_size))
 
 class ImageEncoderBase(ImageCodecBase):
     def encodeImage(self, lflf_path, image_path, quantization, palette_num, freeze_palette, compression_method=None):
@@ -73,37 +98,10 @@ class ImageEncoderVgaBase(ImageEncoderBase):
     def writeBitmap(self, lflf_path, image_path, source_image, width, height, compression_method, freeze_palette, quantization):
         width, height = source_image.size
         bitdata = list(source_image.getdata())
-        # Write strips
-        newsmapfile = file(self.getNewBitmapPath(lflf_path), 'wb')
-        # Write dummy header
-        newsmapfile.write('00000000')
-        blockStart = newsmapfile.tell()
-        numStrips = width / 8
-        stripsStartOffset = blockStart + (numStrips * 4) # each offset is a DWord
-        currStripOffsetValue = stripsStartOffset
-        stripSize = height * 8
-        # Write strip offsets
-        # Because we're just using uncompressed things, we can cheat and
-        # predict how big a strip will be
-        for _ in xrange(numStrips):
-            intToBytes(currStripOffsetValue, LE=1).tofile(newsmapfile)
-            currStripOffsetValue += stripSize + 1 # add one for compression ID
-
         palette_offset = 0 if (freeze_palette or not quantization or quantization < 240) else 16
-
-        for stripNum in xrange(numStrips):
-            newsmapfile.write(chr(01)) # tell it it's an uncompressed thingo
-            stripData = array.array('B')
-            for rowNum in range(height):
-                for pixel in bitdata[stripNum * 8 + rowNum * width:
-                                     stripNum * 8 + rowNum * width + 8]:
-                    stripData.append(pixel + palette_offset)
-            stripData.tofile(newsmapfile)
-
-        # Write the header
-        newsmapfile.seek(0, 2)
-        blocksize = newsmapfile.tell()
-        newsmapfile.seek(0, 0)
-        newsmapfile.write('SMAP')
-        intToBytes(blocksize).tofile(newsmapfile)
-        newsmapfile.close()
+        smap_data = encodeVgaBitmap(bitdata, width, height, palette_offset, compression_method)
+        newsmapfile = file(self.getNewBitmapPath(lflf_path), 'wb')
+        try:
+            newsmapfile.write(smap_data)
+        finally:
+            newsmapfile.close()
@@ -1,33 +1,252 @@
 import array
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
 import os
 import struct
 from PIL import Image
-from sie.sie_util import ScummImageEncoderException, makeDirs, xy2i
+from sie.sie_util import ScummImageEncoderException, makeDirs
 import common
 import numpy as np
 
 DEBUG_DUMP = False
 
+# Longest runs of a common value, and of any other value or of discrete values.
+MAX_COMMON_RUN = 32
+MAX_RUN = 64
+# How many of the values with the most runs are tried as common values, for the max compression.
+COMMON_VALUE_CANDIDATES = 12
+# The 4 common values at the start of each RLE stream, and a run of an uncommon value.
+COMMON_VALUES_STRUCT = struct.Struct('<4B')
+UNCOMMON_RUN_STRUCT = struct.Struct('<2B')
+# Where each pixel pair's 2 bit colour index goes in a row byte, from left to right.
+ROW_COLOUR_SHIFTS = np.array([6, 4, 2, 0])
+# Where each pixel's bit goes in a mask row byte, from left to right.
+MASK_BIT_SHIFTS = np.arange(8)
+# The pic maps index 8x8 blocks with 1 byte, and the character map is 2048 bytes.
+MAX_BLOCKS = 256
+
+def formatPixels(xs, ys):
+    """ Lists pixel positions as "(x, y), ...", ordered by row. """
+    order = np.lexsort((xs, ys))
+    return ", ".join("(%d, %d)" % (xs[i], ys[i]) for i in order)
+
+def mapToArray(data):
+    """ A map (a list, or an array.array of bytes) as a numpy array. Byte arrays aren't copied."""
+    if isinstance(data, array.array) and data.typecode == 'B':
+        return np.frombuffer(data, np.uint8)
+    return np.asarray(data, np.intp)
+
+def findSmallestRLEV1(data, common, wildcard=None):
+    """ Finds the runs that RLE encode data in the fewest bytes, for the given 4 common values
+    (see common.COMPRESSION_MAX). Each kind of repeated run has one size of code, so they're always as long as possible.
+    wildcard: a value that can be output as anything (e.g. blocks without a custom colour).
+    Returns the size of the encoded data (without the common values),
+    and a list of (length, value, repeated) tuples. value is None for runs of discrete values."""
+    num_values = len(data)
+    common_set = set(common)
+    # For each position, the bytes needed to encode the rest of the data, and the first run to use.
+    cost = [0] * (num_values + 1)
+    choice = [None] * num_values
+    # Values from each position with the same value as it, or wildcards.
+    same = [0] * (num_values + 1)
+    wildcards = 0 # wildcards starting at this position
+    # Positions after this one, with cost[j] + j increasing, for the cheapest run of discrete values.
+    window = deque()
+    for i in xrange(num_values - 1, -1, -1):
+        value = data[i]
+        if value == wildcard:
+            wildcards += 1
+            next_i = i + wildcards
+        else:
+            next_i = i + 1 + wildcards
+            wildcards = 0
+        next_value = data[next_i] if next_i < num_values else None
+        next_same = same[next_i] if next_i < num_values else 0
+        # Discrete values: 1 byte, plus 1 for each value.
+        j = i + 1
+        while window and cost[window[-1]] + window[-1] >= cost[j] + j:
+            window.pop()
+        window.append(j)
+        if window[0] > i + MAX_RUN:
+            window.popleft()
+        j = window[0]
+        best = cost[j] + j - i + 1
+        best_choice = (j - i, None, False)
+        if value == wildcard:
+            # Runs of wildcards can be output as a common value, or as the value that follows them.
+            candidates = [(c, wildcards + (next_same if next_value == c else 0)) for c in common_set]
+            if next_value is not None:
+                candidates.append((next_value, wildcards + next_same))
+        else:
+            same[i] = next_i - i + (next_same if next_value == value else 0)
+            candidates = [(value, same[i])]
+        for run_value, run in candidates:
+            # Common values: 1 byte for up to 32. Others: 2 bytes for up to 64.
+            if run_value in common_set:
+                run = min(run, MAX_COMMON_RUN)
+                if cost[i + run] + 1 < best:
+                    best = cost[i + run] + 1
+                    best_choice = (run, run_value, True)
+            else:
+                run = min(run, MAX_RUN)
+                if cost[i + run] + 2 < best:
+                    best = cost[i + run] + 2
+                    best_choice = (run, run_value, True)
+        cost[i] = best
+        choice[i] = best_choice
+    runs = []
+    i = 0
+    while i < num_values:
+        runs.append(choice[i])
+        i += choice[i][0]
+    return cost[0], runs
+
 # TODO: maybe split this out into separate classes for backgrounds, background masks,
 #  objects, and object masks.
 
+def blockKeys(char_data):
+    """ The 8 row bytes of each block as one 64-bit key, for an array of blocks (with 8 bytes in the last axis)."""
+    return np.ascontiguousarray(char_data, np.uint8).view('<u8')[..., 0]
+
+class BlockDictionary(object):
+    """ The distinct 8x8 blocks of a character map, shared by the background and objects.
+    Keeps how many times each block is used, and raises ScummImageEncoderException
+    if a room needs more than MAX_BLOCKS blocks."""
+    def __init__(self, name, charMap=None):
+        """ name: used in messages, e.g. "character map".
+        charMap: existing blocks to start with. They aren't counted as used."""
+        self.name = name
+        self.charMap = array.array('B')
+        self.indexes = {} # block key -> block index
+        self.counts = []
+        if charMap:
+            char_data = np.frombuffer(array.array('B', charMap), np.uint8).reshape(-1, 8)
+            for block_data, key in zip(char_data, blockKeys(char_data).tolist()):
+                self.addBlock(key, block_data)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def addBlock(self, key, block_data):
+        """ Adds a block that isn't in the dictionary yet. Returns its index."""
+        if len(self) >= MAX_BLOCKS:
+            raise ScummImageEncoderException("Too many entries in the %s - " % self.name +
+                "maximum distinct 8x8 blocks is %d (incl. background and objects)." % MAX_BLOCKS)
+        index = len(self)
+        self.indexes.setdefault(key, index)
+        self.charMap.extend(block_data.tolist())
+        self.counts.append(0)
+        return index
+
+    def store(self, char_data, block_order, picMap):
+        """ Adds the blocks from EncoderV1.packBlocks or packMaskBlocks to picMap,
+        in the order of the (block row, block column) pairs in block_order.
+        Blocks that haven't been used before are added to the dictionary, in the order they're first used."""
+        block_y, block_x = np.array(block_order, np.intp).reshape(-1, 2).T
+        keys = blockKeys(char_data)[block_y, block_x]
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        uses = np.bincount(inverse).tolist()
+        block_indexes = np.empty(len(unique_keys), np.intp)
+        for unique_i in np.argsort(first, kind='mergesort').tolist():
+            key = int(unique_keys[unique_i])
+            index = self.indexes.get(key)
+            if index is None:
+                i = first[unique_i]
+                index = self.addBlock(key, char_data[block_y[i], block_x[i]])
+            block_indexes[unique_i] = index
+            self.counts[index] += uses[unique_i]
+        picMap.extend(block_indexes[inverse].tolist())
+
+    def report(self):
+        """ How close the room is to the limit, and how many blocks are only used once."""
+        return "%d of %d %s blocks used (%d left), %d used only once" % (
+            len(self), MAX_BLOCKS, self.name, MAX_BLOCKS - len(self), self.counts.count(1))
+
 class EncoderV1(common.ImageEncoderBase):
 
     def findCommonValuesForRLE(self, data):
-        value_freqs = defaultdict(lambda: 0)
-        for b in data:
-            value_freqs[b] += 1
-        # Sort first by values, then by frequencies. Most frequent should be first.
-        value_freqs_sorted = sorted(value_freqs.items(), key=lambda x: x[0])
-        value_freqs_sorted.sort(key=lambda x: x[1], reverse=True)
-        common = [c for c, f in value_freqs_sorted[:4]]
+        value_freqs = np.bincount(mapToArray(data), minlength=1)
+        # Most frequent first, then lowest value first.
+        values_sorted = np.argsort(-value_freqs, kind='mergesort')
+        common = [c for c in values_sorted[:4].tolist() if value_freqs[c]]
         if len(common) < 4: # pad it out to 4 values.
             common.extend([0] * (4 - len(common)))
         return common
 
-    def packRunInfo(self, value, run_length, common, discrete_buffer):
+    def findSmallestCommonValuesForRLE(self, data, wildcard=None):
+        """ Picks the 4 common values that give the smallest encoding: starting from the most frequent values,
+        keeps swapping in whichever of the values with the most runs saves the most bytes.
+        Returns the common values, and the size and runs from findSmallestRLEV1."""
+        values = [v for v in data if v != wildcard]
+        common = self.findCommonValuesForRLE(values)
+        run_freqs = defaultdict(lambda: 0)
+        for idx, value in enumerate(values):
+            if idx == 0 or values[idx - 1] != value:
+                run_freqs[value] += 1
+        candidates = sorted(run_freqs, key=lambda v: (-run_freqs[v], v))[:COMMON_VALUE_CANDIDATES]
+        size, runs = findSmallestRLEV1(data, common, wildcard)
+        improved = True
+        while improved:
+            improved = False
+            best_common = common
+            for idx in xrange(4):
+                for candidate in candidates:
+                    if candidate in common:
+                        continue
+                    new_common = common[:idx] + [candidate] + common[idx + 1:]
+                    new_size, new_runs = findSmallestRLEV1(data, new_common, wildcard)
+                    if new_size < size:
+                        size, runs, best_common = new_size, new_runs, new_common
+                        improved = True
+            common = best_common
+        return common, size, runs
+
+    def compressRLEV1Smallest(self, data, wildcard=None):
+        """ Like compressRLEV1, but picks the common values and runs that take the fewest bytes."""
+        common, size, runs = self.findSmallestCommonValuesForRLE(data, wildcard)
+        output_data = bytearray(COMMON_VALUES_STRUCT.pack(*common))
+        pos = 0
+        last_value = common[0]
+        for run_length, value, repeated in runs:
+            if not repeated:
+                output_data.append(run_length - 1)
+                for v in data[pos:pos + run_length]:
+                    if v != wildcard:
+                        last_value = v
+                    output_data.append(last_value)
+            elif value in common:
+                output_data.append(0x80 | (common.index(value) << 5) | (run_length - 1))
+            else:
+                output_data.extend((0x40 | (run_length - 1), value))
+            if repeated:
+                last_value = value
+            pos += run_length
+        return str(output_data)
+
+    def compressMap(self, data, compression_method, colours=False):
+        """ RLE compresses a map with compressRLEV1 (or compressColourRLEV1, for colour maps),
+        or with compressRLEV1Smallest for the max compression (also logs how many bytes that saved)."""
+        if compression_method is None:
+            return self.compressColourRLEV1(data) if colours else self.compressRLEV1(data)
+        elif compression_method != common.COMPRESSION_MAX:
+            raise ScummImageEncoderException("Unsupported compression method for v1: %s" % compression_method)
+        default_size = len(self.compressColourRLEV1(data) if colours else self.compressRLEV1(data))
+        if colours:
+            # Blocks without a custom colour are 0. The original encoder stores colours with 8 added.
+            output_data = self.compressRLEV1Smallest([v | 8 if v else 0 for v in data], 0)
+        else:
+            output_data = self.compressRLEV1Smallest(data)
+        common.logBytesSaved(len(output_data), default_size)
+        return output_data
+
+    def packRunInfo(self, value, run_length, common, discrete_buffer, output_data=None):
+        """ Appends the codes for a run to output_data (a bytearray).
+        If there's no output_data, returns the codes as a string instead."""
+        if output_data is None:
+            output_data = bytearray()
+            self.packRunInfo(value, run_length, common, discrete_buffer, output_data)
+            return str(output_data)
+
         # Original encoder seems to favour outputting single discrete values
         #  (i.e. only 1 value in the run) as a run - this gives better compression
         #  if the value is a common value, as it only uses 1 byte.
@@ -37,112 +256,70 @@ class EncoderV1(common.ImageEncoderBase):
         # Output non-repeated values.
         if discrete_buffer is not None and len(discrete_buffer) > 1:
             # Maximum run length value is 0x3F (63) - actual run length of 64.
-            data = ''
-            while len(discrete_buffer) > 0:
-                buf_size_to_output = min(len(discrete_buffer), 64)
-                db = discrete_buffer[:buf_size_to_output]
-                format = '<%dB' % (buf_size_to_output + 1)
-                data += struct.pack(format,
-                               buf_size_to_output - 1, # value counts start from 0, not 1.
-                               *db)
-                discrete_buffer = discrete_buffer[buf_size_to_output:]
-            return data
+            for start in xrange(0, len(discrete_buffer), 64):
+                db = discrete_buffer[start:start + 64]
+                output_data.append(len(db) - 1) # value counts start from 0, not 1.
+                output_data.extend(db)
         # Output common repeated values.
         elif value in common:
             # Maximum run length is 0x1F (31 [actually 32]), so output as many of these
             #  things as we need to capture the whole run.
             # Assume input run_length starts counting run lengths from 0
             #  (e.g. "12 12 12" has a run length value of 2)
-            data = ''
+            output = 0x80 | ((common.index(value) & 3) << 5)
             while run_length >= 0:
-                output = 0x80
-                comval = common.index(value) & 3
-                output |= (comval << 5)
-                rl = min(run_length, 0x1F)
-                output |= rl
-                data += struct.pack('<B', output)
+                output_data.append(output | min(run_length, 0x1F))
                 run_length -= 0x20 # substract 32 since it's the real run
-            return data
         # Output uncommon repeated values.
         else:
             # Maximum run length is 0x3F (63 [actually 64]), so output as many of these
             #  things as we need to capture the whole run.
-            data = ''
             while run_length >= 0:
-                output = 0x40
-                rl = min(run_length, 0x3F)
-                #print "run_length: %d. rl: %d" % (run_length, rl)
-                output |= rl
-                data += struct.pack('<2B', output, value)
+                output_data.extend(UNCOMMON_RUN_STRUCT.pack(0x40 | min(run_length, 0x3F), value))
                 run_length -= 0x40 # substract 64 since it's the real run
-            return data
 
-    def compressRLEV1(self, data):
+    def packRuns(self, values, common, output_data):
         """
-        Compression compares the current value with the previous value, and
-        performs one of two actions:
-        1. If values are different:
-           A. If previous run was a repeated value, output that run, and reset the "discrete value" buffer.
-           B. Else, if in a "discrete value" run, add the previous value to the "discrete value" buffer.
-        2. If values are the same:
-           A. If previous run was a "discrete value" run, output the "discrete value" buffer, and reset the run.
-           B. Else, if in a repeated value run, increment the run counter.
+        Appends the codes for values to output_data (a bytearray). Each run of 2 or more of the same value
+        is output as a run. The values between those runs are output as discrete values.
         """
-        last_value = None
-        run_length = 0
-        discrete_buffer = [] # holds non-run values
-        output_data = ""
+        values_array = mapToArray(values)
+        values = values_array.tolist()
+        if not values:
+            return
+        # Where each run of the same value starts, and how long it is.
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(values_array)) + 1))
+        run_lengths = np.diff(np.concatenate((run_starts, [len(values)])))
+        is_run = run_lengths > 1
+        pos = 0
+        for start, length in zip(run_starts[is_run].tolist(), run_lengths[is_run].tolist()):
+            if start > pos:
+                self.packRunInfo(None, 0, common, values[pos:start], output_data)
+            self.packRunInfo(values[start], length - 1, common, None, output_data) # run lengths start counting from 0
+            pos = start + length
+        # Output last bit of data.
+        if pos < len(values):
+            self.packRunInfo(None, 0, common, values[pos:], output_data)
+
+    def compressRLEV1(self, data):
+        """ Outputs the 4 most common values, then the runs from packRuns."""
+        output_data = bytearray()
 
         # First, determine the most common values.
         common = self.findCommonValuesForRLE(data)
         logging.debug("4 most common bytes on compression:")
         logging.debug(' '.join(format(x, '02x') for x in common))
-        output_data += struct.pack('<4B', *common)
+        output_data.extend(COMMON_VALUES_STRUCT.pack(*common))
 
-        for value in data:
-            if last_value is None: # special case for first item
-                last_value = value
-                continue
-            if value == last_value:
-                if len(discrete_buffer):
-                    output_data += self.packRunInfo(None, run_length, common, discrete_buffer)
-                    run_length = 1 # because we look a value behind, we already know this run's length is 2.
-                    discrete_buffer = []
-                else:
-                    run_length += 1
-            else:
-                # Output previous run
-                if run_length:
-                    output_data += self.packRunInfo(last_value, run_length, common, None)
-                    run_length = 0
-                    discrete_buffer = []
-                else:
-                    discrete_buffer.append(last_value)
-            last_value = value
-
-        # Output last bit of data.
-        if not run_length: # hackish
-            discrete_buffer.append(last_value)
-        output_data += self.packRunInfo(last_value, run_length, common, discrete_buffer)
-        return output_data
+        self.packRuns(data, common, output_data)
+        return str(output_data)
         
     def compressColourRLEV1(self, data):
         """
-        Compression compares the current value with the previous value, and
-        performs one of two actions:
-        1. If values are different:
-           A. If previous run was a repeated value, output that run, and reset the "discrete value" buffer.
-           B. Else, if in a "discrete value" run, add the previous value to the "discrete value" buffer.
-        2. If values are the same:
-           A. If previous run was a "discrete value" run, output the "discrete value" buffer, and reset the run.
-           B. Else, if in a repeated value run, increment the run counter.
+        Like compressRLEV1, but a 0 (no custom colour) carries on the previous custom colour,
+        and colours are stored with 8 added.
         """
-        #last_value = None
-        run_length = 0
-        discrete_buffer = [] # holds non-run values
-        output_data = ""
-        
-        previous_extra_colour = None
+        output_data = bytearray()
 
         # First, determine the most common values.
         common = self.findCommonValuesForRLE(data)
@@ -150,37 +327,15 @@ class EncoderV1(common.ImageEncoderBase):
         logging.debug(' '.join(format(x, '02x') for x in common))
         for idx, x in enumerate(common):
             common[idx] |= 8
-        output_data += struct.pack('<4B', *common)
-
-        for value in data:
-            if previous_extra_colour is None: # special case for first item
-                #last_value = value
-                previous_extra_colour = value
-                continue
-            if value == 0 or value == previous_extra_colour:
-                if len(discrete_buffer):
-                    output_data += self.packRunInfo(None, run_length, common, discrete_buffer)
-                    run_length = 1 # because we look a value behind, we already know this run's length is 2.
-                    discrete_buffer = []
-                else:
-                    run_length += 1
-            else:
-                # Output previous run
-                if run_length:
-                    output_data += self.packRunInfo(previous_extra_colour | 8, run_length, common, None)
-                    run_length = 0
-                    discrete_buffer = []
-                else:
-                    discrete_buffer.append(previous_extra_colour | 8)
-            #last_value = value
-            if value != 0 and value != previous_extra_colour:
-                previous_extra_colour = value
+        output_data.extend(COMMON_VALUES_STRUCT.pack(*common))
 
-        # Output last bit of data.
-        if not run_length: # hackish
-            discrete_buffer.append(previous_extra_colour | 8)
-        output_data += self.packRunInfo(previous_extra_colour | 8, run_length, common, discrete_buffer)
-        return output_data
+        data = mapToArray(data)
+        keep = data != 0
+        keep[:1] = True # the first value is always kept
+        # Index of the last colour kept, at or before each position.
+        last_kept = np.maximum.accumulate(np.where(keep, np.arange(len(data)), 0))
+        self.packRuns(data[last_kept] | 8, common, output_data)
+        return str(output_data)
 
     def getCommonColoursV1(self, source_data, width, height):
         """
@@ -284,60 +439,64 @@ class EncoderV1(common.ImageEncoderBase):
         
         return common_colours_list
 
-    def packRowData(self, source_data, common_colours, custom_colour, row_start, width):
-        row_data = 0
-        for col in xrange(0, 8, 2):
-            val1 = source_data[row_start + col]
-            val2 = source_data[row_start + col + 1] # only used for validation
-            if val1 != val2:
-                raise ScummImageEncoderException("V1 images can only have one colour per every two pixels on the x axis. " +
-                "Offending pixel at (%d, %d)" % ((row_start + col + 1) % width, (row_start + col + 1) / width))
-
-            # Convert from the source colour table index, to an index in our 4-value colour array.
-            if val1 in common_colours:
-                colour = common_colours.index(val1)
-            else:
-                if custom_colour is None:
-                    custom_colour = val1
-                if custom_colour > 7:
-                    raise ScummImageEncoderException("The fourth 'custom colour' per block cannot have a value higher than 7. " +
-                    "Offending pixel at (%d, %d)" % ((row_start + col) % width, (row_start + col) / width))
-                if custom_colour == val1:
-                    colour = 3
-                else:
-                    logging.error("Too many colours. Common: %s, custom: %s, offending: %s" % (common_colours, custom_colour, val1))
-                    raise ScummImageEncoderException("Image has too many colours in a block - max of 4 colours allowed " +
-                                                     "(3 common colours and 1 custom colour for the block).  " +
-                    "Offending pixel at (%d, %d).\n" % ((row_start + col) % width, (row_start + col) / width) +
-                    "Colours: %s. Custom colour: %s. Offending colour: %s" % (common_colours, custom_colour, val1))
-
-            # Compress 4 pixels to 1 byte
-            colour &= 3
-            row_data |= colour << 6 - col
-            # end col
-        return row_data, custom_colour
-        # end row
-
-    def packBlock(self, source_data, vstrip_i, hstrip_i, width, common_colours, block_map, picMap, charMap, colourMap):
+    def packBlocks(self, source_data, width, height, common_colours):
         """
-         Modifies:
-          - block_map
-          - picMap
-          - charMap
-          - colourMap
+        Packs all the 8x8 blocks of an image at once. Each row of a block is stored in 1 byte:
+        2 bits for each pair of pixels, holding an index into the 3 common colours,
+        or 3 for the block's custom colour.
+        Returns the character data (an array of 8 bytes for each block, indexed by block row, then block column),
+        and the custom colour for each block (0 if it doesn't need one).
+        Raises ScummImageEncoderException listing all the offending pixels, if the image breaks the V1 rules.
         """
-        block_data = []
-        custom_colour = None
-        for row_i in xrange(8):
-            row_start = xy2i(vstrip_i * 8, hstrip_i * 8 + row_i, width)
-            #logging.debug("vstrip_i: %d. hstrip_i: %d. row start: %d" % (vstrip_i, hstrip_i, row_start,))
-            row_data, custom_colour = self.packRowData(source_data, common_colours, custom_colour, row_start, width)
-            block_data.append(row_data)
-        self.storeBlockData(block_map, charMap, picMap, block_data)
-        if custom_colour is None:
-            custom_colour = 0
-        colourMap.append(custom_colour)
-        #logging.debug("last picMap: %d" % picMap[-1])
+        num_strips = width / 8
+        num_blocks = height / 8
+        pixels = np.asarray(source_data, np.intp).reshape(height, width)
+        errors = []
+
+        # Each value is output twice, so the pixels to the right of each pair are only used for validation.
+        bad_y, bad_x = np.nonzero(pixels[:, 0::2] != pixels[:, 1::2])
+        if len(bad_y):
+            errors.append("V1 images can only have one colour per every two pixels on the x axis. " +
+                          "Offending pixels at %s" % formatPixels(bad_x * 2 + 1, bad_y))
+
+        # Convert from the source colour table index, to an index in our 4-value colour array (-1 for custom colours).
+        colours = pixels[:, 0::2]
+        colour_lut = np.full(max(16, colours.max() + 1 if colours.size else 0), -1, np.intp)
+        for idx in reversed(xrange(len(common_colours))):
+            if common_colours[idx] < len(colour_lut):
+                colour_lut[common_colours[idx]] = idx
+        indexes = colour_lut[colours]
+
+        def byBlock(a):
+            """ The 32 pixel pairs of each block, in order, indexed by block row and block column."""
+            return a.reshape(num_blocks, 8, num_strips, 4).swapaxes(1, 2).reshape(num_blocks, num_strips, 32)
+        block_colours = byBlock(colours)
+        is_custom = byBlock(indexes) < 0
+        # The first colour that isn't a common colour becomes the block's custom colour.
+        first_custom = is_custom.argmax(axis=2)
+        custom_colours = np.where(is_custom.any(axis=2),
+                                  np.take_along_axis(block_colours, first_custom[:, :, np.newaxis], 2)[:, :, 0], 0)
+
+        def pixelPositions(block_y, block_x, pair_i):
+            return block_x * 8 + (pair_i % 4) * 2, block_y * 8 + pair_i / 4
+        block_y, block_x = np.nonzero(custom_colours > 7)
+        if len(block_y):
+            errors.append("The fourth 'custom colour' per block cannot have a value higher than 7. " +
+                          "Offending pixels at %s" % formatPixels(*pixelPositions(block_y, block_x, first_custom[block_y, block_x])))
+        block_y, block_x, pair_i = np.nonzero(is_custom & (block_colours != custom_colours[:, :, np.newaxis]))
+        if len(block_y):
+            logging.error("Too many colours. Common: %s" % common_colours)
+            errors.append("Image has too many colours in a block - max of 4 colours allowed " +
+                          "(3 common colours and 1 custom colour for the block). " +
+                          "Offending pixels at %s" % formatPixels(*pixelPositions(block_y, block_x, pair_i)))
+        if errors:
+            raise ScummImageEncoderException("\n".join(errors))
+
+        # Compress 4 pixels to 1 byte
+        indexes = np.where(indexes < 0, 3, indexes) & 3
+        row_data = (indexes.reshape(height, num_strips, 4) << ROW_COLOUR_SHIFTS).sum(axis=2)
+        char_data = row_data.reshape(num_blocks, 8, num_strips).swapaxes(1, 2)
+        return char_data, custom_colours
 
     def packBackgroundData(self, source_data, width, height):
         """
@@ -347,9 +506,9 @@ class EncoderV1(common.ImageEncoderBase):
         - Add the charMap index to picMap
         - Add the block's custom colour to colourMap
         When done, run RLE over each map, EXCEPT charMap (since it will be modified again later).
-        Returns charMap, for further modification (to add object data).
+        Returns the BlockDictionary holding charMap, for further modification (to add object data).
         """
-        charMap = array.array('B') # B1v1 - always 2048 bytes
+        blocks = BlockDictionary("character map") # B1v1 - always 2048 bytes
         picMap = array.array('B') # B2v1
         colourMap = array.array('B') # B3v1
 
@@ -361,11 +520,13 @@ class EncoderV1(common.ImageEncoderBase):
         # Get the three most used colours. The fourth colour is determined per block.
         common_colours = self.getCommonColoursV1(source_data, width, height)
         logging.debug("Common colours: %s" % common_colours)
-        block_map = {} # map block signatures to indices into the picMap
 
-        for vstrip_i in xrange(num_strips):
-            for hstrip_i in xrange(num_blocks):
-                self.packBlock(source_data, vstrip_i, hstrip_i, width, common_colours, block_map, picMap, charMap, colourMap)
+        char_data, custom_colours = self.packBlocks(source_data, width, height, common_colours)
+        # Background blocks go down each strip in turn.
+        block_order = [(hstrip_i, vstrip_i) for vstrip_i in xrange(num_strips) for hstrip_i in xrange(num_blocks)]
+        blocks.store(char_data, block_order, picMap)
+        custom_colours = custom_colours.tolist()
+        colourMap.extend(custom_colours[hstrip_i][vstrip_i] for hstrip_i, vstrip_i in block_order)
 
         # If picMap or colourMap is not the size of the image (divided into 8x8 blocks),
         #  there's something wrong with my code.
@@ -374,10 +535,10 @@ class EncoderV1(common.ImageEncoderBase):
             raise ScummImageEncoderException("I don't seem to have generated enough entries in either the picMap or colourMap. " +
                 "Expected entries: %d. picMap entries: %d. colourMap entries: %d." % (num_strips * num_blocks, len(picMap), len(colourMap)))
 
-        return charMap, picMap, colourMap, block_map, common_colours
+        return blocks, picMap, colourMap, common_colours
 
-    def writeBackgroundBitmap(self, lflf_path, source_image, width, height):
-        charMap, picMap, colourMap, block_map, common_colours = self.packBackgroundData(source_image, width, height)
+    def writeBackgroundBitmap(self, lflf_path, source_image, width, height, compression_method=None):
+        blocks, picMap, colourMap, common_colours = self.packBackgroundData(source_image, width, height)
 
         # don't output charMap yet, since objects will modify it.
 
@@ -390,34 +551,33 @@ class EncoderV1(common.ImageEncoderBase):
         logging.debug("Background and objects PicMap before compression (B2v1):")
         for idx in xrange(0, len(picMap), height/8):
             logging.debug(' '.join(format(x, '02x') for x in picMap[idx:idx+height/8]))
-        picMap = self.compressRLEV1(picMap)
+        picMap = self.compressMap(picMap, compression_method)
         out_path = os.path.join(lflf_path, 'ROv1', 'B2v1')
         self.genericWrite(out_path, picMap)
         
         logging.debug("Background and objects ColourMap before compression (B3v1):")
         for idx in xrange(0, len(colourMap), height/8):
             logging.debug(' '.join(format(x, '02x') for x in colourMap[idx:idx+height/8]))
-        colourMap = self.compressColourRLEV1(colourMap)
+        colourMap = self.compressMap(colourMap, compression_method, colours=True)
         out_path = os.path.join(lflf_path, 'ROv1', 'B3v1')
         self.genericWrite(out_path, colourMap)
 
-        return charMap, block_map, common_colours
+        return blocks, common_colours
 
     def packBackgroundMaskData(self, source_data, width, height):
-        maskCharMap = array.array('B')
+        mask_blocks = BlockDictionary("mask character map")
         picMap = array.array('B')
-        mask_block_map = {}
         if width % 8 or height % 8:
             raise ScummImageEncoderException("Input image must have dimensions divisible by 8. (Input dimensions: %dx%d)" % (width, height))
+        char_data = self.packMaskBlocks(source_data, width, height)
         num_vstrips = width / 8
         num_hstrips = height / 8
-        for vstrip_i in xrange(num_vstrips):
-            for hstrip_i in xrange(num_hstrips):
-                self.packMaskBlock(source_data, vstrip_i, hstrip_i, width, mask_block_map, picMap, maskCharMap)
-        return maskCharMap, picMap, mask_block_map
+        block_order = [(hstrip_i, vstrip_i) for vstrip_i in xrange(num_vstrips) for hstrip_i in xrange(num_hstrips)]
+        mask_blocks.store(char_data, block_order, picMap)
+        return mask_blocks, picMap
 
-    def writeBackgroundMaskBitmap(self, lflf_path, source_image, width, height):
-        maskCharMap, maskPicMap, mask_block_map = self.packBackgroundMaskData(source_image, width, height)
+    def writeBackgroundMaskBitmap(self, lflf_path, source_image, width, height, compression_method=None):
+        mask_blocks, maskPicMap = self.packBackgroundMaskData(source_image, width, height)
 
         if DEBUG_DUMP:
             out_path = os.path.join(lflf_path, 'maskPicMap')
@@ -426,55 +586,43 @@ class EncoderV1(common.ImageEncoderBase):
         logging.debug("Background mask PicMap before compression (B4v1):")
         for idx in xrange(0, len(maskPicMap), height/8):
             logging.debug(' '.join(format(x, '02d') for x in maskPicMap[idx:idx+height/8]))
-        maskPicMap = self.compressRLEV1(maskPicMap)
+        maskPicMap = self.compressMap(maskPicMap, compression_method)
         out_path = os.path.join(lflf_path, 'ROv1', 'B4v1')
         self.genericWrite(out_path, maskPicMap)
         
-        return maskCharMap, mask_block_map
-
-    def packMaskRowData(self, source_data, row_start, width):
-        """Compressess 8 values of 0 or 1 into one byte.   """
-        row_data = 0
-        for col in xrange(8):
-            val = source_data[row_start + col]
-            if val > 1:
-                raise ScummImageEncoderException("V1 mask images can only have values of 0 or 1. " +
-                "Offending pixel at (%d, %d). Value: %d." % ((row_start + col + 1) % width, (row_start + col + 1) / width, val))
-
-            row_data |= (val << col)
-        return row_data
-        # end row
-
-    def packMaskBlock(self, source_data, vstrip_i, hstrip_i, width, block_map, objectMap, maskCharMap):
-        """
-         Modifies:
-          - block_map
-          - objectMap
-          - maskCharMap
+        return mask_blocks
+
+    def packMaskBlocks(self, source_data, width, height):
+        """ Packs all the 8x8 blocks of a mask at once. Each row of a block is stored in 1 byte,
+        with the leftmost pixel in the lowest bit.
+        Returns the character data, indexed by block row, then block column.
+        Raises ScummImageEncoderException listing all the offending pixels, if any aren't 0 or 1.
         """
-        block_data = []
-        for row_i in xrange(8):
-            row_start = xy2i(vstrip_i * 8, hstrip_i * 8 + row_i, width)
-            #logging.debug("vstrip_i: %d. hstrip_i: %d. row start: %d" % (vstrip_i, hstrip_i, row_start,))
-            row_data = self.packMaskRowData(source_data, row_start, width)
-            block_data.append(row_data)
-        self.storeBlockData(block_map, maskCharMap, objectMap, block_data)
-        #logging.debug("last picMap: %d" % objectMap[-1])
+        num_strips = width / 8
+        num_blocks = height / 8
+        pixels = np.asarray(source_data, np.intp).reshape(height, width)
+        bad_y, bad_x = np.nonzero(pixels > 1)
+        if len(bad_y):
+            raise ScummImageEncoderException("V1 mask images can only have values of 0 or 1. " +
+                "Offending pixels at %s. Values: %s." % (formatPixels(bad_x, bad_y),
+                                                         ", ".join(str(v) for v in np.unique(pixels[bad_y, bad_x]))))
+        row_data = (pixels.reshape(height, num_strips, 8) << MASK_BIT_SHIFTS).sum(axis=2)
+        return row_data.reshape(num_blocks, 8, num_strips).swapaxes(1, 2)
 
 
-    def packObjectMaskData(self, source_data, width, height, maskCharMap, mask_block_map):
+    def packObjectMaskData(self, source_data, width, height, mask_blocks):
         objectMap = array.array('B')
         if width % 8 or height % 8:
             raise ScummImageEncoderException("Input image must have dimensions divisible by 8. (Input dimensions: %dx%d)" % (width, height))
+        char_data = self.packMaskBlocks(source_data, width, height)
         num_vstrips = width / 8
         num_hstrips = height / 8
-        for hstrip_i in xrange(num_hstrips):
-            for vstrip_i in xrange(num_vstrips):
-                self.packMaskBlock(source_data, vstrip_i, hstrip_i, width, mask_block_map, objectMap, maskCharMap)
-        return objectMap, maskCharMap
+        block_order = [(hstrip_i, vstrip_i) for hstrip_i in xrange(num_hstrips) for vstrip_i in xrange(num_vstrips)]
+        mask_blocks.store(char_data, block_order, objectMap)
+        return objectMap
 
 
-    def packObjectData(self, source_data, width, height, charMap, block_map, common_colours, mask_data):
+    def packObjectData(self, source_data, width, height, blocks, common_colours, mask_data):
         """
         Objects seem to be compressed in blocks horizontally, rather than vertically.
         Custom colours are stored after all block data, in the same order as the
@@ -498,9 +646,11 @@ class EncoderV1(common.ImageEncoderBase):
 
         logging.debug("num_vstrips * num_hstrips: %d" % (num_vstrips * num_hstrips))
 
-        for hstrip_i in xrange(num_hstrips):
-            for vstrip_i in xrange(num_vstrips):
-                self.packBlock(source_data, vstrip_i, hstrip_i, width, common_colours, block_map, objectMap, charMap, colourMap)
+        char_data, custom_colours = self.packBlocks(source_data, width, height, common_colours)
+        # Object blocks go across each row in turn.
+        block_order = [(hstrip_i, vstrip_i) for hstrip_i in xrange(num_hstrips) for vstrip_i in xrange(num_vstrips)]
+        blocks.store(char_data, block_order, objectMap)
+        colourMap.extend(custom_colours.ravel().tolist())
 
         # If objectMap or colourMap is not the size of the image (divided into 8x8 blocks),
         #  there's something wrong with my code.
@@ -514,7 +664,7 @@ class EncoderV1(common.ImageEncoderBase):
         # Also add the mask data.
         objectMap.extend(mask_data)
 
-        return objectMap, charMap
+        return objectMap
 
     def genericWrite(self, out_path, data):
         makeDirs(out_path)
@@ -528,26 +678,7 @@ class EncoderV1(common.ImageEncoderBase):
                 outFile.write(b)
         outFile.close()
 
-    def storeBlockData(self, block_map, charMap, picMap, block_data):
-        """ Modifies the input block_map, the picMap, and the charMap.
-        """
-        # If this 8x8 block has been used before in the image, re-use that block's index.
-        # Otherwise, output the new data to the charMap, and store the hash of the block
-        #  in a lookup table, so we can test if future blocks can re-use the same character data.
-        block_key = tuple(block_data) # block data is going to be, at most, 8 bytes, so not too inefficient.
-        if block_key in block_map:
-            picMap.append(block_map[block_key])
-        else:
-            row_char_idx = len(charMap) / 8 # Need to store the index of the charMap entry that starts the row.
-            if row_char_idx > 255:
-                logging.debug("block_map: %s" % block_map)
-                raise ScummImageEncoderException("Too many entries in the character map - " +
-                    "maximum distinct 8x8 blocks is 255 (incl. background and objects).\n")
-            charMap.extend(block_data)
-            picMap.append(row_char_idx)
-            block_map[block_key] = row_char_idx
-
-    def writeCharMap(self, lflf_path, charMap):
+    def writeCharMap(self, lflf_path, charMap, compression_method=None):
         if len(charMap) < 2048:
             charMap.extend([0] * (2048 - len(charMap)))
         elif len(charMap) > 2048:
@@ -557,18 +688,18 @@ class EncoderV1(common.ImageEncoderBase):
         logging.debug("Background and objects CharMap before compression (B1v1):")
         for idx in xrange(0, len(charMap), 8):
             logging.debug(' '.join(format(x, '02x') for x in charMap[idx:idx+8]))
-        charMap = self.compressRLEV1(charMap)
+        charMap = self.compressMap(charMap, compression_method)
         out_path = os.path.join(lflf_path, 'ROv1', 'B1v1')
         self.genericWrite(out_path, charMap)
 
-    def writeMaskCharMap(self, lflf_path, maskCharMap):
+    def writeMaskCharMap(self, lflf_path, maskCharMap, compression_method=None):
         size = len(maskCharMap) + 8
         if size > 65535:
             raise ScummImageEncoderException("Too many entries in the mask char map - max 65527.")
         logging.debug("Background and objects MASK CharMap before compression (B5v1):")
         for idx in xrange(0, size, 8):
             logging.debug(' '.join(format(x, '02x') for x in maskCharMap[idx:idx+8]))
-        data = self.compressRLEV1(maskCharMap)
+        data = self.compressMap(maskCharMap, compression_method)
         out_path = os.path.join(lflf_path, 'ROv1', 'B5v1')
         makeDirs(out_path)
         outFile = file(out_path, 'wb')
@@ -588,7 +719,7 @@ class EncoderV1(common.ImageEncoderBase):
         data = struct.pack('<4B', *common_colours)
         self.genericWrite(out_path, data)
 
-    def writeMaskBitmap(self, lflf_path, image_path, width, height):
+    def writeMaskBitmap(self, lflf_path, image_path, width, height, compression_method=None):
         bi, biext = os.path.splitext(image_path)
         mask_path = bi + ".mask" + biext
         mask_image = Image.open(mask_path)
@@ -596,25 +727,27 @@ class EncoderV1(common.ImageEncoderBase):
         if mask_width != width or mask_height != height:
             raise ScummImageEncoderException("The dimensions of the background image and it's associated mask image do not match. "
                 "Background dimensions: %dx%d. Mask dimensions: %dx%d." % (width, height, mask_width, mask_height))
-        maskCharMap, mask_block_map = self.writeBackgroundMaskBitmap(lflf_path, mask_image.getdata(), mask_width, mask_height)
-        return maskCharMap, mask_block_map
+        return self.writeBackgroundMaskBitmap(lflf_path, mask_image.getdata(), mask_width, mask_height, compression_method)
 
     def writeBitmap(self, lflf_path, image_path, source_image, width, height, compression_method, freeze_palette, quantization):
         # Read & pack the background data - just the pic map and colour map for now.
         #  Character map and common colour data is written later, since this info is used/modified by
         #  objects as well.
-        charMap, block_map, common_colours = self.writeBackgroundBitmap(lflf_path, source_image.getdata(), width, height)
-        bgCharMapLen = len(charMap) / 8
-        logging.debug("charmap length for background: %d" % (len(charMap) / 8))
+        blocks, common_colours = self.writeBackgroundBitmap(lflf_path, source_image.getdata(), width, height,
+                                                            compression_method)
+        bgCharMapLen = len(blocks)
+        logging.debug("charmap length for background: %d" % bgCharMapLen)
         # Read & pack the mask data (as much as we can for now, anyway)
-        maskCharMap, mask_block_map = self.writeMaskBitmap(lflf_path, image_path, width, height)
-        self.encodeObjectImages(lflf_path, image_path, charMap, maskCharMap, block_map, mask_block_map, common_colours)
-        logging.debug("charmap length for objects: %d" % ((len(charMap) / 8) - bgCharMapLen))
-        self.writeCharMap(lflf_path, charMap)
-        self.writeMaskCharMap(lflf_path, maskCharMap)
+        mask_blocks = self.writeMaskBitmap(lflf_path, image_path, width, height, compression_method)
+        logging.info("Background: %s. %s." % (blocks.report(), mask_blocks.report()))
+        self.encodeObjectImages(lflf_path, image_path, blocks, mask_blocks, common_colours, compression_method)
+        logging.debug("charmap length for objects: %d" % (len(blocks) - bgCharMapLen))
+        logging.info("Room: %s. %s." % (blocks.report(), mask_blocks.report()))
+        self.writeCharMap(lflf_path, blocks.charMap, compression_method)
+        self.writeMaskCharMap(lflf_path, mask_blocks.charMap, compression_method)
         self.writeCommonColours(lflf_path, common_colours)
 
-    def encodeObjectImages(self, lflf_path, image_path, charMap, maskCharMap, block_map, mask_block_map, common_colours):
+    def encodeObjectImages(self, lflf_path, image_path, blocks, mask_blocks, common_colours, compression_method=None):
         # Get the dir containing all the object images
         object_images_path = os.path.split(image_path)[0]
         # Search for images that match an expected format, representing objects
@@ -637,13 +770,13 @@ class EncoderV1(common.ImageEncoderBase):
             mask_file_name = oibase + ".mask" + oiext
             mask_image = Image.open(os.path.join(object_images_path, mask_file_name))
             width, height = mask_image.size
-            mask_data, maskCharMap = self.packObjectMaskData(mask_image.getdata(), width, height, maskCharMap, mask_block_map)
+            mask_data = self.packObjectMaskData(mask_image.getdata(), width, height, mask_blocks)
             # Read in the source image data
             source_image = Image.open(os.path.join(object_images_path, obj_image_name))
             width, height = source_image.size
             # Pack and RLE compress the data
-            objectMap, charMap = self.packObjectData(source_image.getdata(), width, height, charMap, block_map, common_colours, mask_data)
-            objectMap = self.compressRLEV1(objectMap)
+            objectMap = self.packObjectData(source_image.getdata(), width, height, blocks, common_colours, mask_data)
+            objectMap = self.compressMap(objectMap, compression_method)
 
             out_path = os.path.join(lflf_path, 'ROv1', 'OIv1_%s' % (objNum.zfill(4)))
             self.genericWrite(out_path, objectMap)
@@ -3,6 +3,62 @@ import logging
 import os
 import struct
 from PIL import Image
+from sie.sie_util import ScummImageEncoderException
+from sie.trace import isTraceEnabled, trace
+
+# Longest runs that can be packed
+MAX_RUN = 0xFF
+
+def getColumnPixels(source_data, width, height):
+    """ The pixels of an image in the order they are encoded: down each column in turn."""
+    return [source_data[y * width + x] for x in xrange(width) for y in xrange(height)]
+
+def findSmallestRuns(pixels, height):
+    """ Finds the runs that encode an image (from getColumnPixels) in the fewest bytes (see common.COMPRESSION_MAX).
+    Runs can carry on into the next column, and unlike encodeImageData,
+    pixels in the first column of a strip can bleed from the strip to their left (as in the original games' images).
+    Returns a list of (bleeding, run) tuples."""
+    num_pixels = len(pixels)
+    # For each position, the bytes needed to encode the rest of the image, and the first run to use.
+    cost = [0] * (num_pixels + 1)
+    choice = [None] * num_pixels
+    same = 0 # pixels with the same colour, starting at this position
+    bleed = 0 # pixels that match the pixel to their left, starting at this position
+    for i in xrange(num_pixels - 1, -1, -1):
+        colour = pixels[i]
+        if i + 1 < num_pixels and pixels[i + 1] == colour:
+            same += 1
+        else:
+            same = 1
+        if i >= height and pixels[i - height] == colour:
+            bleed += 1
+        else:
+            bleed = 0
+        # Colour runs: 1 byte for up to 7 pixels, 2 bytes for up to 255.
+        run = min(same, MAX_RUN)
+        best_bleeding, best_run = False, min(run, 0x07)
+        best = cost[i + best_run] + 1
+        if run > 0x07 and cost[i + run] + 2 < best:
+            best_run = run
+            best = cost[i + run] + 2
+        # Bleeding runs: 1 byte for up to 127 pixels, 2 bytes for up to 255.
+        run = min(bleed, MAX_RUN)
+        if run:
+            short_run = min(run, 0x7F)
+            if cost[i + short_run] + 1 < best:
+                best_bleeding, best_run = True, short_run
+                best = cost[i + short_run] + 1
+            if run > 0x7F and cost[i + run] + 2 < best:
+                best_bleeding, best_run = True, run
+                best = cost[i + run] + 2
+        cost[i] = best
+        choice[i] = (best_bleeding, best_run)
+    runs = []
+    i = 0
+    while i < num_pixels:
+        runs.append(choice[i])
+        i += choice[i][1]
+    return runs
 
 class EncoderV2(common.ImageEncoderBase):
     def encodeImage(self, lflf_path, image_path, quantization, palette_num, freeze_palette, compression_method=None):
@@ -49,8 +105,7 @@ class EncoderV2(common.ImageEncoderBase):
             object_path = self.getNewObjectPath(lflf_path, objNum)
             self.writeObject(object_path, image_path, source_image, source_mask, width, height, compression_method, freeze_palette, quantization)
     
-    def packRunInfoV2(self, run, colour, bleeding):
-        logging.debug("Writing out run info. run: %d, colour: %s, bleeding: %s" % (run, colour, bleeding))
+    def packRunInfoV2(self, run, colour, bleeding, tracing=False):
         data = None
         if bleeding:
             if run > 0x7F:
@@ -62,7 +117,8 @@ class EncoderV2(common.ImageEncoderBase):
                 data = struct.pack('2B', colour, run)
             else:
                 data = struct.pack('B', (run << 4) | colour)
-        logging.debug("  packed data = %r" % data)
+        if tracing:
+            trace("run", run=run, colour=colour, bleeding=bleeding, data=data.encode('hex'))
         return data
     
     def packRunInfoMaskV2(self, run, colour, last_bytes = False):
@@ -73,27 +129,27 @@ class EncoderV2(common.ImageEncoderBase):
             pending = run;
             while pending > 0:
                 if pending >= 0x7F:
-                    logging.debug("Writing out run info. run: %d, colour: %s" % (0x7F, colour))
+                    logging.debug("Writing out run info. run: %d, colour: %s", 0x7F, colour)
                     total_bytes += 2
                     array_bytes.extend([0xFF, colour])
                     pending -= 0x7F
                 elif last_bytes and pending == 2 and colour == 0x00:
-                    logging.debug("Writing out run info. run: %d, colour: %s" % (pending, colour))
+                    logging.debug("Writing out run info. run: %d, colour: %s", pending, colour)
                     logging.debug("Ignoring colour byte for coherence with original code")
                     total_bytes += 1
                     array_bytes.append(0x80 | pending)
                     pending = 0
                 else:
-                    logging.debug("Writing out run info. run: %d, colour: %s" % (pending, colour))
+                    logging.debug("Writing out run info. run: %d, colour: %s", pending, colour)
                     total_bytes += 2
                     array_bytes.extend([0x80 | pending, colour])
                     pending = 0
         else:
-            logging.debug("Writing out run info. run: %d, colour: %s" % (run, colour))
+            logging.debug("Writing out run info. run: %d, colour: %s", run, colour)
             total_bytes += 2
             array_bytes.extend([run, colour])
         data = struct.pack(str(total_bytes) + 'B', *array_bytes)
-        logging.debug("  packed data = %r" % data)
+        logging.debug("  packed data = %r", data)
         return data
     
     def packRunInfoMaskMultiSingleV2(self, colours):
@@ -105,47 +161,48 @@ class EncoderV2(common.ImageEncoderBase):
         current = 0;
         while pending > 0:
             if pending >= 0x7F:
-                logging.debug("Writing out singles info. singles: %d" % 0x7F)
+                logging.debug("Writing out singles info. singles: %d", 0x7F)
                 total_bytes += 1
                 array_bytes.append(0x7F)
                 for i in xrange(0x7F):
-                    logging.debug("\tcolour: %s" % colours[current+i])
+                    logging.debug("\tcolour: %s", colours[current+i])
                     total_bytes += 1
                     array_bytes.append(colours[current+i])
                 current += 0x7F
                 pending -= 0x7F
             else:
-                logging.debug("Writing out singles info. singles: %d" % run)
+                logging.debug("Writing out singles info. singles: %d", run)
                 total_bytes += 1
                 array_bytes.append(run)
                 for i in xrange(pending):
-                    logging.debug("\tcolour: %s" % colours[current+i])
+                    logging.debug("\tcolour: %s", colours[current+i])
                     total_bytes += 1
                     array_bytes.append(colours[current+i])
                 current += pending
                 pending = 0
         data = struct.pack(str(total_bytes) + 'B', *array_bytes)
-        logging.debug("  packed data = %r" % data)
+        logging.debug("  packed data = %r", data)
         return data
 
-    def writeBitmap(self, lflf_path, image_path, source_image, width, height, compression_method, freeze_palette, quantization):
-        img_file = file(self.getNewBitmapPath(lflf_path), 'wb')
-        source_data = source_image.getdata()
-        bleed_table = [None] * 128
+    def encodeImageData(self, source_data, width, height):
+        """ Encodes the image like the original encoder. Returns the encoded data."""
+        image_data = []
+        empty_bleed_table = [None] * height
+        bleed_table = empty_bleed_table[:]
         run = 0
         colour = None
         b = None
         bleeding = False
+        tracing = isTraceEnabled()
         for x in xrange(width):
             bleed_i = 0
-            logging.debug("Column: %d" % x)
 
             # Original encoded images seem to reset the bleed table every 8th column.
             # Presumably to aid in drawing "strips", which are 8 pixels wide.
             if not x % 8:
-                bleed_table = [None] * 128
-
-            logging.debug("Dither table: %s" % bleed_table)
+                bleed_table[:] = empty_bleed_table
+            if tracing:
+                trace("column", column=x, bleed_table=bleed_table)
 
             for y in xrange(height):
                 # Get the current pixel.
@@ -154,8 +211,8 @@ class EncoderV2(common.ImageEncoderBase):
                 #  It will revert to bleeding even if it interrupts a continuous run of colour.)
                 if not bleeding and b == bleed_table[bleed_i]:
                     if run:
-                        data = self.packRunInfoV2(run, colour, bleeding)
-                        img_file.write(data)
+                        data = self.packRunInfoV2(run, colour, bleeding, tracing)
+                        image_data.append(data)
                     bleeding = True
                     run = 1
                     colour = None
@@ -170,11 +227,12 @@ class EncoderV2(common.ImageEncoderBase):
                         bleed_table[bleed_i] = colour
                 # Current pixel is not the same as the last.
                 else:
-                    logging.debug("Ending run. b: %d. bleed_table value: %s" % (b, bleed_table[bleed_i]))
+                    if tracing:
+                        trace("end_run", pixel=b, bleed_colour=bleed_table[bleed_i])
                     # End the run, only if we have started one (e.g. the start of a column).
                     if run:
-                        data = self.packRunInfoV2(run, colour, bleeding)
-                        img_file.write(data)
+                        data = self.packRunInfoV2(run, colour, bleeding, tracing)
+                        image_data.append(data)
                     # Start a new run.
                     run = 1
                     # If the current pixel is the same as the bleed colour, engage bleeding mode.
@@ -185,14 +243,44 @@ class EncoderV2(common.ImageEncoderBase):
                         bleeding = False
                         colour = b
                         bleed_table[bleed_i] = colour
-                    logging.debug("Start of new run. colour: %s, bleeding: %s" % (colour, bleeding))
+                    if tracing:
+                        trace("start_run", colour=colour, bleeding=bleeding)
                 bleed_i += 1
 
-            logging.debug("---")
-
         # End the last run encountered, once we reach the end of the file.
-        data = self.packRunInfoV2(run, colour, bleeding)
+        data = self.packRunInfoV2(run, colour, bleeding, tracing)
+        image_data.append(data)
+        return ''.join(image_data)
+
+    def encodeImageDataSmallest(self, source_data, width, height):
+        """ Encodes the image in as few bytes as possible. Returns the encoded data."""
+        pixels = getColumnPixels(source_data, width, height)
+        tracing = isTraceEnabled()
+        image_data = []
+        i = 0
+        for bleeding, run in findSmallestRuns(pixels, height):
+            image_data.append(self.packRunInfoV2(run, pixels[i], bleeding, tracing))
+            i += run
+        return ''.join(image_data)
+
+    def writeImageData(self, img_file, source_data, width, height, compression_method=None):
+        """ compression_method: None to encode like the original encoder, or common.COMPRESSION_MAX
+                            for the smallest encoding (also logs how many bytes that saved).
+        Returns the size of the image data."""
+        if compression_method == common.COMPRESSION_MAX:
+            data = self.encodeImageDataSmallest(source_data, width, height)
+            common.logBytesSaved(len(data), len(self.encodeImageData(source_data, width, height)))
+        elif compression_method is None:
+            data = self.encodeImageData(source_data, width, height)
+        else:
+            raise ScummImageEncoderException("Unsupported compression method for v2: %s" % compression_method)
         img_file.write(data)
+        return len(data)
+
+    def writeBitmap(self, lflf_path, image_path, source_image, width, height, compression_method, freeze_palette, quantization):
+        img_file = file(self.getNewBitmapPath(lflf_path), 'wb')
+        source_data = source_image.getdata()
+        self.writeImageData(img_file, source_data, width, height, compression_method)
         img_file.close()
     
     def writeMask(self, mask_path, source_mask, width, height):
@@ -200,20 +288,11 @@ class EncoderV2(common.ImageEncoderBase):
         source_data = source_mask.getdata()
         
         logging.debug("Encoding mask image")
-        logging.debug("width: %d, height: %d" % (width, height))
+        logging.debug("width: %d, height: %d", width, height)
         if source_mask is not None:
             # We encode the mask
             small_width = width >> 3
-            mask_data = source_mask.getdata()
-            compact_data = [0] * small_width * height 
-            
-            for x in xrange(small_width):
-                for y in xrange(height):
-                    byte = 0x00
-                    for i in xrange(8):
-                        bit = mask_data[y * width + x*8+i] / 255
-                        byte = byte | (bit << 7-i)
-                    compact_data[y * small_width + x] = byte
+            compact_data = common.packMaskBits(source_mask, width, height)
             
             previous_value = None
             run = 0
@@ -222,17 +301,17 @@ class EncoderV2(common.ImageEncoderBase):
             single_values = []
             for x in xrange(small_width):
                 for y in xrange(height):
-                    b = compact_data[y * small_width + x]
+                    b = compact_data[x][y]
                     if previous_value is None:
                         run += 1
-                    elif b is not previous_value:
+                    elif b != previous_value:
                         if run == 1:
                             single_values.append(previous_value)
                         else:
                             data = self.packRunInfoMaskV2(run, previous_value)
                             img_file.write(data)
                         run = 1   
-                    elif b is previous_value: 
+                    elif b == previous_value: 
                         if run == 1 and len(single_values) > 0:
                             data = self.packRunInfoMaskMultiSingleV2(single_values)
                             img_file.write(data)
@@ -257,84 +336,14 @@ class EncoderV2(common.ImageEncoderBase):
     def writeObject(self, object_path, image_path, source_image, source_mask, width, height, compression_method, freeze_palette, quantization):
         img_file = file(object_path, 'wb')
         source_data = source_image.getdata()
-        bleed_table = [None] * height
-        run = 0
-        colour = None
-        b = None
-        bleeding = False
-        for x in xrange(width):
-            bleed_i = 0
-            logging.debug("Column: %d" % x)
-
-            # Original encoded images seem to reset the bleed table every 8th column.
-            # Presumably to aid in drawing "strips", which are 8 pixels wide.
-            if not x % 8:
-                bleed_table = [None] * height
-
-            logging.debug("Dither table: %s" % bleed_table)
-
-            for y in xrange(height):
-                # Get the current pixel.
-                b = source_data[y * width + x]
-                # Check if we can bleed. (The original encoder seems to favour bleeding over efficient run compression.
-                # It will revert to bleeding even if it interrupts a continuous run of colour.)
-                if not bleeding and b == bleed_table[bleed_i]:
-                    if run:
-                        data = self.packRunInfoV2(run, colour, bleeding)
-                        img_file.write(data)
-                    bleeding = True
-                    run = 1
-                    colour = None
-                # If the current pixel is the same, or we're currently bleeding and
-                # the bleed colour matches this pixel, increment run counter.
-                # Also need to check bounds - maximum value of a run is
-                # 0xFF.
-                elif run < 0xFF and \
-                   (b == colour or (bleeding and b == bleed_table[bleed_i])):
-                    run += 1
-                    if not bleeding:
-                        bleed_table[bleed_i] = colour
-                # Current pixel is not the same as the last.
-                else:
-                    logging.debug("Ending run. b: %d. bleed_table value: %s" % (b, bleed_table[bleed_i]))
-                    # End the run, only if we have started one (e.g. the start of a column).
-                    if run:
-                        data = self.packRunInfoV2(run, colour, bleeding)
-                        img_file.write(data)
-                    # Start a new run.
-                    run = 1
-                    # If the current pixel is the same as the bleed colour, engage bleeding mode.
-                    if b == bleed_table[bleed_i]:
-                        bleeding = True
-                        colour = None
-                    else:
-                        bleeding = False
-                        colour = b
-                        bleed_table[bleed_i] = colour
-                    logging.debug("Start of new run. colour: %s, bleeding: %s" % (colour, bleeding))
-                bleed_i += 1
-
-            logging.debug("---")
-
-        # End the last run encountered, once we reach the end of the file.
-        data = self.packRunInfoV2(run, colour, bleeding)
-        img_file.write(data)
+        self.writeImageData(img_file, source_data, width, height, compression_method)
         
         logging.debug("Encoding object mask")
-        logging.debug("width: %d, height: %d" % (width, height))
+        logging.debug("width: %d, height: %d", width, height)
         if source_mask is not None:
             # We encode the mask
             small_width = width >> 3
-            mask_data = source_mask.getdata()
-            compact_data = [0] * small_width * height 
-            
-            for x in xrange(small_width):
-                for y in xrange(height):
-                    byte = 0x00
-                    for i in xrange(8):
-                        bit = mask_data[y * width + x*8+i] / 255
-                        byte = byte | (bit << 7-i)
-                    compact_data[y * small_width + x] = byte
+            compact_data = common.packMaskBits(source_mask, width, height)
             
             previous_value = None
             run = 0
@@ -343,18 +352,18 @@ class EncoderV2(common.ImageEncoderBase):
             single_values = []
             for x in xrange(small_width):
                 for y in xrange(height):
-                    b = compact_data[y * small_width + x]
+                    b = compact_data[x][y]
                     if previous_value is None:
                         logging.debug("Initial pixel")
                         run += 1
-                    elif b is not previous_value:
+                    elif b != previous_value:
                         if run == 1:
                             single_values.append(previous_value)
                         else:
                             data = self.packRunInfoMaskV2(run, previous_value)
                             img_file.write(data)
                         run = 1   
-                    elif b is previous_value: 
+                    elif b == previous_value: 
                         if run == 1 and len(single_values) > 0:
                             data = self.packRunInfoMaskMultiSingleV2(single_values)
                             img_file.write(data)
@@ -3,6 +3,8 @@ import logging
 import os
 import struct
 from PIL import Image
+from sie.sie_util import ScummImageEncoderException
+from sie.trace import isTraceEnabled, trace
 
 UNDEFCOLOR = 125
 MODE_NONE = 0
@@ -10,16 +12,110 @@ MODE_COLOR_RUN = 1
 MODE_ALTERNATE = 2
 MODE_BLEED = 3
 
-class EncForm:
-    def __init__(self):
-        self.color1 = UNDEFCOLOR
-        self.color2 = UNDEFCOLOR
-        self.mode = MODE_NONE
-        self.length = 0
-        self.data = None
-        self.used_chars = 255
-        self.fin_width = 0
-        self.fin_height = 0
+# Longest runs that can be packed
+MAX_RUN = 0xFF
+
+def getChunkPixels(source_data, imWidth, imHeight, chunk_x):
+    """ The pixels of the chunk (8 columns) starting at column chunk_x, in the order they are encoded:
+    down each column in turn."""
+    chunk_end = min(chunk_x + 8, imWidth)
+    return [source_data[y * imWidth + x] for x in xrange(chunk_x, chunk_end) for y in xrange(imHeight)]
+
+def getRunLengths(pixels, imHeight):
+    """ Works out how far each kind of run could go from every position in a chunk,
+    in a single backwards pass. Runs stop at the end of the chunk. Returns 3 lists:
+    same   - the number of pixels with the same colour, starting at each position.
+    repeat - the number of pixels that match the pixel two positions on, starting at each position.
+             A run alternating between two colours covers these pixels, plus the last two.
+    copy   - the number of pixels that match the pixel to their left, starting at each position.
+             Always 0 in the first column of the chunk.
+    """
+    num_pixels = len(pixels)
+    same = [1] * num_pixels
+    repeat = [0] * num_pixels
+    copy = [0] * num_pixels
+    for i in xrange(num_pixels - 2, -1, -1):
+        colour = pixels[i]
+        if pixels[i + 1] == colour:
+            same[i] = same[i + 1] + 1
+        if i + 2 < num_pixels and pixels[i + 2] == colour:
+            repeat[i] = repeat[i + 1] + 1
+    for i in xrange(num_pixels - 1, imHeight - 1, -1):
+        if pixels[i - imHeight] == pixels[i]:
+            copy[i] = copy[i + 1] + 1 if i + 1 < num_pixels else 1
+    return same, repeat, copy
+
+def getRunOptions(pixels, i, same, repeat, copy):
+    """ The runs of each mode that could start at position i of a chunk, from the lists made by getRunLengths.
+    Returns a (length, used_chars) tuple for each of the same colour, alternating and copy modes.
+    As in the original encoder:
+    - An alternating run has length 1 if the next pixel has the same colour, and 0 if only the first two pixels
+      alternate. Either way it can't be used, and counts as 255 chars.
+    - A copy run has length 0 (and 255 chars) if it can't be used."""
+    run = min(same[i], MAX_RUN)
+    same_run = (run, 2 if run > 0x07 else 1)
+    if i + 1 == len(pixels):
+        alternate_run = (1, 2)
+    elif pixels[i + 1] == pixels[i]:
+        alternate_run = (1, 255)
+    else:
+        run = min(repeat[i] + 2, MAX_RUN)
+        if run == 2:
+            alternate_run = (0, 255)
+        else:
+            alternate_run = (run, 3 if run > 0x3F else 2)
+    run = min(copy[i], MAX_RUN)
+    if run:
+        copy_run = (run, 2 if run > 0x3F else 1)
+    else:
+        copy_run = (0, 255)
+    return same_run, alternate_run, copy_run
+
+def findSmallestRuns(pixels, imHeight):
+    """ Finds the runs that encode a chunk in the fewest bytes (see common.COMPRESSION_MAX).
+    Returns a list of (mode, run) tuples."""
+    same_lengths, repeat_lengths, copy_lengths = getRunLengths(pixels, imHeight)
+    num_pixels = len(pixels)
+    # For each position, the bytes needed to encode the rest of the chunk, and the first run to use.
+    cost = [0] * (num_pixels + 1)
+    choice = [None] * num_pixels
+    for i in xrange(num_pixels - 1, -1, -1):
+        remaining = num_pixels - i
+        # Same colour runs: 1 byte for up to 7 pixels, 2 bytes for up to 255.
+        run = min(same_lengths[i], MAX_RUN)
+        best_mode, best_run = MODE_COLOR_RUN, min(run, 0x07)
+        best = cost[i + best_run] + 1
+        if run > 0x07 and cost[i + run] + 2 < best:
+            best_run = run
+            best = cost[i + run] + 2
+        # Copy runs: 1 byte for up to 63 pixels, 2 bytes for up to 255.
+        run = min(copy_lengths[i], MAX_RUN)
+        if run:
+            short_run = min(run, 0x3F)
+            if cost[i + short_run] + 1 < best:
+                best_mode, best_run = MODE_BLEED, short_run
+                best = cost[i + short_run] + 1
+            if run > 0x3F and cost[i + run] + 2 < best:
+                best_mode, best_run = MODE_BLEED, run
+                best = cost[i + run] + 2
+        # Alternating runs: 2 bytes for up to 63 pixels, 3 bytes for up to 255.
+        run = min(repeat_lengths[i] + 2, remaining, MAX_RUN)
+        if run > 1:
+            short_run = min(run, 0x3F)
+            if cost[i + short_run] + 2 < best:
+                best_mode, best_run = MODE_ALTERNATE, short_run
+                best = cost[i + short_run] + 2
+            if run > 0x3F and cost[i + run] + 3 < best:
+                best_mode, best_run = MODE_ALTERNATE, run
+                best = cost[i + run] + 3
+        cost[i] = best
+        choice[i] = (best_mode, best_run)
+    runs = []
+    i = 0
+    while i < num_pixels:
+        runs.append(choice[i])
+        i += choice[i][1]
+    return runs
 
 class EncoderV3(common.ImageEncoderBase):
     def encodeImage(self, lflf_path, image_path, quantization, palette_num, freeze_palette, compression_method=None):
@@ -67,7 +163,6 @@ class EncoderV3(common.ImageEncoderBase):
             self.writeObject(object_path, image_path, source_image, source_mask, width, height, compression_method, freeze_palette, quantization)
     
     def packRunInfoV3(self, run, colour, colour_alt, mode):
-        logging.debug("Writing out run info. run: %d, colour1: %s, colour2: %s, mode: %s" % (run, colour, colour_alt, mode))
         data = None
         bytes = 0
         if mode == MODE_BLEED:
@@ -91,7 +186,6 @@ class EncoderV3(common.ImageEncoderBase):
             else:
                 data = struct.pack('B', (run << 4) | colour)
                 bytes = 1
-        logging.debug("  packed data = %r" % data)
         return data, bytes
     
     def packRunInfoMaskV3(self, run, colour, last_bytes = False):
@@ -163,250 +257,131 @@ class EncoderV3(common.ImageEncoderBase):
         logging.debug("  packed data = %r" % data)
         return data, total_bytes
 
-    def checkLengthOfSamePixelsWithinChunk(self, cur_width, cur_height, f1, imHeight, imWidth, source_data):
-        k = 0
-        j = 0
-
-        colorTmp = 0
-        nextColumnChunkBorder = 0
-        nextColumnChunkBorder = cur_width + 8 - (cur_width % 8)
-
-        colorTmp = source_data[cur_height * imWidth + cur_width]
-
-        f1.mode = MODE_COLOR_RUN
-        f1.color1 = colorTmp
-        f1.length = 1
-        f1.fin_width = cur_width
-        f1.fin_height = cur_height
-
-        k = cur_width
-        j = cur_height
-        while True:
-            j += 1
-            if j >= imHeight:
-                j = 0
-                k += 1
-                if k >= nextColumnChunkBorder or k >= imWidth:
-                    break
-
-            colorTmp = source_data[j * imWidth + k]
-
-            if colorTmp == f1.color1 and f1.length < 255:
-                f1.length += 1
-                f1.fin_width = k
-                f1.fin_height = j
-            else:
-                break
-
-        f1.data, f1.used_chars = self.packRunInfoV3(f1.length, f1.color1, None, f1.mode)
-            
-        return f1
-    
-    def checkLengthOfSwitchingPixelsWithinChunk(self, cur_width, cur_height, f2, imHeight, imWidth, source_data):
-        alterIdx = 0
-
-        colorTmp = 0
-        nextColumnChunkBorder = cur_width + 8 - (cur_width % 8)
-
-        colorTmp = source_data[cur_height * imWidth + cur_width]
-        
-        f2.mode = MODE_ALTERNATE
-        f2.color1 = colorTmp
-        f2.length = 1
-        f2.fin_width = cur_width
-        f2.fin_height = cur_height
-
-        k = cur_width
-        j = cur_height
-        alterIdx = 1;
-        
-        while True:
-            j += 1
-            if j >= imHeight:
-                j = 0
-                k += 1
-                if k >= nextColumnChunkBorder or k >= imWidth:
-                    break
-
-            colorTmp = source_data[j * imWidth + k]
-            
-            if f2.color2 == UNDEFCOLOR:
-                f2.color2 = colorTmp
-                if f2.color2 == f2.color1:
-                    return f2
-
-            if ((alterIdx % 2 == 1) and (colorTmp == f2.color2)) or ((alterIdx % 2 == 0) and (colorTmp == f2.color1) and f2.length < 255):
-                f2.length += 1
-                f2.fin_width = k
-                f2.fin_height = j
-            else:
-                break
-
-            alterIdx += 1
-
-        if f2.length == 2:
-            f2.length = 0
-            f2.fin_width = cur_width
-            f2.fin_height = cur_height
-            return f2
-
-        f2.data, f2.used_chars = self.packRunInfoV3(f2.length, f2.color1, f2.color2, f2.mode)
-
-        return f2
-        
-    def checkLengthOfCopyColumnPixelsWithinChunk(self, cur_width, cur_height, f3, imHeight, imWidth, source_data):
-        k = 0
-        j = 0
-        colorTmp1 = 0
-        colorTmp2 = 0
-
-        colorInPalIdx1 = 0
-        colorInPalIdx2 = 0
-
-        nextColumnChunkBorder = 0
-        if cur_width % 8 == 0:
-            return f3
-
-        nextColumnChunkBorder = cur_width + 8 - (cur_width % 8)
-
-        colorTmp1 = source_data[cur_height * imWidth + cur_width]
-        colorTmp2 = source_data[cur_height * imWidth + cur_width -1]
-        if colorTmp1 != colorTmp2:
-            return f3
-
-        f3.mode = MODE_BLEED
-        f3.length = 1
-        f3.fin_width = cur_width
-        f3.fin_height = cur_height
-
-        k = cur_width
-        j = cur_height
-        while True: #k < nextColumnChunkBorder:
-            j += 1
-            if j >= imHeight:
-                j = 0
-                #break
-                k += 1
-                if k >= nextColumnChunkBorder or k >= imWidth:
-                    break
-
-            colorTmp1 = source_data[j * imWidth + k]
-            colorTmp2 = source_data[j * imWidth + k - 1]
-            if colorTmp1 == colorTmp2 and f3.length < 255:
-                f3.length += 1
-                f3.fin_width = k
-                f3.fin_height = j
-            else:
-                break
-
-        f3.data, f3.used_chars = self.packRunInfoV3(f3.length, None, None, f3.mode)
-
-        return f3
-
-    def findMode(self, resultForm, eFofSamePix, eFofAlternativePix, eFofCopyColPix):
+    def findMode(self, same, alternate, copy):
+        """ Picks the longest of the three runs possible at a position, or the one that packs smallest if they tie.
+        Each run is a (length, used_chars) tuple. Returns the mode of the chosen run."""
+        same_len, same_chars = same
+        alt_len, alt_chars = alternate
+        copy_len, copy_chars = copy
         #If two are equal and greater than the third (3)
-        if (eFofSamePix.length == eFofAlternativePix.length) and (eFofSamePix.length > eFofCopyColPix.length):
-            # subcases for char_used (min is better):  
-            # - If both are equal (1)
-            # - If one of the two is less than the other (2)
-            if eFofSamePix.used_chars <= eFofAlternativePix.used_chars:
-                resultForm = eFofSamePix
-            elif eFofAlternativePix.used_chars < eFofSamePix.used_chars:
-                resultForm = eFofAlternativePix
-        elif (eFofSamePix.length == eFofCopyColPix.length) and (eFofSamePix.length > eFofAlternativePix.length):
+        if (same_len == alt_len) and (same_len > copy_len):
             # subcases for char_used (min is better):  
             # - If both are equal (1)
             # - If one of the two is less than the other (2)
-            if eFofSamePix.used_chars < eFofCopyColPix.used_chars:
-                resultForm = eFofSamePix
-            elif eFofCopyColPix.used_chars <= eFofSamePix.used_chars:
-                resultForm = eFofCopyColPix
-        elif (eFofCopyColPix.length == eFofAlternativePix.length) and (eFofCopyColPix.length > eFofSamePix.length):
-            # subcases for char_used (min is better):  
-            # - If both are equal (1)
-            # - If one of the two is less than the other (2)
-            if eFofCopyColPix.used_chars <= eFofAlternativePix.used_chars:
-                resultForm = eFofCopyColPix
-            elif eFofAlternativePix.used_chars < eFofCopyColPix.used_chars:
-                resultForm = eFofAlternativePix
+            if same_chars <= alt_chars:
+                return MODE_COLOR_RUN
+            return MODE_ALTERNATE
+        elif (same_len == copy_len) and (same_len > alt_len):
+            if same_chars < copy_chars:
+                return MODE_COLOR_RUN
+            return MODE_BLEED
+        elif (copy_len == alt_len) and (copy_len > same_len):
+            if copy_chars <= alt_chars:
+                return MODE_BLEED
+            return MODE_ALTERNATE
         # If one out of three is greater than all others (3)
-        elif (eFofSamePix.length > eFofAlternativePix.length) and (eFofSamePix.length > eFofCopyColPix.length):
-            resultForm = eFofSamePix
-        elif (eFofCopyColPix.length > eFofSamePix.length) and (eFofCopyColPix.length > eFofAlternativePix.length):
-            resultForm = eFofCopyColPix
-        elif (eFofAlternativePix.length > eFofCopyColPix.length) and (eFofAlternativePix.length > eFofSamePix.length):
-            resultForm = eFofAlternativePix
+        elif (same_len > alt_len) and (same_len > copy_len):
+            return MODE_COLOR_RUN
+        elif (copy_len > same_len) and (copy_len > alt_len):
+            return MODE_BLEED
+        elif (alt_len > copy_len) and (alt_len > same_len):
+            return MODE_ALTERNATE
         # If all three are equal (1) 
-        elif (eFofSamePix.length == eFofAlternativePix.length) and (eFofSamePix.length == eFofCopyColPix.length):
-            # subcases for char_used (min is better):
-            # If two are equals and less than the third one (3)
-            if (eFofSamePix.used_chars == eFofAlternativePix.used_chars) and (eFofSamePix.used_chars < eFofCopyColPix.used_chars):
-                resultForm = eFofSamePix
-            elif (eFofSamePix.used_chars == eFofCopyColPix.used_chars) and (eFofSamePix.used_chars < eFofAlternativePix.used_chars):
-                resultForm = eFofCopyColPix
-            elif (eFofCopyColPix.used_chars == eFofAlternativePix.used_chars) and (eFofCopyColPix.used_chars < eFofSamePix.used_chars):
-                resultForm = eFofCopyColPix
-            # If one out of the three is less than all the others (3)
-            elif (eFofSamePix.used_chars < eFofAlternativePix.used_chars) and (eFofSamePix.used_chars < eFofCopyColPix.used_chars):
-                resultForm = eFofSamePix
-            elif (eFofCopyColPix.used_chars < eFofSamePix.used_chars) and (eFofCopyColPix.used_chars < eFofAlternativePix.used_chars):
-                resultForm = eFofCopyColPix
-            elif (eFofAlternativePix.used_chars < eFofSamePix.used_chars) and (eFofAlternativePix.used_chars < eFofCopyColPix.used_chars):
-                resultForm = eFofAlternativePix
-            # If all three are equal (copy color selection) (1)
-            elif (eFofSamePix.used_chars == eFofAlternativePix.used_chars) and (eFofSamePix.used_chars == eFofCopyColPix.used_chars):
-                resultForm = eFofCopyColPix
-        return resultForm
-        
+        # subcases for char_used (min is better):
+        # If two are equals and less than the third one (3)
+        elif (same_chars == alt_chars) and (same_chars < copy_chars):
+            return MODE_COLOR_RUN
+        elif (same_chars == copy_chars) and (same_chars < alt_chars):
+            return MODE_BLEED
+        elif (copy_chars == alt_chars) and (copy_chars < same_chars):
+            return MODE_BLEED
+        # If one out of the three is less than all the others (3)
+        elif (same_chars < alt_chars) and (same_chars < copy_chars):
+            return MODE_COLOR_RUN
+        elif (copy_chars < same_chars) and (copy_chars < alt_chars):
+            return MODE_BLEED
+        elif (alt_chars < same_chars) and (alt_chars < copy_chars):
+            return MODE_ALTERNATE
+        # If all three are equal (copy color selection) (1)
+        return MODE_BLEED
+
+    def encodeChunk(self, pixels, imHeight):
+        """ Greedily encodes the pixels of a chunk, taking the longest run possible at each position."""
+        tracing = isTraceEnabled()
+        same_lengths, repeat_lengths, copy_lengths = getRunLengths(pixels, imHeight)
+        num_pixels = len(pixels)
+        data = []
+        i = 0
+        while i < num_pixels:
+            same, alternate, copy = getRunOptions(pixels, i, same_lengths, repeat_lengths, copy_lengths)
+            mode = self.findMode(same, alternate, copy)
+            if mode == MODE_COLOR_RUN:
+                run = same[0]
+                packed, used_chars = self.packRunInfoV3(run, pixels[i], None, mode)
+            elif mode == MODE_ALTERNATE:
+                run = alternate[0]
+                packed, used_chars = self.packRunInfoV3(run, pixels[i], pixels[i + 1], mode)
+            else:
+                run = copy[0]
+                packed, used_chars = self.packRunInfoV3(run, None, None, mode)
+            if tracing:
+                trace("run", position=i, mode=mode, run=run, data=packed.encode('hex'))
+            data.append(packed)
+            i += run
+        return ''.join(data)
+
+    def encodeChunkSmallest(self, pixels, imHeight):
+        """ Encodes the pixels of a chunk in as few bytes as possible."""
+        tracing = isTraceEnabled()
+        data = []
+        i = 0
+        for mode, run in findSmallestRuns(pixels, imHeight):
+            if mode == MODE_COLOR_RUN:
+                packed, used_chars = self.packRunInfoV3(run, pixels[i], None, mode)
+            elif mode == MODE_ALTERNATE:
+                packed, used_chars = self.packRunInfoV3(run, pixels[i], pixels[i + 1], mode)
+            else:
+                packed, used_chars = self.packRunInfoV3(run, None, None, mode)
+            if tracing:
+                trace("run", position=i, mode=mode, run=run, data=packed.encode('hex'))
+            data.append(packed)
+            i += run
+        return ''.join(data)
+
+    def writeImageData(self, img_file, source_data, imWidth, imHeight, compression_method=None):
+        """ Writes the size of the image data, the offset of each chunk (8 columns), then the chunks.
+        compression_method: None to encode like the original encoder, or common.COMPRESSION_MAX
+                            for the smallest encoding (also logs how many bytes that saved).
+        Returns the size."""
+        header_size = 2 + (imWidth/8) * 2
+        chunk_offsets = []
+        chunks = []
+        written = 0
+        greedy_written = 0
+        for chunk_x in xrange(0, imWidth, 8):
+            chunk_offsets.append(header_size + written)
+            pixels = getChunkPixels(source_data, imWidth, imHeight, chunk_x)
+            if compression_method == common.COMPRESSION_MAX:
+                chunk = self.encodeChunkSmallest(pixels, imHeight)
+                greedy_written += len(self.encodeChunk(pixels, imHeight))
+            elif compression_method is None:
+                chunk = self.encodeChunk(pixels, imHeight)
+            else:
+                raise ScummImageEncoderException("Unsupported compression method for v3: %s" % compression_method)
+            chunks.append(chunk)
+            written += len(chunk)
+        img_file.write(struct.pack('%dH' % (1 + len(chunk_offsets)), header_size + written, *chunk_offsets))
+        img_file.write(''.join(chunks))
+        if compression_method == common.COMPRESSION_MAX:
+            common.logBytesSaved(header_size + written, header_size + greedy_written)
+        return header_size + written
+
     def writeBitmap(self, lflf_path, image_path, source_image, imWidth, imHeight, compression_method, freeze_palette, quantization):
         img_file = file(self.getNewBitmapPath(lflf_path), 'wb')
         source_data = source_image.getdata()
         
         logging.debug("Encoding background image")
-        for i in range(1 + imWidth/8):
-            img_file.write(struct.pack('2B', 0x00, 0x00))
-        
-        writtenImageBytes = 0;
-        i = 0
-        j = 0
-        chnkIdx = 0
-
-        arrayOfChunkColIndexes = [0] * (imWidth/8)
-        arrayOfChunkColIndexes[chnkIdx] = 2 + (imWidth/8) * 2 + writtenImageBytes
-        chnkIdx += 1
-        while i < imWidth:
-            eFofCopyColPix = EncForm()
-            eFofSwitchingPix = EncForm()
-            eFofSamePix = EncForm()
-
-            eFofSamePix = self.checkLengthOfSamePixelsWithinChunk(i, j, eFofSamePix, imHeight, imWidth, source_data)
-            eFofSwitchingPix = self.checkLengthOfSwitchingPixelsWithinChunk(i, j, eFofSwitchingPix, imHeight, imWidth, source_data)
-            eFofCopyColPix = self.checkLengthOfCopyColumnPixelsWithinChunk(i, j, eFofCopyColPix, imHeight, imWidth, source_data)
-
-            resultForm = EncForm()
-            resultForm = self.findMode(resultForm, eFofSamePix, eFofSwitchingPix, eFofCopyColPix)
-            img_file.write(resultForm.data)
-            logging.debug("Chosen: %d" % resultForm.mode)
-
-            i = resultForm.fin_width
-            j = resultForm.fin_height + 1
-            writtenImageBytes += resultForm.used_chars
-            if j >= imHeight:
-                j = 0
-                i += 1
-                if i >= imWidth:
-                    break
-
-                if i % 8 == 0:
-                    arrayOfChunkColIndexes[chnkIdx] = 2 + (imWidth/8) * 2 + writtenImageBytes
-                    chnkIdx += 1
-
-        finalSize = 2 + (imWidth/8) * 2 + writtenImageBytes
-        img_file.seek(0, os.SEEK_SET)
-        img_file.write(struct.pack('H', finalSize))
-
-        for i in range(chnkIdx):
-            img_file.write(struct.pack('H', arrayOfChunkColIndexes[i]))
+        self.writeImageData(img_file, source_data, imWidth, imHeight, compression_method)
             
         img_file.close()
         
@@ -428,16 +403,7 @@ class EncoderV3(common.ImageEncoderBase):
         if source_mask is not None:
             # We encode the mask
             small_width = imWidth >> 3
-            mask_data = source_mask.getdata()
-            compact_data = [0] * small_width * imHeight 
-            
-            for x in xrange(small_width):
-                for y in xrange(imHeight):
-                    byte = 0x00
-                    for i in xrange(8):
-                        bit = mask_data[y * imWidth + x*8+i] / 255
-                        byte = byte | (bit << 7-i)
-                    compact_data[y * small_width + x] = byte
+            compact_data = common.packMaskBits(source_mask, imWidth, imHeight)
             
             previous_value = None
             run = 0
@@ -446,10 +412,10 @@ class EncoderV3(common.ImageEncoderBase):
             single_values = []
             for x in xrange(small_width):
                 for y in xrange(imHeight):
-                    b = compact_data[y * small_width + x]
+                    b = compact_data[x][y]
                     if previous_value is None:
                         run += 1
-                    elif b is not previous_value:
+                    elif b != previous_value:
                         if run == 1:
                             single_values.append(previous_value)
                         else:
@@ -457,7 +423,7 @@ class EncoderV3(common.ImageEncoderBase):
                             img_file.write(data)
                             writtenImageBytes += bytes
                         run = 1   
-                    elif b is previous_value: 
+                    elif b == previous_value: 
                         if run == 1 and len(single_values) > 0:
                             data, bytes = self.packRunInfoMaskMultiSingleV3(single_values)
                             img_file.write(data)
@@ -506,50 +472,7 @@ class EncoderV3(common.ImageEncoderBase):
         source_data = source_image.getdata()
         
         logging.debug("Encoding object image")
-        for i in range(1 + imWidth/8):
-            img_file.write(struct.pack('2B', 0x00, 0x00))
-        
-        writtenImageBytes = 0;
-        i = 0
-        j = 0
-        chnkIdx = 0
-
-        arrayOfChunkColIndexes = [0] * (imWidth/8)
-        arrayOfChunkColIndexes[chnkIdx] = 2 + (imWidth/8) * 2 + writtenImageBytes
-        chnkIdx += 1
-        while i < imWidth:
-            eFofCopyColPix = EncForm()
-            eFofSwitchingPix = EncForm()
-            eFofSamePix = EncForm()
-
-            eFofSamePix = self.checkLengthOfSamePixelsWithinChunk(i, j, eFofSamePix, imHeight, imWidth, source_data)
-            eFofSwitchingPix = self.checkLengthOfSwitchingPixelsWithinChunk(i, j, eFofSwitchingPix, imHeight, imWidth, source_data)
-            eFofCopyColPix = self.checkLengthOfCopyColumnPixelsWithinChunk(i, j, eFofCopyColPix, imHeight, imWidth, source_data)
-
-            resultForm = EncForm()
-            resultForm = self.findMode(resultForm, eFofSamePix, eFofSwitchingPix, eFofCopyColPix)
-            img_file.write(resultForm.data)
-            logging.debug("Chosen: %d" % resultForm.mode)
-
-            i = resultForm.fin_width
-            j = resultForm.fin_height + 1
-            writtenImageBytes += resultForm.used_chars
-            if j >= imHeight:
-                j = 0
-                i += 1
-                if i >= imWidth:
-                    break
-
-                if i % 8 == 0:
-                    arrayOfChunkColIndexes[chnkIdx] = 2 + (imWidth/8) * 2 + writtenImageBytes
-                    chnkIdx += 1
-
-        finalSize = 2 + (imWidth/8) * 2 + writtenImageBytes
-        img_file.seek(0, os.SEEK_SET)
-        img_file.write(struct.pack('H', finalSize))
-
-        for i in range(chnkIdx):
-            img_file.write(struct.pack('H', arrayOfChunkColIndexes[i]))
+        finalSize = self.writeImageData(img_file, source_data, imWidth, imHeight, compression_method)
             
         logging.debug("Encoding object mask")
         logging.debug("width: %d, height: %d" % (imWidth, imHeight))
@@ -567,16 +490,7 @@ class EncoderV3(common.ImageEncoderBase):
         if source_mask is not None:
             # We encode the mask
             small_width = imWidth >> 3
-            mask_data = source_mask.getdata()
-            compact_data = [0] * small_width * imHeight 
-            
-            for x in xrange(small_width):
-                for y in xrange(imHeight):
-                    byte = 0x00
-                    for i in xrange(8):
-                        bit = mask_data[y * imWidth + x*8+i] / 255
-                        byte = byte | (bit << 7-i)
-                    compact_data[y * small_width + x] = byte
+            compact_data = common.packMaskBits(source_mask, imWidth, imHeight)
             
             previous_value = None
             run = 0
@@ -585,10 +499,10 @@ class EncoderV3(common.ImageEncoderBase):
             single_values = []
             for x in xrange(small_width):
                 for y in xrange(imHeight):
-                    b = compact_data[y * small_width + x]
+                    b = compact_data[x][y]
                     if previous_value is None:
                         run += 1
-                    elif b is not previous_value:
+                    elif b != previous_value:
                         if run == 1:
                             single_values.append(previous_value)
                         else:
@@ -596,7 +510,7 @@ class EncoderV3(common.ImageEncoderBase):
                             img_file.write(data)
                             writtenImageBytes += bytes
                         run = 1   
-                    elif b is previous_value: 
+                    elif b == previous_value: 
                         if run == 1 and len(single_values) > 0:
                             data, bytes = self.packRunInfoMaskMultiSingleV3(single_values)
                             img_file.write(data)
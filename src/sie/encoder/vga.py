@@ -0,0 +1,285 @@
+import array
+import logging
+import struct
+from sie.sie_util import ScummImageEncoderException
+
+HORIZONTAL = 0
+VERTICAL = 1
+
+# Compression IDs. The compressed methods store the number of bits used for a
+#  palette index ("paramSub") in the ID itself - add paramSub to the base value.
+#  Only the opaque variants are listed, we never encode transparency.
+UNCOMPRESSED = 0x01
+METHOD_ONE_VERTICAL_BASE = 0x0A # 0x0E - 0x12
+METHOD_ONE_HORIZONTAL_BASE = 0x14 # 0x18 - 0x1C
+METHOD_TWO_BASE = 0x3C # 0x40 - 0x44
+
+MIN_PARAM_SUB = 4
+MAX_PARAM_SUB = 8
+
+# A method two "repeat" command costs 13 bits (2 + 3 + 8), so it only beats
+#  single "same colour" bits for runs of 14 pixels or more.
+METHOD_TWO_MIN_REPEAT = 14
+METHOD_TWO_MAX_REPEAT = 0xFF
+
+class BitStreamWriter(object):
+    """ Packs variable-width codes into bytes. SCUMM reads the bits of each byte
+    starting from the least significant bit, so the first bit of a code goes in
+    the lowest free bit."""
+    def __init__(self):
+        self.data = array.array('B')
+        self.acc = 0
+        self.num_bits = 0
+
+    def writeByte(self, value):
+        """ Only valid when the stream is byte-aligned (e.g. for the initial colour)."""
+        self.data.append(value)
+
+    def write(self, value, length):
+        self.acc |= value << self.num_bits
+        self.num_bits += length
+        while self.num_bits >= 8:
+            self.data.append(self.acc & 0xFF)
+            self.acc >>= 8
+            self.num_bits -= 8
+
+    def flush(self):
+        """ Pads the last byte with zeros and returns the data."""
+        if self.num_bits:
+            self.data.append(self.acc & 0xFF)
+            self.acc = 0
+            self.num_bits = 0
+        return self.data
+
+def getStripPixels(bitdata, width, height, stripNum, rendDir, palette_offset=0):
+    """ Returns the pixels of an 8 pixel wide strip, in the order they will be drawn."""
+    x_start = stripNum * 8
+    if rendDir == HORIZONTAL:
+        pixels = []
+        for y in xrange(height):
+            row_start = y * width + x_start
+            pixels.extend(bitdata[row_start:row_start + 8])
+    else:
+        pixels = [bitdata[y * width + x]
+                  for x in xrange(x_start, x_start + 8)
+                  for y in xrange(height)]
+    if palette_offset:
+        pixels = [p + palette_offset for p in pixels]
+    return pixels
+
+def encodeUncompressed(pixels):
+    return array.array('B', pixels)
+
+def encodeMethodOne(pixels, paramSub, max_size=None):
+    """
+    Codes, following the first (full byte) colour:
+     0                  - same colour as the last pixel
+     10 + paramSub bits - new colour
+     110                - add the current increment (starts at -1) to the colour
+     111                - negate the increment, then add it to the colour
+    Returns None if a colour needs a palette index that doesn't fit in paramSub bits,
+    or as soon as the output reaches max_size bytes.
+    """
+    max_colour = (1 << paramSub) - 1
+    out = BitStreamWriter()
+    colour = pixels[0]
+    out.writeByte(colour)
+    inc = -1
+    for p in pixels[1:]:
+        if p == colour:
+            out.write(0x0, 1)
+        elif p == colour + inc:
+            out.write(0x3, 3)
+        elif p == colour - inc:
+            inc = -inc
+            out.write(0x7, 3)
+        elif p <= max_colour:
+            inc = -1
+            out.write(0x1 | (p << 2), 2 + paramSub)
+        else:
+            return None
+        if max_size is not None and len(out.data) >= max_size:
+            return None
+        colour = p
+    return checkSize(out.flush(), max_size)
+
+def encodeMethodTwo(pixels, paramSub, max_size=None):
+    """
+    Codes, following the first (full byte) colour:
+     0                  - same colour as the last pixel
+     10 + paramSub bits - new colour
+     11 + 3 bits        - add (value - 4) to the colour, for values other than 4
+     11 + 100 + 8 bits  - repeat the current colour for the next n pixels
+    Returns None if a colour needs a palette index that doesn't fit in paramSub bits,
+    or as soon as the output reaches max_size bytes.
+    """
+    max_colour = (1 << paramSub) - 1
+    out = BitStreamWriter()
+    colour = pixels[0]
+    out.writeByte(colour)
+    num_pixels = len(pixels)
+    i = 1
+    while i < num_pixels:
+        p = pixels[i]
+        if p == colour:
+            run = 1
+            while i + run < num_pixels and pixels[i + run] == colour:
+                run += 1
+            i += run
+            while run >= METHOD_TWO_MIN_REPEAT:
+                repeat = min(run, METHOD_TWO_MAX_REPEAT)
+                out.write(0x3 | (0x4 << 2) | (repeat << 5), 13)
+                run -= repeat
+            if run:
+                out.write(0x0, run)
+            if max_size is not None and len(out.data) >= max_size:
+                return None
+            continue
+        delta = p - colour
+        if -4 <= delta <= 3:
+            out.write(0x3 | ((delta + 4) << 2), 5)
+        elif p <= max_colour:
+            out.write(0x1 | (p << 2), 2 + paramSub)
+        else:
+            return None
+        if max_size is not None and len(out.data) >= max_size:
+            return None
+        colour = p
+        i += 1
+    return checkSize(out.flush(), max_size)
+
+def checkSize(data, max_size):
+    if max_size is not None and len(data) >= max_size:
+        return None
+    return data
+
+def getCompressionParams(compID):
+    """ Returns the method, paramSub and render direction for a compression ID that we can encode."""
+    if compID == UNCOMPRESSED:
+        return 0, 0, HORIZONTAL
+    paramSub = compID - METHOD_ONE_VERTICAL_BASE
+    if MIN_PARAM_SUB <= paramSub <= MAX_PARAM_SUB:
+        return 1, paramSub, VERTICAL
+    paramSub = compID - METHOD_ONE_HORIZONTAL_BASE
+    if MIN_PARAM_SUB <= paramSub <= MAX_PARAM_SUB:
+        return 1, paramSub, HORIZONTAL
+    paramSub = compID - METHOD_TWO_BASE
+    if MIN_PARAM_SUB <= paramSub <= MAX_PARAM_SUB:
+        return 2, paramSub, HORIZONTAL
+    raise ScummImageEncoderException("Unsupported compression method for encoding: %d" % compID)
+
+def getMinParamSub(pixels):
+    """ The smallest palette index size that can hold every colour in the strip."""
+    max_colour = max(pixels)
+    paramSub = MIN_PARAM_SUB
+    while paramSub < MAX_PARAM_SUB and max_colour >> paramSub:
+        paramSub += 1
+    return paramSub
+
+def getCompressionName(compID):
+    compMethod, paramSub, rendDir = getCompressionParams(compID)
+    if compMethod == 0:
+        return "uncompressed"
+    return "method %d, %s, paramSub %d" % (compMethod,
+                                           "horizontal" if rendDir == HORIZONTAL else "vertical",
+                                           paramSub)
+
+def getCandidateCompressionIds(max_param_sub=MAX_PARAM_SUB):
+    """ Every compressed ID we can encode, in the order they are tried."""
+    ids = []
+    for paramSub in xrange(MIN_PARAM_SUB, max_param_sub + 1):
+        ids.extend([METHOD_TWO_BASE + paramSub,
+                    METHOD_ONE_HORIZONTAL_BASE + paramSub,
+                    METHOD_ONE_VERTICAL_BASE + paramSub])
+    return ids
+
+def encodeStrip(bitdata, width, height, stripNum, palette_offset, compID):
+    """ Encodes a strip with the given compression ID. Returns None if the strip can't be represented."""
+    compMethod, paramSub, rendDir = getCompressionParams(compID)
+    pixels = getStripPixels(bitdata, width, height, stripNum, rendDir, palette_offset)
+    if compMethod == 0:
+        return encodeUncompressed(pixels)
+    elif compMethod == 1:
+        return encodeMethodOne(pixels, paramSub)
+    return encodeMethodTwo(pixels, paramSub)
+
+def findBestStripEncoding(bitdata, width, height, stripNum, palette_offset):
+    """ Trial-encodes the strip with every compressed ID and keeps the smallest result.
+    Each trial is abandoned as soon as it reaches the size of the best one so far,
+    starting with the size of an uncompressed strip (which is used if nothing beats it).
+    IDs with a paramSub bigger than needed to store every colour in the strip are skipped,
+    since they can only produce longer palette indexes.
+    Returns the compression ID and the encoded data."""
+    pixels = {
+        HORIZONTAL : getStripPixels(bitdata, width, height, stripNum, HORIZONTAL, palette_offset),
+        VERTICAL : getStripPixels(bitdata, width, height, stripNum, VERTICAL, palette_offset)
+    }
+    best_id = UNCOMPRESSED
+    best_data = encodeUncompressed(pixels[HORIZONTAL])
+    for compID in getCandidateCompressionIds(getMinParamSub(pixels[HORIZONTAL])):
+        compMethod, paramSub, rendDir = getCompressionParams(compID)
+        if compMethod == 1:
+            data = encodeMethodOne(pixels[rendDir], paramSub, len(best_data))
+        else:
+            data = encodeMethodTwo(pixels[rendDir], paramSub, len(best_data))
+        # Anything that wasn't abandoned is smaller than the current best.
+        if data is not None:
+            best_id = compID
+            best_data = data
+    return best_id, best_data
+
+def encodeVgaStrips(bitdata, width, height, palette_offset=0, compression_method=None):
+    """ Returns a list of (compression ID, encoded data) tuples, one per strip.
+    compression_method: None to pick the best compression for each strip,
+                        or a compression ID to use for every strip."""
+    strips = []
+    for stripNum in xrange(width / 8):
+        if compression_method is None:
+            compID, data = findBestStripEncoding(bitdata, width, height, stripNum, palette_offset)
+        else:
+            compID = compression_method
+            data = encodeStrip(bitdata, width, height, stripNum, palette_offset, compID)
+            if data is None:
+                raise ScummImageEncoderException("Strip %d can't be encoded with compression method %d - "
+                                                 "it uses a colour that doesn't fit in the palette index size." % (stripNum, compID))
+        strips.append((compID, data))
+    return strips
+
+def getStripReport(strips, height):
+    """ Returns a list of lines, describing the compression chosen for each strip and its size in bytes."""
+    uncompressed_size = height * 8 + 1
+    lines = []
+    total = 0
+    for stripNum, (compID, data) in enumerate(strips):
+        size = len(data) + 1 # add one for compression ID
+        total += size
+        lines.append("Strip %3d: 0x%02X (%s) - %d bytes (%.1f%% of uncompressed)" %
+                     (stripNum, compID, getCompressionName(compID), size, 100.0 * size / uncompressed_size))
+    if strips:
+        lines.append("Total strip data: %d bytes (%.1f%% of uncompressed)" %
+                     (total, 100.0 * total / (uncompressed_size * len(strips))))
+    return lines
+
+def buildSmap(strips):
+    """ Returns a complete SMAP block, as a string."""
+    numStrips = len(strips)
+    # Strip offsets are from the start of the block, which includes the 8 byte header.
+    offsets = []
+    currStripOffsetValue = 8 + numStrips * 4 # each offset is a DWord
+    for compID, data in strips:
+        offsets.append(currStripOffsetValue)
+        currStripOffsetValue += len(data) + 1 # add one for compression ID
+    blocksize = currStripOffsetValue
+
+    smap = ['SMAP', struct.pack('>I', blocksize), struct.pack('<%dI' % numStrips, *offsets)]
+    for compID, data in strips:
+        smap.append(chr(compID))
+        smap.append(data.tostring())
+    return ''.join(smap)
+
+def encodeVgaBitmap(bitdata, width, height, palette_offset=0, compression_method=None):
+    """ Returns a complete SMAP block, as a string. See encodeVgaStrips for the arguments."""
+    strips = encodeVgaStrips(bitdata, width, height, palette_offset, compression_method)
+    for line in getStripReport(strips, height):
+        logging.info(line)
+    return buildSmap(strips)
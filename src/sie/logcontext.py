@@ -0,0 +1,46 @@
+import logging
+import os
+
+LOG_FORMAT = "%(asctime)s - %(job)s[%(process)d] - %(levelname)s - %(message)s"
+
+# The job being worked on by this process, e.g. the LFLF being decoded.
+_job = "-"
+
+class JobContextFilter(logging.Filter):
+    """ Adds the current job to each record, as "job"."""
+    def filter(self, record):
+        record.job = _job
+        return True
+
+def getJob():
+    return _job
+
+def setJob(job):
+    """ Sets the job shown in this process's log records. Returns the previous job."""
+    global _job
+    previous = _job
+    _job = job
+    return previous
+
+def getJobLogPath(log_path, job):
+    """ Fills in "{job}" and "{pid}" in a log file path, so each job or process can have its own file."""
+    return log_path.replace("{job}", job).replace("{pid}", str(os.getpid()))
+
+def configureLogging(level=logging.WARNING, log_path=None, job="-"):
+    """ Logs to log_path (appending, so concurrent jobs don't overwrite each other's logs),
+    or nowhere if log_path is None."""
+    setJob(job)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    if log_path is None:
+        handler = logging.NullHandler()
+        level = logging.CRITICAL + 1 # don't even create the records
+    else:
+        handler = logging.FileHandler(getJobLogPath(log_path, job), 'a')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(JobContextFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
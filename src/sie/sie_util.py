@@ -1,6 +1,7 @@
 import array
 import logging
 import os
+import numpy as np
 
 decryptvalue = 0x69
 
@@ -17,8 +18,99 @@ def makeDirs(file_path):
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
+class Bitmap(object):
+    """ An image with one byte per pixel (a palette index, or a mask value), stored
+    row by row in a NumPy uint8 array. Indexing the bitmap itself works on the flat
+    pixel data (index = y * width + x); rows gives a (height, width) view of the same data."""
+    def __init__(self, width, height, data=None):
+        self.width = width
+        self.height = height
+        if data is None:
+            data = np.zeros(width * height, np.uint8)
+        self.data = data
+        self.rows = data.reshape(height, width)
+
+    def getStrip(self, stripNum):
+        """ A (height, 8) view of an 8 pixel wide strip."""
+        return self.rows[:, stripNum * 8:stripNum * 8 + 8]
+
+    def getStrips(self, stripNum, numStrips):
+        """ A (height, numStrips * 8) view of several consecutive strips."""
+        return self.rows[:, stripNum * 8:(stripNum + numStrips) * 8]
+
+    def getColumn(self, x):
+        """ A (height,) view of a single column of pixels."""
+        return self.rows[:, x]
+
+    def crop(self, x, width):
+        """ Returns a new bitmap holding a copy of the columns from x to x + width."""
+        return Bitmap(width, self.height, self.rows[:, x:x + width].flatten())
+
+    def tostring(self):
+        return self.data.tostring()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data.tolist())
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            other = other.data
+        return len(self.data) == len(other) and np.array_equal(self.data, np.asarray(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # Pickle the pixel data once - rows is just a view of it.
+        return (Bitmap, (self.width, self.height, self.data))
+
+    def __repr__(self):
+        return "Bitmap(%d, %d, %r)" % (self.width, self.height, self.data.tolist())
+
+class PackedBitmap(object):
+    """ A 1 bit per pixel image (a mask), with 8 pixels in each byte and the leftmost pixel in the top bit,
+    stored row by row in a NumPy uint8 array. rows gives a (height, width / 8) view of the same data."""
+    def __init__(self, width, height, data=None):
+        self.width = width
+        self.height = height
+        if data is None:
+            data = np.zeros(width / 8 * height, np.uint8)
+        self.data = data
+        self.rows = data.reshape(height, width / 8)
+
+    def unpack(self):
+        """ Returns a Bitmap with one byte per pixel: 0 or 1."""
+        return Bitmap(self.width, self.height, np.unpackbits(self.rows, axis=1).reshape(-1))
+
+    def tostring(self):
+        return self.data.tostring()
+
+    def __reduce__(self):
+        return (PackedBitmap, (self.width, self.height, self.data))
+
+    def __repr__(self):
+        return "PackedBitmap(%d, %d, %r)" % (self.width, self.height, self.data.tolist())
+
 def initBitmapData(width, height):
-    return array.array('B', [0] * (width * height))
+    return Bitmap(width, height)
+
+def readSmapData(smap):
+    """ Returns image data (e.g. an SMAP block) as a bytearray. smap can be an open file (or anything else
+    with a read method), or the data's bytes (a string, bytearray or buffer)."""
+    if hasattr(smap, 'read'):
+        return bytearray(smap.read())
+    if isinstance(smap, bytearray):
+        return smap
+    return bytearray(smap)
 
 def indent_elementtree(elem, level=0):
     """ This function taken from http://effbot.org/zone/element-lib.htm#prettyprint.
@@ -0,0 +1,58 @@
+import json
+import logging
+
+# Trace records go to their own logger, which stays off (even when everything
+#  else logs at DEBUG level) until enableTrace is called.
+logger = logging.getLogger("sie.trace")
+logger.setLevel(logging.INFO)
+
+class TraceEvent(object):
+    """ A trace message. It's only formatted if a handler writes it out."""
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return "%s: %s" % (self.event, ", ".join("%s=%s" % (k, v) for k, v in sorted(self.fields.iteritems())))
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Writes each record as a single line of JSON."""
+    def format(self, record):
+        if isinstance(record.msg, TraceEvent):
+            data = dict(record.msg.fields)
+            data["event"] = record.msg.event
+        else:
+            data = {"event" : "log", "level" : record.levelname, "message" : record.getMessage()}
+        data["time"] = record.created
+        return json.dumps(data, sort_keys=True, default=str)
+
+def isTraceEnabled():
+    """ Check this once per call, then guard each trace call in loops with it:
+    tracing = isTraceEnabled()
+    ...
+        if tracing:
+            trace("run", run=run, colour=colour)
+    """
+    return logger.isEnabledFor(logging.DEBUG)
+
+def trace(event, **fields):
+    logger.debug(TraceEvent(event, fields))
+
+def enableTrace(json_path=None):
+    """ Turns on tracing. Records go to the root logger's handlers,
+    or only to json_path (one JSON object per line) if it's given."""
+    logger.setLevel(logging.DEBUG)
+    if json_path:
+        handler = logging.FileHandler(json_path, 'w')
+        handler.setFormatter(JsonLinesFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+
+def disableTrace():
+    logger.setLevel(logging.INFO)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    logger.propagate = True
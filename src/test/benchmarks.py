@@ -0,0 +1,395 @@
+#! /usr/bin/python
+
+import array
+import io
+import logging
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import numpy as np
+from PIL import Image
+import sie.classconfigs
+import sie.decoder
+import sie.decoder.c64
+import sie.decoder.ega
+import sie.decoder.vga
+import sie.encoder.v1
+import sie.encoder.v2
+import sie.encoder.v3
+from sie.encoder.common import COMPRESSION_MAX
+import sie.encoder.vga
+import sie.trace
+
+# Rooms from the test resources: (LFLF path, width, height)
+VGA_ROOMS = [
+    (os.path.join("v5", "res", "LFLF_001"), 320, 200),
+    (os.path.join("v6", "res", "LFLF_001"), 784, 200),
+    (os.path.join("v6", "res", "LFLF_002"), 320, 200),
+    (os.path.join("v6", "res", "LFLF_046"), 480, 144)
+]
+
+def getSmapPath(lflf_path):
+    return os.path.join(lflf_path, "ROOM", "RMIM", "IM00", "SMAP.dmp")
+
+def timeCall(func, repeat):
+    """ Returns the best time of several runs, in seconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def benchmarkVgaDecode(repeat):
+    for lflf_path, width, height in VGA_ROOMS:
+        smap_path = getSmapPath(lflf_path)
+        func = lambda: sie.decoder.vga.decodeVgaBitmap(file(smap_path, 'rb'), width, height)
+        taken = timeCall(func, repeat)
+        logging.info("%-20s %4dx%-4d %8.1f ms %8.2f Mpixels/s" %
+                     (lflf_path, width, height, taken * 1000, width * height / taken / 1000000))
+
+def benchmarkVgaDecodeBytes(repeat):
+    """ Decoding from an SMAP block that is already in memory."""
+    for lflf_path, width, height in VGA_ROOMS:
+        smap_data = file(getSmapPath(lflf_path), 'rb').read()
+        func = lambda: sie.decoder.vga.decodeVgaBitmap(smap_data, width, height)
+        taken = timeCall(func, repeat)
+        logging.info("%-20s %4dx%-4d %8.1f ms %8.2f Mpixels/s" %
+                     (lflf_path, width, height, taken * 1000, width * height / taken / 1000000))
+
+def makeWideSmap(smap_path, width, height, copies):
+    """ Builds an SMAP block that repeats every strip of an existing room, to get a very wide room."""
+    data = bytearray(file(smap_path, 'rb').read())
+    strips = []
+    for start, limit in sie.decoder.vga.getStripBounds(data, width / 8):
+        strips.append((data[start], array.array('B', str(data[start + 1:limit]))))
+    return sie.encoder.vga.buildSmap(strips * copies)
+
+def benchmarkVgaDecodeUncompressed(repeat):
+    """ Rooms re-encoded with uncompressed strips only."""
+    for lflf_path, width, height in VGA_ROOMS:
+        bitdata = list(sie.decoder.vga.decodeVgaBitmap(file(getSmapPath(lflf_path), 'rb'), width, height))
+        strips = sie.encoder.vga.encodeVgaStrips(bitdata, width, height, compression_method=sie.encoder.vga.UNCOMPRESSED)
+        smap_data = sie.encoder.vga.buildSmap(strips)
+        func = lambda: sie.decoder.vga.decodeVgaBitmap(smap_data, width, height)
+        taken = timeCall(func, repeat)
+        logging.info("%-20s %4dx%-4d %8.1f ms %8.2f Mpixels/s" %
+                     (lflf_path, width, height, taken * 1000, width * height / taken / 1000000))
+
+def benchmarkVgaDecodeJobs(repeat):
+    """ Decoding a very wide room in a process pool. The room has compressed strips,
+    so there is enough decoding to share out."""
+    lflf_path, width, height = VGA_ROOMS[3]
+    copies = 8
+    smap_data = makeWideSmap(getSmapPath(lflf_path), width, height, copies)
+    width *= copies
+    for jobs in (1, 2, 4, 8):
+        func = lambda: sie.decoder.vga.decodeVgaBitmap(smap_data, width, height, jobs)
+        taken = timeCall(func, repeat)
+        logging.info("%4dx%-4d jobs %d %8.1f ms %8.2f Mpixels/s" %
+                     (width, height, jobs, taken * 1000, width * height / taken / 1000000))
+
+def benchmarkVgaViewport(repeat):
+    """ Decoding a 320 pixel wide viewport, compared to the whole room."""
+    lflf_path, width, height = VGA_ROOMS[1]
+    smap_path = getSmapPath(lflf_path)
+    func = lambda: sie.decoder.vga.decodeVgaBitmap(file(smap_path, 'rb'), width, height)
+    logging.info("%4dx%-4d whole room      %8.1f ms" % (width, height, timeCall(func, repeat) * 1000))
+    for x in (0, width - 320):
+        func = lambda: sie.decoder.vga.decodeVgaViewport(file(smap_path, 'rb'), width, height, x, 320)
+        logging.info("%4dx%-4d viewport x=%-4d %8.1f ms" % (width, height, x, timeCall(func, repeat) * 1000))
+
+    copies = 4
+    smap_data = makeWideSmap(smap_path, width, height, copies)
+    width *= copies
+    func = lambda: sie.decoder.vga.decodeVgaBitmap(smap_data, width, height)
+    logging.info("%4dx%-4d whole room      %8.1f ms" % (width, height, timeCall(func, repeat) * 1000))
+    func = lambda: sie.decoder.vga.decodeVgaViewport(smap_data, width, height, width / 2, 320)
+    logging.info("%4dx%-4d viewport x=%-4d %8.1f ms" % (width, height, width / 2, timeCall(func, repeat) * 1000))
+
+def benchmarkDecodeImage(repeat):
+    """ Whole decodes, from the LFLF files to a PNG."""
+    rooms = [(os.path.join("v1", "res", "LFv1_001"), 1)] + [(lflf_path, 5 if lflf_path.startswith("v5") else 6)
+                                                             for lflf_path, width, height in VGA_ROOMS]
+    out_dir = tempfile.mkdtemp()
+    try:
+        for lflf_path, version in rooms:
+            image_path = os.path.join(out_dir, "image.png")
+            func = lambda: sie.decoder.decodeImage(lflf_path, image_path, version, 1)
+            logging.info("%-20s v%d png    %8.1f ms" % (lflf_path, version, timeCall(func, repeat) * 1000))
+            func = lambda: sie.decoder.decodeBitmap(lflf_path, version, 1)
+            logging.info("%-20s v%d bitmap %8.1f ms" % (lflf_path, version, timeCall(func, repeat) * 1000))
+    finally:
+        shutil.rmtree(out_dir)
+
+def benchmarkOutputFormats(repeat):
+    """ Whole decodes of the widest room, with each output format."""
+    lflf_path, width, height = VGA_ROOMS[1]
+    formats = [(sie.decoder.PNG, None), (sie.decoder.PNG, 0), (sie.decoder.PNG, 1), (sie.decoder.PNG, 6),
+               (sie.decoder.PNG, 9), (sie.decoder.RAW, None), (sie.decoder.NPY, None), (sie.decoder.MEMORY, None)]
+    out_dir = tempfile.mkdtemp()
+    try:
+        for output_format, level in formats:
+            image_path = os.path.join(out_dir, "image.png")
+            func = lambda: sie.decoder.decodeImage(lflf_path, image_path, 6, 1, output_format=output_format, png_compress_level=level)
+            taken = timeCall(func, repeat)
+            size = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+            logging.info("%4dx%-4d %-6s level %-4s %8.1f ms %8d bytes" %
+                         (width, height, output_format, "-" if level is None else level, taken * 1000, size))
+            for name in os.listdir(out_dir):
+                os.remove(os.path.join(out_dir, name))
+    finally:
+        shutil.rmtree(out_dir)
+
+def benchmarkEgaTrace(repeat):
+    """ v2 decodes with tracing off, and with tracing written to a JSON lines file."""
+    lflf_path = os.path.join("v2", "res", "LFv2_001")
+    func = lambda: sie.decoder.decodeBitmap(lflf_path, 2, 1)
+    logging.info("%-20s trace off  %8.1f ms" % (lflf_path, timeCall(func, repeat) * 1000))
+    out_dir = tempfile.mkdtemp()
+    try:
+        sie.trace.enableTrace(os.path.join(out_dir, "trace.json"))
+        try:
+            logging.info("%-20s trace json %8.1f ms" % (lflf_path, timeCall(func, repeat) * 1000))
+        finally:
+            sie.trace.disableTrace()
+    finally:
+        shutil.rmtree(out_dir)
+
+def makeV3Bitmap(bmp, out_dir, compression_method=None):
+    """ Encodes a bitmap as a v3 background image. Returns the path of the image file."""
+    source_image = Image.frombuffer('P', (bmp.width, bmp.height), bmp.data, 'raw', 'P', 0, 1)
+    encoder = sie.encoder.v3.EncoderV3(sie.classconfigs.ConfigV3)
+    encoder.writeBitmap(out_dir, None, source_image, bmp.width, bmp.height, compression_method, False, 16)
+    return encoder.getBitmapPath(out_dir)
+
+def benchmarkEgaDecode(repeat):
+    """ v2 and v3 background images. The v3 image is the v2 test room, re-encoded."""
+    lflf_path = os.path.join("v2", "res", "LFv2_001")
+    bmp, pal = sie.decoder.decodeBitmap(lflf_path, 2, 1)
+    out_dir = tempfile.mkdtemp()
+    try:
+        bitmap_paths = [("v2", sie.decoder.ega.decodeV2Bitmap, os.path.join(lflf_path, "ROv2", "IMv2")),
+                        ("v3", sie.decoder.ega.decodeV3Bitmap, makeV3Bitmap(bmp, out_dir))]
+        for version, decode, bitmap_path in bitmap_paths:
+            func = lambda: decode(file(bitmap_path, 'rb'), bmp.width, bmp.height)
+            taken = timeCall(func, repeat)
+            logging.info("%s %4dx%-4d %8.1f ms %8.2f Mpixels/s" %
+                         (version, bmp.width, bmp.height, taken * 1000, bmp.width * bmp.height / taken / 1000000))
+    finally:
+        shutil.rmtree(out_dir)
+
+def benchmarkV2Encode(repeat):
+    """ Re-encoding the v2 test room, with the default and max compression."""
+    bmp, pal = sie.decoder.decodeBitmap(os.path.join("v2", "res", "LFv2_001"), 2, 1)
+    source_data = bmp.data.tolist()
+    encoder = sie.encoder.v2.EncoderV2(sie.classconfigs.ConfigV2)
+    for name, compression_method in [("default", None), ("max", COMPRESSION_MAX)]:
+        func = lambda: encoder.writeImageData(io.BytesIO(), source_data, bmp.width, bmp.height, compression_method)
+        logging.disable(logging.INFO) # the encoder's report of the bytes saved
+        try:
+            taken = timeCall(func, repeat)
+            size = func()
+        finally:
+            logging.disable(logging.NOTSET)
+        logging.info("%-8s %4dx%-4d %8.1f ms %8.2f Mpixels/s %6d bytes" %
+                     (name, bmp.width, bmp.height, taken * 1000, bmp.width * bmp.height / taken / 1000000, size))
+
+def benchmarkV3Encode(repeat):
+    """ Encoding the v2 test room as a v3 background image, with the default and max compression."""
+    bmp, pal = sie.decoder.decodeBitmap(os.path.join("v2", "res", "LFv2_001"), 2, 1)
+    out_dir = tempfile.mkdtemp()
+    try:
+        for name, compression_method in [("default", None), ("max", COMPRESSION_MAX)]:
+            func = lambda: makeV3Bitmap(bmp, out_dir, compression_method)
+            logging.disable(logging.INFO) # the encoder's report of the bytes saved
+            try:
+                taken = timeCall(func, repeat)
+                size = os.path.getsize(func())
+            finally:
+                logging.disable(logging.NOTSET)
+            logging.info("%-8s %4dx%-4d %8.1f ms %8.2f Mpixels/s %6d bytes" %
+                         (name, bmp.width, bmp.height, taken * 1000, bmp.width * bmp.height / taken / 1000000, size))
+    finally:
+        shutil.rmtree(out_dir)
+
+def makeMask(bmp):
+    """ A full size mask, white wherever the room uses one of its lower colours."""
+    mask_data = (bmp.rows < bmp.rows.mean()).astype('uint8') * 255
+    return Image.frombuffer('L', (bmp.width, bmp.height), mask_data.tostring(), 'raw', 'L', 0, 1)
+
+def benchmarkMaskEncode(repeat):
+    """ v2 and v3 mask encoding, of masks the size of the v2 test room and of the widest v6 room."""
+    rooms = [(os.path.join("v2", "res", "LFv2_001"), 2), (VGA_ROOMS[1][0], 6)]
+    encoders = [("v2", sie.encoder.v2.EncoderV2(sie.classconfigs.ConfigV2)),
+                ("v3", sie.encoder.v3.EncoderV3(sie.classconfigs.ConfigV3))]
+    out_dir = tempfile.mkdtemp()
+    try:
+        for lflf_path, version in rooms:
+            bmp, pal = sie.decoder.decodeBitmap(lflf_path, version, 1)
+            source_mask = makeMask(bmp)
+            for name, encoder in encoders:
+                mask_path = os.path.join(out_dir, "mask")
+                func = lambda: encoder.writeMask(mask_path, source_mask, bmp.width, bmp.height)
+                taken = timeCall(func, repeat)
+                logging.info("%-20s %s %4dx%-4d %8.1f ms %8.2f Mpixels/s %6d bytes" %
+                             (lflf_path, name, bmp.width, bmp.height, taken * 1000, bmp.width * bmp.height / taken / 1000000,
+                              os.path.getsize(mask_path)))
+    finally:
+        shutil.rmtree(out_dir)
+
+def benchmarkMaskDecode(repeat):
+    """ v2 and v3 mask decoding, of the masks from mask_encode, compared to just looping over the mask data."""
+    rooms = [(os.path.join("v2", "res", "LFv2_001"), 2), (VGA_ROOMS[1][0], 6)]
+    decoders = [("v2", sie.encoder.v2.EncoderV2(sie.classconfigs.ConfigV2), sie.decoder.ega.decodeV2Mask),
+                ("v3", sie.encoder.v3.EncoderV3(sie.classconfigs.ConfigV3), sie.decoder.ega.decodeV3Mask)]
+    out_dir = tempfile.mkdtemp()
+    try:
+        for lflf_path, version in rooms:
+            bmp, pal = sie.decoder.decodeBitmap(lflf_path, version, 1)
+            source_mask = makeMask(bmp)
+            for name, encoder, decode in decoders:
+                mask_path = os.path.join(out_dir, "mask_" + name)
+                encoder.writeMask(mask_path, source_mask, bmp.width, bmp.height)
+                data = file(mask_path, 'rb').read()
+                func = lambda: decode(io.BytesIO(data), bmp.width, bmp.height)
+                taken = timeCall(func, repeat)
+                func = lambda: [b for b in bytearray(data)]
+                loop_taken = timeCall(func, repeat)
+                logging.info("%-20s %s %4dx%-4d %8.1f ms %8.2f Mpixels/s  (looping over %6d bytes: %6.1f ms)" %
+                             (lflf_path, name, bmp.width, bmp.height, taken * 1000, bmp.width * bmp.height / taken / 1000000,
+                              len(data), loop_taken * 1000))
+    finally:
+        shutil.rmtree(out_dir)
+
+def makeV1Map(size, max_value):
+    """ A synthetic v1 map: a mix of runs and long stretches of different values."""
+    rnd = random.Random(size)
+    data = []
+    while len(data) < size:
+        if rnd.random() < 0.5:
+            data.extend([rnd.randint(0, max_value)] * rnd.randint(2, 100))
+        else:
+            data.extend(rnd.randint(0, max_value) for _ in xrange(rnd.randint(1, 200)))
+    return array.array('B', data[:size])
+
+def benchmarkV1RLE(repeat):
+    """ v1 RLE compression of synthetic maps for square images up to the largest v1 size (2040x2040),
+    to show the time per value stays the same."""
+    encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
+    for side in [510, 1020, 2040]:
+        num_blocks = (side / 8) * (side / 8)
+        # Object maps have the picture, colour and mask maps one after the other.
+        for name, data, compress in [("picMap", makeV1Map(num_blocks, 255), encoder.compressRLEV1),
+                                     ("colourMap", makeV1Map(num_blocks, 7), encoder.compressColourRLEV1),
+                                     ("objectMap", makeV1Map(num_blocks * 3, 255), encoder.compressRLEV1)]:
+            taken = timeCall(lambda: compress(data), repeat)
+            logging.info("%4dx%-4d %-10s %7d values %8.1f ms %6.2f us/value" %
+                         (side, side, name, len(data), taken * 1000, taken * 1000000 / len(data)))
+
+def benchmarkV1Pack(repeat):
+    """ Packing the v1 room's background and mask into 8x8 blocks, and the same room repeated across 4 times."""
+    lflf_path = os.path.join("v1", "res", "LFv1_001")
+    encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
+    bmp, pal = sie.decoder.decodeBitmap(lflf_path, 1, 1)
+    rows = bmp.data.reshape(bmp.height, bmp.width)
+    for copies in [1, 4]:
+        pixels = np.tile(rows, (1, copies))
+        height, width = pixels.shape
+        source_data = pixels.ravel().tolist()
+        mask_data = (pixels.ravel() & 1).tolist()
+        taken = timeCall(lambda: encoder.packBackgroundData(source_data, width, height), repeat)
+        mask_taken = timeCall(lambda: encoder.packBackgroundMaskData(mask_data, width, height), repeat)
+        logging.info("%4dx%-4d background %8.1f ms  mask %8.1f ms" % (width, height, taken * 1000, mask_taken * 1000))
+
+def benchmarkV1Decode(repeat):
+    """ A whole v1 room, background and objects, and reading the resources they share."""
+    lflf_path = os.path.join("v1", "res", "LFv1_001")
+    num_objects = len([f for f in os.listdir(os.path.join(lflf_path, "ROv1")) if f.startswith("OIv1_")])
+    func = lambda: sie.decoder.decodeImage(lflf_path, "image.png", 1, 1, output_format=sie.decoder.MEMORY)
+    # Leave out the decoder's progress messages for each object.
+    logging.disable(logging.INFO)
+    try:
+        taken = timeCall(func, repeat)
+    finally:
+        logging.disable(logging.NOTSET)
+    logging.info("%-20s %3d objects      %8.1f ms" % (lflf_path, num_objects, taken * 1000))
+    def readResources():
+        resources = sie.decoder.c64.RoomResources(lflf_path)
+        return resources.colours, resources.charMap, resources.maskCharMap
+    logging.info("%-20s shared resources %8.1f ms" % (lflf_path, timeCall(readResources, repeat) * 1000))
+
+def benchmarkC64Decode(repeat):
+    """ The C64 RLE decompression of the v1 room's character, picture and colour maps."""
+    lflf_path = os.path.join("v1", "res", "LFv1_001")
+    bmp, pal = sie.decoder.decodeBitmap(lflf_path, 1, 1)
+    num_blocks = (bmp.width / 8) * (bmp.height / 8)
+    for name, size in [("B1v1", 2048), ("B2v1", num_blocks), ("B3v1", num_blocks)]:
+        data = file(os.path.join(lflf_path, "ROv1", name), 'rb').read()
+        func = lambda: sie.decoder.c64.decodeC64Gfx(io.BytesIO(data), size)
+        taken = timeCall(func, repeat)
+        func = lambda: sie.decoder.c64.decodeC64GfxData(data, size)
+        bytes_taken = timeCall(func, repeat)
+        logging.info("%-20s %s %5d -> %5d bytes  file %8.3f ms  bytes %8.3f ms" %
+                     (lflf_path, name, len(data), size, taken * 1000, bytes_taken * 1000))
+
+BENCHMARKS = [
+    ("c64_decode", benchmarkC64Decode),
+    ("decode_image", benchmarkDecodeImage),
+    ("ega_decode", benchmarkEgaDecode),
+    ("ega_trace", benchmarkEgaTrace),
+    ("v1_decode", benchmarkV1Decode),
+    ("v1_pack", benchmarkV1Pack),
+    ("v1_rle", benchmarkV1RLE),
+    ("v2_encode", benchmarkV2Encode),
+    ("v3_encode", benchmarkV3Encode),
+    ("mask_decode", benchmarkMaskDecode),
+    ("mask_encode", benchmarkMaskEncode),
+    ("output_formats", benchmarkOutputFormats),
+    ("vga_decode", benchmarkVgaDecode),
+    ("vga_decode_bytes", benchmarkVgaDecodeBytes),
+    ("vga_decode_uncompressed", benchmarkVgaDecodeUncompressed),
+    ("vga_decode_jobs", benchmarkVgaDecodeJobs),
+    ("vga_viewport", benchmarkVgaViewport)
+]
+
+def configure_logging():
+    logging.basicConfig(format="", level=logging.INFO)
+
+def main(args):
+    configure_logging()
+    oparser = OptionParser(usage="%prog [options] [benchmark ...]",
+                           version="1.0",
+                           description="Times the encoders and decoders on the test resources. "
+                                       "Runs every benchmark if none are named. "
+                                       "Available: " + ", ".join(name for name, _ in BENCHMARKS))
+    oparser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", default=5,
+                       help="Number of runs for each timing (the best one is reported).")
+
+    options, args = oparser.parse_args()
+
+    names = [name for name, _ in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            oparser.error("Unknown benchmark: %s" % name)
+
+    # Print statements in the decoders would swamp the results.
+    stdout = sys.stdout
+    try:
+        for name, func in BENCHMARKS:
+            if args and name not in args:
+                continue
+            logging.info("--- %s ---" % name)
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                func(options.repeat)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+    except Exception, e:
+        logging.exception("Unhandled exception: \n")
+        return 2
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import sie.decoder
+import sie.logcontext
+import sie.trace
+
+LFLF_PATH = os.path.join(os.path.dirname(__file__), "v2", "res", "LFv2_001")
+
+class TestJobLog(unittest.TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self.root_handlers = root.handlers[:]
+        self.root_level = root.level
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+        for handler in self.root_handlers:
+            root.addHandler(handler)
+        root.setLevel(self.root_level)
+        sie.logcontext.setJob("-")
+        shutil.rmtree(self.out_dir)
+
+    def test_job_log_file(self):
+        log_path = os.path.join(self.out_dir, "{job}.log")
+        sie.logcontext.configureLogging(logging.WARNING, log_path, "LFv2_001")
+        logging.info("not logged")
+        logging.warning("first run")
+        sie.logcontext.configureLogging(logging.WARNING, log_path, "LFv2_001")
+        logging.warning("second run")
+        lines = file(os.path.join(self.out_dir, "LFv2_001.log"), 'r').read().splitlines()
+        # Appended, not overwritten
+        self.assertEqual(2, len(lines))
+        self.assertTrue(all(" - LFv2_001[%d] - WARNING - " % os.getpid() in line for line in lines))
+
+    def test_no_log(self):
+        sie.logcontext.configureLogging(logging.DEBUG, None)
+        self.assertFalse(logging.getLogger().isEnabledFor(logging.CRITICAL))
+
+class TestTrace(unittest.TestCase):
+    def tearDown(self):
+        sie.trace.disableTrace()
+
+    def test_disabled_by_default(self):
+        self.assertFalse(sie.trace.isTraceEnabled())
+
+    def test_trace_json(self):
+        expected, pal = sie.decoder.decodeBitmap(LFLF_PATH, 2)
+        out_dir = tempfile.mkdtemp()
+        try:
+            trace_path = os.path.join(out_dir, "trace.json")
+            sie.trace.enableTrace(trace_path)
+            bmp, pal = sie.decoder.decodeBitmap(LFLF_PATH, 2)
+            sie.trace.disableTrace()
+            self.assertEqual(expected, bmp)
+            records = [json.loads(line) for line in file(trace_path, 'r')]
+        finally:
+            shutil.rmtree(out_dir)
+        columns = [r for r in records if r["event"] == "column"]
+        self.assertEqual(range(bmp.width), [r["column"] for r in columns])
+        self.assertEqual(0, columns[0]["offset"])
+        runs = [r for r in records if r["event"] == "run"]
+        self.assertTrue(runs)
+        self.assertTrue(all(0 <= r["colour"] <= 15 for r in runs))
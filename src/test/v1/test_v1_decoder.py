@@ -4,6 +4,7 @@ import os
 import StringIO
 import unittest
 import sie.decoder.c64 as c64
+from sie.sie_util import ScummImageEncoderException
 
 class TestRLEV1Unpack(unittest.TestCase):
     def setUp(self):
@@ -65,6 +66,25 @@ class TestRLEV1Unpack(unittest.TestCase):
         self.assertEqual(size, len(result))
         self.assertEqual(expected, result)
 
+    def test_rle_bytes(self):
+        # Same as test_rle_real_1, from a string instead of a file.
+        data = "\x03\x0F\x16\x15\xE0\xC1\xA2\x82"
+        expected = array.array('B', [21, 22, 22, 15, 15, 15, 3, 3, 3])
+        self.assertEqual(expected, c64.decodeC64GfxData(data, 9))
+        self.assertEqual(expected, c64.decodeC64GfxData(bytearray(data), 9))
+
+    def test_rle_whole_runs(self):
+        # The last run is output in full, even past the size asked for.
+        data = "\x00\x00\x00\x00\x45\x07\x02\x01\x02\x03"
+        self.assertEqual(array.array('B', [7] * 6), c64.decodeC64GfxData(data, 2))
+        self.assertEqual(array.array('B', [7] * 6 + [1, 2, 3]), c64.decodeC64GfxData(data, 7))
+
+    def test_rle_truncated(self):
+        data = "\x00\x00\x00\x00\x05\x01\x02"
+        self.assertRaises(ScummImageEncoderException, c64.decodeC64GfxData, data, 6)
+        self.assertRaises(ScummImageEncoderException, c64.decodeC64GfxData, "\x00\x00\x00\x00\x45", 6)
+        self.assertRaises(ScummImageEncoderException, c64.decodeC64GfxData, "\x00\x00", 0)
+
 class TestObjectDecode(unittest.TestCase):
     def test_object_decode_1(self):
         objectMap = [0x00, 0x05]
@@ -198,6 +218,31 @@ class TestBackgroundMaskDecode(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+class TestRoomResources(unittest.TestCase):
+    def setUp(self):
+        self.lflf_path = os.path.join('res', 'LFv1_001')
+
+    def test_read_once(self):
+        resources = c64.RoomResources(self.lflf_path)
+        self.assertEqual(c64.readCharMap(self.lflf_path), resources.charMap)
+        self.assertEqual(c64.readMaskCharMap(self.lflf_path), resources.maskCharMap)
+        self.assertTrue(resources.charMap is resources.charMap)
+        self.assertTrue(resources.maskCharMap is resources.maskCharMap)
+        # Unpacking changes the fourth colour, so each caller gets a copy.
+        colours = resources.colours
+        colours[3] = 15
+        self.assertEqual(c64.readCommonColours(self.lflf_path), resources.colours)
+
+    def test_shared_by_objects(self):
+        resources = c64.RoomResources(self.lflf_path)
+        for objNum in ['0014', '0084']:
+            width, height = c64.readObjectDimensions(self.lflf_path, objNum)
+            bmp_data, mask_data = c64.decodeV1Object(self.lflf_path, width, height, objNum, resources)
+            expected_bmp, expected_mask = c64.decodeV1Object(self.lflf_path, width, height, objNum)
+            self.assertEqual(list(expected_bmp), list(bmp_data))
+            self.assertEqual(list(expected_mask), list(mask_data))
+
+
 def configure_logging():
     logging.basicConfig(format="", level=logging.DEBUG)
 
@@ -1,8 +1,13 @@
 import array
 import logging
+import random
 import unittest
+import numpy as np
 import sie.encoder
 import sie.classconfigs
+import sie.decoder.c64 as c64
+from sie.encoder.common import COMPRESSION_MAX
+from sie.sie_util import ScummImageEncoderException
 
 class TestRLEPackRunInfoV1(unittest.TestCase):
     def setUp(self):
@@ -113,6 +118,14 @@ class TestRLEPackRunInfoV1(unittest.TestCase):
             result
         )
 
+    def test_packRunInfo_output_buffer(self):
+        # Codes are added to the end of the buffer, and nothing is returned.
+        output_data = bytearray("\x01")
+        result = self.encoder.packRunInfo(6, 4, [4, 5, 6, 7], None, output_data)
+        self.assertEqual(None, result)
+        self.encoder.packRunInfo(None, 0, [], [1, 2], output_data)
+        self.assertEqual("\x01\xC4\x01\x01\x02", str(output_data))
+
 class TestRLEV1(unittest.TestCase):
     def setUp(self):
         self.encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
@@ -206,6 +219,16 @@ class TestRLEV1(unittest.TestCase):
             result
         )
 
+    def test_rle_colour(self):
+        data = [0, 3, 0, 3, 5, 0, 0, 2, 5]
+        expected = ("\x08\x0B\x0D\x0A" + # common colours, plus 8
+                    "\x80" + # the first 0 is kept
+                    "\xA2" + # 0s carry on the previous colour, so 3 3s...
+                    "\xC2" + # ...and 3 5s
+                    "\x01\x0A\x0D" # 2 discrete values
+        )
+        self.assertEqual(expected, self.encoder.compressColourRLEV1(data))
+
 class TestRowPack(unittest.TestCase):
     def setUp(self):
         self.encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
@@ -222,13 +245,44 @@ class TestRowPack(unittest.TestCase):
                     105, 105, 10, 10, 105, 105, 10, 10])
         common_colours = [10, 190, 105]
         width = 8
-        custom_colour = 5
-        row_start = 0
+        height = 8
         expected = 0x11
         
-        result = self.encoder.packRowData(source_data, common_colours, custom_colour, row_start, width)
-
-        self.assertTrue(expected, result)
+        char_data, custom_colours = self.encoder.packBlocks(source_data, width, height, common_colours)
+
+        self.assertEqual(expected, char_data[0, 0, 0])
+        self.assertEqual(5, custom_colours[0, 0])
+
+    def test_offending_pixels(self):
+        # Every bad pair, and every pixel that doesn't fit in a block, is listed.
+        source_data = [0] * 64
+        source_data[3] = 1
+        source_data[8 * 5 + 6] = 6
+        source_data[8 * 5 + 7] = 6
+        source_data[8 * 7 + 0] = 4
+        source_data[8 * 7 + 1] = 4
+        common_colours = [0, 1, 2]
+        try:
+            self.encoder.packBlocks(source_data, 8, 8, common_colours)
+            self.fail("Expected an exception")
+        except ScummImageEncoderException, e:
+            lines = str(e).split("\n")
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].endswith("Offending pixels at (3, 0)"))
+        self.assertTrue(lines[1].endswith("Offending pixels at (0, 7)"))
+
+    def test_mask_row_pack(self):
+        source_data = [1, 0, 0, 0, 0, 0, 0, 1] * 8
+        source_data[8 * 3 + 1] = 1
+        char_data = self.encoder.packMaskBlocks(source_data, 8, 8)
+        self.assertEqual([0x81, 0x81, 0x81, 0x83, 0x81, 0x81, 0x81, 0x81], char_data[0, 0].tolist())
+
+    def test_mask_offending_pixels(self):
+        source_data = [0] * 64
+        source_data[9] = 2
+        source_data[63] = 3
+        self.assertRaisesRegexp(ScummImageEncoderException, r"\(1, 1\), \(7, 7\)\. Values: 2, 3\.",
+                                self.encoder.packMaskBlocks, source_data, 8, 8)
 
 class TestBlockPack(unittest.TestCase):
     def setUp(self):
@@ -244,29 +298,54 @@ class TestBlockPack(unittest.TestCase):
                     190, 190, 105, 105, 190, 190, 105, 105,
                     190, 190, 5, 5, 190, 190, 5, 5,
                     105, 105, 10, 10, 105, 105, 10, 10])
-        vstrip_i = 0
-        hstrip_i = 0
         width = 8
+        height = 8
         common_colours = [10, 190, 105]
-        block_map = {}
+        blocks = sie.encoder.v1.BlockDictionary("character map")
         picMap = []
-        charMap = []
         colourMap = []
-        expectedBlockMap = {(0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88) : 0}
+        expectedBlockMap = {0x8877665544332211 : 0}
         expectedPicMap = [0]
         expectedCharMap = [0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88]
         expectedColourMap = [5]
 
-        self.encoder.packBlock(source_data, vstrip_i, hstrip_i, width, common_colours, block_map, picMap, charMap, colourMap)
-        print block_map
+        char_data, custom_colours = self.encoder.packBlocks(source_data, width, height, common_colours)
+        blocks.store(char_data, [(0, 0)], picMap)
+        colourMap.append(custom_colours[0, 0])
+        print blocks.indexes
         print picMap
-        print charMap
+        print blocks.charMap
         print colourMap
-        self.assertEqual(expectedBlockMap, block_map)
+        self.assertEqual(expectedBlockMap, blocks.indexes)
         self.assertEqual(expectedPicMap, picMap)
-        self.assertEqual(expectedCharMap, charMap)
+        self.assertEqual(expectedCharMap, blocks.charMap.tolist())
         self.assertEqual(expectedColourMap, colourMap)
 
+class TestBlockDictionary(unittest.TestCase):
+    def test_reuse_and_counts(self):
+        char_data = np.array([[[1] * 8, [2] * 8, [1] * 8],
+                              [[2] * 8, [3] * 8, [1] * 8]])
+        blocks = sie.encoder.v1.BlockDictionary("character map")
+        picMap = []
+        # Down each column, like a background.
+        blocks.store(char_data, [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2), (1, 2)], picMap)
+        self.assertEqual([0, 1, 1, 2, 0, 0], picMap)
+        self.assertEqual([1] * 8 + [2] * 8 + [3] * 8, blocks.charMap.tolist())
+        self.assertEqual([3, 2, 1], blocks.counts)
+        self.assertEqual(3, len(blocks))
+        self.assertEqual("3 of 256 character map blocks used (253 left), 1 used only once", blocks.report())
+
+    def test_too_many_blocks(self):
+        char_data = np.zeros((1, 257, 8), np.uint8)
+        char_data[0, :, 0] = np.arange(257) % 256
+        char_data[0, :, 1] = np.arange(257) / 256
+        blocks = sie.encoder.v1.BlockDictionary("mask character map")
+        picMap = []
+        blocks.store(char_data[:, :256], [(0, x) for x in xrange(256)], picMap)
+        self.assertEqual(range(256), picMap)
+        self.assertRaisesRegexp(ScummImageEncoderException, "Too many entries in the mask character map",
+                                blocks.store, char_data, [(0, 256)], picMap)
+
 
 class TestObjectPack(unittest.TestCase):
     def setUp(self):
@@ -285,8 +364,7 @@ class TestObjectPack(unittest.TestCase):
                     105, 105, 10, 10, 105, 105, 10, 10])
         width = 8
         height = 8
-        charMap = array.array('B')
-        block_map = {}
+        blocks = sie.encoder.v1.BlockDictionary("character map")
         common_colours = [0x0A, 0xBE, 0x69, 0x13]
         mask_data = array.array('B', [0x01])
 
@@ -298,7 +376,8 @@ class TestObjectPack(unittest.TestCase):
         )
 
 
-        objectMap, charMap = self.encoder.packObjectData(source_data, width, height, charMap, block_map, common_colours, mask_data)
+        objectMap = self.encoder.packObjectData(source_data, width, height, blocks, common_colours, mask_data)
+        charMap = blocks.charMap
         self.assertEqual(objectMap, expected_objectMap)
         self.assertEqual(charMap, expected_charMap)
 
@@ -323,8 +402,7 @@ class TestObjectPack(unittest.TestCase):
                      10, 10, 190, 190, 10, 10, 190, 190])
         width = 8
         height = 16
-        charMap = array.array('B')
-        block_map = {}
+        blocks = sie.encoder.v1.BlockDictionary("character map")
         common_colours = [0x0A, 0xBE, 0x69]
         mask_data = array.array('B', [0x11, 0x22])
 
@@ -336,7 +414,8 @@ class TestObjectPack(unittest.TestCase):
              0x88, 0x77, 0x66, 0x55, 0x44, 0x33, 0x22, 0x11]
         )
 
-        objectMap, charMap = self.encoder.packObjectData(source_data, width, height, charMap, block_map, common_colours, mask_data)
+        objectMap = self.encoder.packObjectData(source_data, width, height, blocks, common_colours, mask_data)
+        charMap = blocks.charMap
         self.assertEqual(objectMap, expected_objectMap)
         self.assertEqual(charMap, expected_charMap)
 
@@ -354,8 +433,7 @@ class TestObjectPack(unittest.TestCase):
         ])
         width = 16
         height = 8
-        charMap = array.array('B')
-        block_map = {}
+        blocks = sie.encoder.v1.BlockDictionary("character map")
         common_colours = [0x0A, 0xBE, 0x69]
         mask_data = array.array('B', [0x3A, 0x3B])
 
@@ -369,7 +447,8 @@ class TestObjectPack(unittest.TestCase):
              0x88, 0x77, 0x66, 0x55, 0x44, 0x33, 0x22, 0x11]
         )
 
-        objectMap, charMap = self.encoder.packObjectData(source_data, width, height, charMap, block_map, common_colours, mask_data)
+        objectMap = self.encoder.packObjectData(source_data, width, height, blocks, common_colours, mask_data)
+        charMap = blocks.charMap
         self.assertEqual(objectMap, expected_objectMap)
         self.assertEqual(charMap, expected_charMap)
 
@@ -383,11 +462,7 @@ class TestObjectPack(unittest.TestCase):
                 0xFF, 0xF5, 0x55, 0x5A, 0xAA, 0xA0, 0x00, 0x0E, 0xE7, 0x7A, 0xA7, 0x7C, 0xC7, 0x78, 0x87, 0x70, 0x01, 0x1A, 0xA9, 0x9F, 0xFE, 0xE8, 0x85, 0x50, 0x03, 0x35, 0x55, 0x59, 0x95, 0x5A, 0xA9, 0x9F, 0xFE, 0xE8, 0x83, 0x3A, 0xA2, 0x20, 0x01, 0x19, 0x95, 0x5E, 0xEA, 0xA8, 0x82, 0x2A, 0xA4, 0x40, 0x02, 0x2A, 0xA5, 0x5F, 0xFA, 0xAF, 0xFF, 0xFA, 0xA5, 0x50, 0x01, 0x10, 0x00, 0x0A, 0xAA, 0xAA, 0xA4, 0x40, 0x02, 0x25, 0x5A, 0xA0, 0x0F, 0xF8, 0x8F, 0xFA, 0xA2, 0x20, 0x02, 0x25, 0x56, 0x66, 0x6B, 0xBB, 0xBF, 0xF8, 0x81, 0x1A, 0xA1, 0x10, 0x01, 0x15, 0x5A, 0xAA, 0xAF, 0xF8, 0x83, 0x30, 0x01, 0x15, 0x5A, 0xAA, 0xAF, 0xF8, 0x85, 0x54, 0x47, 0x7A, 0xA9, 0x90, 0x02, 0x25, 0x55, 0x5D, 0xD4, 0x4D, 0xD4, 0x44, 0x44, 0x4C, 0xCC, 0xC8, 0x86, 0x64, 0x40, 0x0F, 0xFC, 0xC8, 0x81, 0x10, 0x05, 0x53, 0x33, 0x33, 0x33, 0x30, 0x03, 0x3C, 0xCF, 0xF1, 0x13, 0x35, 0x54, 0x44, 0x47, 0x7E, 0xE8, 0x80, 0x04, 0x4F, 0xFF, 0xFF, 0xF0, 0x0C, 0xC0, 0x00, 0x03, 0x30, 0x03, 0x38, 0x83, 0x3E, 0xE1, 0x18, 0x85, 0x50, 0x03, 0x33, 0x3F, 0xF0, 0x0F, 0xF0, 0x03, 0x30, 0x03, 0x38, 0x82, 0x2C, 0xC3, 0x34, 0x43, 0x38, 0x85, 0x5C, 0xC3, 0x3A, 0xA3, 0x34, 0x47, 0x75, 0x5A, 0xA4, 0x47, 0x7F, 0xF9, 0x90, 0x08, 0x80, 0x00, 0x0F, 0xF7, 0x7F, 0xF7, 0x7C, 0xC4, 0x4D, 0xD5, 0x5C, 0xC4, 0x4D, 0xD1, 0x17, 0x7D, 0xD0, 0x00, 0x08, 0x86, 0x60, 0x02, 0x20, 0x00, 0x0D, 0xDF, 0xFD, 0xDF, 0xF4, 0x43, 0x35, 0x57, 0x74, 0x40, 0x07, 0x7D, 0xD8, 0x81, 0x1C, 0xC0, 0x0A, 0xA4, 0x48, 0x82, 0x2C, 0xC0, 0x0A, 0xA3, 0x38, 0x83, 0x3C, 0xC0, 0x0A, 0xA2, 0x28, 0x84, 0x4C, 0xC0, 0x0A, 0xA1, 0x10
             ]
         )
-        # Need to fake the block map too.
-        block_map = {}
-        for i in xrange(0, len(charMap), 8):
-            block_key = tuple(charMap[i : i + 8])
-            block_map[block_key] = i / 8
+        blocks = sie.encoder.v1.BlockDictionary("character map", charMap)
         common_colours = [0x00, 0x08, 0x09, 0x06]
         mask_data = array.array('B')
 
@@ -436,10 +511,45 @@ class TestObjectPack(unittest.TestCase):
             ]
         )
 
-        objectMap, charMap = self.encoder.packObjectData(source_data, width, height, charMap, block_map, common_colours, mask_data)
+        objectMap = self.encoder.packObjectData(source_data, width, height, blocks, common_colours, mask_data)
+        charMap = blocks.charMap
         print "objectMap: %s. charMap: %s." % (objectMap, charMap)
         self.assertEqual(expected_objectMap, objectMap)
         self.assertEqual(expected_charMap, charMap)
 
+class TestMaxCompression(unittest.TestCase):
+    def setUp(self):
+        self.encoder = sie.encoder.v1.EncoderV1(sie.classconfigs.ConfigV1)
+
+    def makeData(self, size):
+        rnd = random.Random(22)
+        data = []
+        while len(data) < size:
+            data.extend([rnd.randint(0, 9)] * rnd.choice([1, 1, 2, 3, 5, 40, 70]))
+        return data[:size]
+
+    def test_round_trip(self):
+        data = self.makeData(2048)
+        result = self.encoder.compressRLEV1Smallest(data)
+        self.assertEqual(data, list(c64.decodeC64GfxData(result, len(data))[:len(data)]))
+        self.assertTrue(len(result) <= len(self.encoder.compressRLEV1(data)))
+
+    def test_common_values(self):
+        # 2 is more frequent than 4, but is never a run on its own. Making 4 common saves a byte.
+        data = [3, 5, 5, 5, 6, 2, 1, 1, 1, 4]
+        self.assertEqual('01050203e0a2010602824004', self.encoder.compressRLEV1(data).encode('hex'))
+        self.assertEqual('01050403e0a201060282c0', self.encoder.compressRLEV1Smallest(data).encode('hex'))
+
+    def test_colour_map(self):
+        # Blocks without a custom colour (0) can be output as any colour.
+        data = [0, 3, 0, 3, 5, 0, 0, 5, 3, 0]
+        result = self.encoder.compressMap(data, COMPRESSION_MAX, colours=True)
+        decoded = c64.decodeC64GfxData(result, len(data))
+        self.assertEqual([v for v in data if v], [d & 7 for v, d in zip(data, decoded) if v])
+        self.assertTrue(len(result) <= len(self.encoder.compressColourRLEV1(data)))
+
+    def test_bad_compression_method(self):
+        self.assertRaises(ScummImageEncoderException, self.encoder.compressMap, [1, 2, 3], 1)
+
 def configure_logging():
     logging.basicConfig(format="", level=logging.DEBUG)
\ No newline at end of file
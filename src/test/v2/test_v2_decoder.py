@@ -0,0 +1,53 @@
+import os
+import unittest
+import sie.decoder
+import sie.decoder.ega as ega
+
+LFLF_PATH = os.path.join(os.path.dirname(__file__), "res", "LFv2_001")
+
+class TestColumnDecoding(unittest.TestCase):
+    def test_v2_runs(self):
+        data = bytearray([0x25, # colour 5 for 2 pixels
+                          0x13, # colour 3 for 1 pixel
+                          0x82, # bleed for 2 pixels
+                          0x07, 0x01]) # colour 7, with the length in the next byte
+        self.assertEqual([5, 5,
+                          5, 5,
+                          3, 7], list(ega.decodeV2Bitmap(data, 2, 3)))
+
+    def test_v2_truncated(self):
+        self.assertRaises(sie.decoder.ScummImageEncoderException, ega.decodeV2Bitmap, bytearray([0x25]), 2, 3)
+
+    def test_v3_alternating_run(self):
+        data = bytearray([0, 0, 4, 0, # header - the image starts at offset 4
+                          0xC4, 0x52, # 4 pixels alternating between colours 5 and 2
+                          0x82]) # bleed for 2 pixels
+        self.assertEqual([5, 2,
+                          2, 2,
+                          5, 5], list(ega.decodeV3Bitmap(data, 2, 3)))
+
+    def test_v3_ends_early(self):
+        data = bytearray([0, 0, 4, 0, 0x35])
+        self.assertEqual([5, 0, 5, 0, 5, 0], list(ega.decodeV3Bitmap(data, 2, 3)))
+
+    def test_from_file(self):
+        bitmap_path = os.path.join(LFLF_PATH, "ROv2", "IMv2")
+        from_file = ega.decodeV2Bitmap(file(bitmap_path, 'rb'), 320, 128)
+        self.assertEqual(from_file, ega.decodeV2Bitmap(file(bitmap_path, 'rb').read(), 320, 128))
+
+class TestMaskDecoding(unittest.TestCase):
+    def test_v2_runs(self):
+        data = bytearray([0x82, 0xF0, # 0xF0 repeated for 2 rows
+                          0x02, 0x01, 0x80]) # the next 2 rows
+        mask = ega.decodeV2Mask(data, 16, 2)
+        self.assertEqual([[0xF0, 0x01],
+                          [0xF0, 0x80]], mask.rows.tolist())
+        self.assertEqual([1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1], list(mask.unpack())[:16])
+
+    def test_v2_truncated(self):
+        self.assertEqual([[0x01, 0], [0, 0]], ega.decodeV2Mask(bytearray([0x03, 0x01]), 16, 2).rows.tolist())
+
+    def test_v3_missing_byte_at_chunk_end(self):
+        data = bytearray([2, 0, # the mask starts at offset 2
+                          0x82]) # ends the column, without the byte to repeat
+        self.assertEqual([[0x82], [0x82]], ega.decodeV3Mask(data, 8, 2).rows.tolist())
@@ -0,0 +1,84 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+import sie.classconfigs
+import sie.decoder.ega as ega
+import sie.encoder.v2
+from sie.encoder.common import COMPRESSION_MAX, packMaskBits
+from sie.sie_util import ScummImageEncoderException
+
+class TestBitmapRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.encoder = sie.encoder.v2.EncoderV2(sie.classconfigs.ConfigV2)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def makeImage(self, width, height):
+        rnd = random.Random(3)
+        pixels = []
+        for y in xrange(height):
+            for x in xrange(width):
+                # Some flat areas, some noise, and rows that repeat in the next column (to bleed).
+                if y < height / 3:
+                    pixels.append((y / 8) % 16)
+                elif y < 2 * height / 3:
+                    pixels.append(rnd.randint(0, 15))
+                else:
+                    pixels.append((x / 4 + y) % 16)
+        source_image = Image.new('P', (width, height))
+        source_image.putdata(pixels)
+        return source_image, pixels
+
+    def assertRoundTrip(self, width, height, compression_method=None):
+        source_image, pixels = self.makeImage(width, height)
+        self.encoder.writeBitmap(self.out_dir, None, source_image, width, height, compression_method, False, 16)
+        bitmap_path = self.encoder.getBitmapPath(self.out_dir)
+        self.assertEqual(pixels, list(ega.decodeV2Bitmap(file(bitmap_path, 'rb'), width, height)))
+        return os.path.getsize(bitmap_path)
+
+    def test_round_trip(self):
+        self.assertRoundTrip(32, 128)
+
+    def test_taller_than_128(self):
+        self.assertRoundTrip(24, 200)
+
+    def test_max_compression(self):
+        default_size = self.assertRoundTrip(32, 128)
+        self.assertTrue(self.assertRoundTrip(32, 128, COMPRESSION_MAX) < default_size)
+
+    def test_max_compression_bleeds_into_strip(self):
+        # Every column is the same. The default encoding starts the second strip with colour runs again.
+        width = 16
+        height = 4
+        source_data = [y for y in xrange(height) for x in xrange(width)]
+        self.assertEqual('101112139c101112139c', self.encoder.encodeImageData(source_data, width, height).encode('hex'))
+        self.assertEqual('10111213bc', self.encoder.encodeImageDataSmallest(source_data, width, height).encode('hex'))
+
+    def test_object_taller_than_128(self):
+        width = 16
+        height = 160
+        source_image, pixels = self.makeImage(width, height)
+        object_path = os.path.join(self.out_dir, "OIv2_0001")
+        self.encoder.writeObject(object_path, None, source_image, None, width, height, None, False, 16)
+        img, mask = ega.decodeV2ObjectBitmap(file(object_path, 'rb'), width, height)
+        self.assertEqual(pixels, list(img))
+
+class TestPackMaskBits(unittest.TestCase):
+    def test_pack(self):
+        width = 16
+        height = 2
+        source_mask = Image.new('L', (width, height))
+        source_mask.putdata([255, 0, 0, 0, 0, 0, 0, 255] + [0] * 8 +
+                            [254] * 8 + [255] * 8)
+        # One list per column of bytes
+        self.assertEqual([[0x81, 0x00], [0x00, 0xFF]], packMaskBits(source_mask, width, height))
+        bw_mask = source_mask.point(lambda v: 255 if v == 255 else 0).convert('1')
+        self.assertEqual([[0x81, 0x00], [0x00, 0xFF]], packMaskBits(bw_mask, width, height))
+
+    def test_wrong_size(self):
+        self.assertRaises(ScummImageEncoderException, packMaskBits, Image.new('L', (16, 8)), 8, 8)
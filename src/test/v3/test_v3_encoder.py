@@ -0,0 +1,62 @@
+import io
+import random
+import unittest
+from PIL import Image
+import sie.classconfigs
+import sie.decoder.ega as ega
+import sie.encoder.v3
+from sie.encoder.common import COMPRESSION_MAX
+from sie.sie_util import ScummImageEncoderException
+
+class TestMaxCompression(unittest.TestCase):
+    def setUp(self):
+        self.encoder = sie.encoder.v3.EncoderV3(sie.classconfigs.ConfigV3)
+
+    def makeImage(self, width, height):
+        """ Builds each column from random stretches, since v3 encodes down the columns. Alternating
+        stretches can be longer than one alternating run (63 pixels), and start on either colour."""
+        rnd = random.Random(16)
+        columns = []
+        for x in xrange(width):
+            column = []
+            while len(column) < height:
+                length = rnd.randint(1, 70)
+                colour, colour_alt = rnd.randint(0, 15), rnd.randint(0, 15)
+                kind = rnd.randint(0, 3)
+                if kind == 0:
+                    column.extend([colour] * length)
+                elif kind == 1:
+                    column.extend((colour, colour_alt)[(len(column) + i) % 2] for i in xrange(length))
+                elif kind == 2:
+                    column.extend(rnd.randint(0, 15) for _ in xrange(length))
+                elif columns:
+                    # Copies the column to the left, to bleed.
+                    column.extend(columns[-1][len(column):len(column) + length])
+            columns.append(column[:height])
+        pixels = [columns[x][y] for y in xrange(height) for x in xrange(width)]
+        source_image = Image.new('P', (width, height))
+        source_image.putdata(pixels)
+        return source_image, pixels
+
+    def encode(self, source_image, width, height, compression_method):
+        img_file = io.BytesIO()
+        self.encoder.writeImageData(img_file, source_image.getdata(), width, height, compression_method)
+        return img_file.getvalue()
+
+    def test_round_trip(self):
+        width = 32
+        height = 128
+        source_image, pixels = self.makeImage(width, height)
+        data = self.encode(source_image, width, height, COMPRESSION_MAX)
+        self.assertEqual(pixels, list(ega.decodeV3Bitmap(data, width, height)))
+        self.assertTrue(len(data) <= len(self.encode(source_image, width, height, None)))
+
+    def test_smaller_than_default(self):
+        # Taking all eight 0s needs the 2 byte form. Taking seven leaves a longer alternating run.
+        pixels = [0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 2, 2, 0, 2, 0, 1]
+        self.assertEqual('0008c320c42011', self.encoder.encodeChunk(pixels, 2).encode('hex'))
+        self.assertEqual('70c402c42011', self.encoder.encodeChunkSmallest(pixels, 2).encode('hex'))
+
+    def test_bad_compression_method(self):
+        source_image, pixels = self.makeImage(8, 8)
+        self.assertRaises(ScummImageEncoderException, self.encode, source_image, 8, 8, 1)
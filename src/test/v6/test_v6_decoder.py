@@ -0,0 +1,221 @@
+import array
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+import sie.decoder
+import sie.decoder.vga as vga
+from sie.sie_util import Bitmap, PackedBitmap, ScummImageEncoderException
+
+def smapPath(lflf_name):
+    return os.path.join(os.path.dirname(__file__), "res", lflf_name, "ROOM", "RMIM", "IM00", "SMAP.dmp")
+
+def packBits(bits):
+    """ Packs a list of bits into bytes, lowest bit first (the order SCUMM reads them)."""
+    data = bytearray((len(bits) + 7) / 8)
+    for i, b in enumerate(bits):
+        data[i / 8] |= b << (i % 8)
+    return data
+
+def intToBits(value, length):
+    return [(value >> i) & 1 for i in xrange(length)]
+
+class TestBitmap(unittest.TestCase):
+    def test_views(self):
+        bmp = Bitmap(16, 2)
+        bmp.getStrip(1)[:] = 7
+        bmp.getColumn(0)[:] = [1, 2]
+        self.assertEqual([1] + [0] * 7 + [7] * 8 + [2] + [0] * 7 + [7] * 8, list(bmp))
+        self.assertEqual(7, bmp[8])
+        self.assertEqual((2, 16), bmp.rows.shape)
+
+    def test_crop(self):
+        bmp = Bitmap(16, 2, np.arange(32, dtype=np.uint8))
+        cropped = bmp.crop(6, 4)
+        self.assertEqual([6, 7, 8, 9, 22, 23, 24, 25], list(cropped))
+        cropped[0] = 99
+        self.assertEqual(6, bmp[6])
+
+    def test_compare(self):
+        self.assertEqual(array.array('B', [0, 0, 5]), Bitmap(3, 1, np.array([0, 0, 5], np.uint8)))
+        self.assertNotEqual(Bitmap(3, 1), Bitmap(4, 1))
+
+    def test_unpack(self):
+        mask = PackedBitmap(16, 1, np.array([0x81, 0x0F], np.uint8))
+        self.assertEqual([1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 1, 1, 1], list(mask.unpack()))
+
+class TestBitStreamDecoding(unittest.TestCase):
+    def decodeStrip(self, method, data, paramSub, rendDir=vga.HORIZONTAL, height=2):
+        img = Bitmap(8, height)
+        if method == 1:
+            vga.doMethodOne(data, 0, img, 8, height, len(data), 0, paramSub, rendDir)
+        else:
+            vga.doMethodTwo(data, 0, img, 8, height, len(data), 0, paramSub)
+        return list(img)
+
+    def test_method_one_codes(self):
+        bits = [0] + \
+               [1, 0] + intToBits(9, 4) + \
+               [1, 1, 0] + \
+               [1, 1, 1] + \
+               [1, 1, 1]
+        data = bytearray([5]) + packBits(bits)
+        self.assertEqual([5, 5, 9, 8, 9, 8] + [0] * 10, self.decodeStrip(1, data, 4))
+
+    def test_method_one_vertical(self):
+        bits = [1, 0] + intToBits(3, 4) + [0] * 14
+        data = bytearray([1]) + packBits(bits)
+        self.assertEqual([1] + [3] * 15, self.decodeStrip(1, data, 4, vga.VERTICAL))
+
+    def test_method_two_codes(self):
+        bits = [1, 1] + intToBits(7, 3) + \
+               [1, 1] + intToBits(0, 3) + \
+               [1, 0] + intToBits(30, 5) + \
+               [1, 1] + intToBits(4, 3) + intToBits(12, 8)
+        data = bytearray([10]) + packBits(bits)
+        self.assertEqual([10, 13, 9, 30] + [30] * 12, self.decodeStrip(2, data, 5))
+
+    def test_uncompressed(self):
+        data = bytearray(xrange(1, 25))
+        img = Bitmap(16, 3)
+        vga.doUncompressed(data, 0, img, 16, 3, len(data), 1)
+        self.assertEqual([0] * 8 + range(1, 9) + [0] * 8 + range(9, 17) + [0] * 8 + range(17, 25), list(img))
+
+    def test_uncompressed_truncated(self):
+        data = bytearray(xrange(1, 12))
+        img = Bitmap(8, 3)
+        vga.doUncompressed(data, 1, img, 8, 3, len(data), 0)
+        self.assertEqual(range(2, 12) + [0] * 14, list(img))
+
+    def test_truncated_strip(self):
+        # The strip ends in the middle of a palette index - the rest of the strip is left alone.
+        bits = [0, 0, 1, 0, 1, 1]
+        data = bytearray([7]) + packBits(bits)
+        self.assertEqual([7, 7, 7] + [0] * 13, self.decodeStrip(1, data, 8))
+        self.assertEqual([7, 7, 7] + [0] * 13, self.decodeStrip(2, data, 8))
+
+class TestRoomDecoding(unittest.TestCase):
+    def assertDecodedHash(self, lflf_name, width, height, expected):
+        img = vga.decodeVgaBitmap(file(smapPath(lflf_name), 'rb'), width, height)
+        self.assertEqual(expected, hashlib.md5(img.tostring()).hexdigest())
+
+    def test_room_v5(self):
+        self.assertDecodedHash(os.path.join("..", "..", "v5", "res", "LFLF_001"), 320, 200, "7f8a4c51410190d4e99d7552767bda1c")
+
+    def test_room_v6_method_two(self):
+        self.assertDecodedHash("LFLF_002", 320, 200, "bb11b20818ff8e5f856506d7d252d3fc")
+
+    def test_room_from_bytes(self):
+        smap_path = smapPath("LFLF_002")
+        from_file = vga.decodeVgaBitmap(file(smap_path, 'rb'), 320, 200)
+        smap_data = file(smap_path, 'rb').read()
+        self.assertEqual(from_file, vga.decodeVgaBitmap(smap_data, 320, 200))
+        self.assertEqual(from_file, vga.decodeVgaBitmap(bytearray(smap_data), 320, 200))
+        self.assertEqual(from_file, vga.decodeVgaBitmap(buffer(smap_data), 320, 200))
+
+    def test_room_parallel(self):
+        smap_data = file(smapPath("LFLF_001"), 'rb').read()
+        serial = vga.decodeVgaBitmap(smap_data, 784, 200)
+        # 98 strips doesn't divide evenly between 3 or 4 jobs
+        for jobs in (2, 3, 4):
+            self.assertEqual(serial, vga.decodeVgaBitmap(smap_data, 784, 200, jobs))
+
+    def test_room_v6_wide(self):
+        self.assertDecodedHash("LFLF_046", 480, 144, "27c24769c7e508cdcb3bcd2ec4d8b321")
+
+class TestDecodeBitmap(unittest.TestCase):
+    def test_decode_bitmap(self):
+        lflf_path = os.path.join(os.path.dirname(__file__), "res", "LFLF_002")
+        bmp, pal = sie.decoder.decodeBitmap(lflf_path, 6)
+        self.assertEqual((320, 200), (bmp.width, bmp.height))
+        self.assertEqual("bb11b20818ff8e5f856506d7d252d3fc", hashlib.md5(bmp.tostring()).hexdigest())
+        self.assertEqual(768, len(pal))
+
+    def test_save_images(self):
+        bmp = Bitmap(16, 8, np.arange(128, dtype=np.uint8))
+        mask = PackedBitmap(16, 8, np.arange(16, dtype=np.uint8) * 15)
+        decoder = sie.decoder.v6.DecoderV6(None)
+        out_dir = tempfile.mkdtemp()
+        try:
+            image_path = os.path.join(out_dir, "image.png")
+            decoder.saveImage(image_path, 16, 8, bmp, range(256) * 3)
+            self.assertEqual(bmp.tostring(), Image.open(image_path).tobytes())
+            mask_path = os.path.join(out_dir, "mask.png")
+            decoder.saveBWImage(mask_path, 16, 8, mask)
+            self.assertEqual([255 * v for v in mask.unpack()], list(Image.open(mask_path).getdata()))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_output_formats(self):
+        lflf_path = os.path.join(os.path.dirname(__file__), "res", "LFLF_002")
+        bmp, pal = sie.decoder.decodeBitmap(lflf_path, 6)
+        out_dir = tempfile.mkdtemp()
+        try:
+            image_path = os.path.join(out_dir, "image.png")
+            sie.decoder.decodeImage(lflf_path, image_path, 6, 1, png_compress_level=0)
+            self.assertEqual(bmp.tostring(), Image.open(image_path).tobytes())
+            sie.decoder.decodeImage(lflf_path, image_path, 6, 1, output_format=sie.decoder.RAW)
+            self.assertEqual(bmp.tostring(), file(os.path.join(out_dir, "image.bin"), 'rb').read())
+            self.assertEqual(list(pal), list(bytearray(file(os.path.join(out_dir, "image.pal"), 'rb').read())))
+            sie.decoder.decodeImage(lflf_path, image_path, 6, 1, output_format=sie.decoder.NPY)
+            self.assertTrue(np.array_equal(bmp.rows, np.load(os.path.join(out_dir, "image.npy"))))
+            self.assertEqual(["image.bin", "image.npy", "image.pal", "image.png"], sorted(os.listdir(out_dir)))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_output_memory(self):
+        lflf_path = os.path.join(os.path.dirname(__file__), "res", "LFLF_002")
+        images = sie.decoder.decodeImage(lflf_path, "image.png", 6, 1, output_format=sie.decoder.MEMORY)
+        bmp, pal = images["image.png"]
+        self.assertEqual("bb11b20818ff8e5f856506d7d252d3fc", hashlib.md5(bmp.tostring()).hexdigest())
+        self.assertEqual(768, len(pal))
+
+    def test_bad_output_options(self):
+        self.assertRaises(ScummImageEncoderException, sie.decoder.ImageOutput, "gif")
+        self.assertRaises(ScummImageEncoderException, sie.decoder.ImageOutput, sie.decoder.PNG, 10)
+
+class TestViewportDecoding(unittest.TestCase):
+    def setUp(self):
+        self.width = 784
+        self.height = 200
+        self.smap_path = smapPath("LFLF_001")
+        self.full = vga.decodeVgaBitmap(file(self.smap_path, 'rb'), self.width, self.height)
+
+    def crop(self, x, view_width):
+        view = array.array('B')
+        for y in xrange(self.height):
+            view.extend(self.full[y * self.width + x:y * self.width + x + view_width])
+        return view
+
+    def test_strips(self):
+        smap = file(self.smap_path, 'rb')
+        try:
+            self.assertEqual(self.crop(80, 320), vga.decodeVgaStrips(smap, self.width, self.height, 10, 40))
+        finally:
+            smap.close()
+
+    def test_viewport(self):
+        smap = file(self.smap_path, 'rb')
+        try:
+            for x, view_width in ((0, 320), (464, 320), (13, 320), (777, 7), (0, 784)):
+                self.assertEqual(self.crop(x, view_width), vga.decodeVgaViewport(smap, self.width, self.height, x, view_width))
+        finally:
+            smap.close()
+
+    def test_viewport_from_bytes(self):
+        smap_data = file(self.smap_path, 'rb').read()
+        self.assertEqual(self.crop(101, 320), vga.decodeVgaViewport(smap_data, self.width, self.height, 101, 320))
+
+    def test_viewport_outside_image(self):
+        smap_data = file(self.smap_path, 'rb').read()
+        self.assertRaises(ScummImageEncoderException, vga.decodeVgaViewport, smap_data, self.width, self.height, 500, 320)
+        self.assertRaises(ScummImageEncoderException, vga.decodeVgaStrips, smap_data, self.width, self.height, 90, 9)
+
+    def test_decode_viewport(self):
+        lflf_path = os.path.join(os.path.dirname(__file__), "res", "LFLF_001")
+        view, height = sie.decoder.decodeViewport(lflf_path, 6, 240, 320)
+        self.assertEqual(self.height, height)
+        self.assertEqual(self.crop(240, 320), view)
@@ -0,0 +1,122 @@
+import array
+import random
+import unittest
+import sie.encoder.vga as vga
+from sie.decoder.vga import decodeVgaBitmap
+
+def decodeSmap(smap_data, width, height):
+    return decodeVgaBitmap(smap_data, width, height)
+
+def makeStrip(pixels, compID):
+    """ Builds a single-strip SMAP block around some encoded strip data."""
+    return "SMAP" + array.array('B', [0, 0, 0, 13 + len(pixels)]).tostring() + \
+        array.array('B', [12, 0, 0, 0]).tostring() + chr(compID) + pixels.tostring()
+
+class TestStripEncode(unittest.TestCase):
+    def test_method_one_same_colour(self):
+        pixels = [0x22] * 16
+        result = vga.encodeMethodOne(pixels, 6)
+        # First colour, then 15 "same colour" bits (padded).
+        self.assertEqual(array.array('B', [0x22, 0x00, 0x00]), result)
+
+    def test_method_one_increments(self):
+        # 5 -> 4 uses the starting increment (110), 4 -> 5 negates it (111).
+        pixels = [5, 4, 3, 4]
+        result = vga.encodeMethodOne(pixels, 4)
+        expected_bits = [1, 1, 0,  1, 1, 0,  1, 1, 1]
+        expected = sum(b << i for i, b in enumerate(expected_bits))
+        self.assertEqual(array.array('B', [5, expected & 0xFF, expected >> 8]), result)
+
+    def test_method_one_palette_index_too_big(self):
+        self.assertEqual(None, vga.encodeMethodOne([0, 200], 4))
+        self.assertNotEqual(None, vga.encodeMethodOne([0, 200], 8))
+
+    def test_method_two_long_run_uses_repeat(self):
+        pixels = [7] * 100
+        result = vga.encodeMethodTwo(pixels, 4)
+        # Colour, then one 13 bit repeat command.
+        self.assertEqual(3, len(result))
+
+    def test_method_two_palette_index_too_big(self):
+        self.assertEqual(None, vga.encodeMethodTwo([0, 17], 4))
+        self.assertNotEqual(None, vga.encodeMethodTwo([0, 17], 5))
+
+    def test_min_param_sub(self):
+        self.assertEqual(4, vga.getMinParamSub([0, 3, 15]))
+        self.assertEqual(5, vga.getMinParamSub([16]))
+        self.assertEqual(8, vga.getMinParamSub([255]))
+
+class TestStripSearch(unittest.TestCase):
+    def test_early_abort(self):
+        pixels = range(0, 256, 16) * 4
+        data = vga.encodeMethodOne(pixels, 8)
+        self.assertNotEqual(None, data)
+        self.assertEqual(None, vga.encodeMethodOne(pixels, 8, len(data)))
+        self.assertEqual(data, vga.encodeMethodOne(pixels, 8, len(data) + 1))
+        self.assertEqual(None, vga.encodeMethodTwo(pixels, 8, 4))
+
+    def test_small_param_sub_reached_by_increments(self):
+        # Colours above 15 don't need a 5 bit palette index if they can be reached with increments.
+        width = 8
+        height = 8
+        bitdata = [14 + (i % 8) / 2 for i in xrange(width * height)]
+        compID, data = vga.findBestStripEncoding(bitdata, width, height, 0, 0)
+        compMethod, paramSub, rendDir = vga.getCompressionParams(compID)
+        self.assertEqual(4, paramSub)
+
+    def test_uncompressed_fallback(self):
+        rnd = random.Random(7)
+        width = 8
+        height = 8
+        bitdata = [rnd.randint(0, 255) for _ in xrange(width * height)]
+        compID, data = vga.findBestStripEncoding(bitdata, width, height, 0, 0)
+        self.assertEqual(vga.UNCOMPRESSED, compID)
+        self.assertEqual(array.array('B', bitdata), data)
+
+    def test_strip_report(self):
+        strips = [(0x01, array.array('B', [0] * 64)), (0x40, array.array('B', [0, 0, 0]))]
+        report = vga.getStripReport(strips, 8)
+        self.assertEqual(3, len(report))
+        self.assertTrue("uncompressed" in report[0])
+        self.assertTrue("0x40 (method 2, horizontal, paramSub 4) - 4 bytes" in report[1])
+
+class TestVgaRoundTrip(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(42)
+        self.width = 64
+        self.height = 16
+        self.bitdata = []
+        for y in xrange(self.height):
+            for x in xrange(self.width):
+                if x < 16:
+                    val = 0x10 # flat
+                elif x < 32:
+                    val = 0x80 + (x + y) % 4 # gentle gradient
+                elif x < 48:
+                    val = rnd.randint(0, 255) # noise
+                else:
+                    val = (y / 4) * 3 # horizontal bands
+                self.bitdata.append(val)
+
+    def assertRoundTrip(self, compression_method):
+        smap_data = vga.encodeVgaBitmap(self.bitdata, self.width, self.height, compression_method=compression_method)
+        result = decodeSmap(smap_data, self.width, self.height)
+        self.assertEqual(array.array('B', self.bitdata), result)
+        return smap_data
+
+    def test_round_trip_best(self):
+        smap_data = self.assertRoundTrip(None)
+        uncompressed = vga.encodeVgaBitmap(self.bitdata, self.width, self.height, compression_method=vga.UNCOMPRESSED)
+        self.assertTrue(len(smap_data) < len(uncompressed))
+
+    def test_round_trip_uncompressed(self):
+        self.assertRoundTrip(vga.UNCOMPRESSED)
+
+    def test_round_trip_forced_methods(self):
+        for base in (vga.METHOD_ONE_HORIZONTAL_BASE, vga.METHOD_ONE_VERTICAL_BASE, vga.METHOD_TWO_BASE):
+            self.assertRoundTrip(base + 8)
+
+    def test_single_strip(self):
+        pixels = vga.encodeMethodTwo([0x41] * 64, 4)
+        result = decodeSmap(makeStrip(pixels, 0x40), 8, 8)
+        self.assertEqual(array.array('B', [0x41] * 64), result)